@@ -0,0 +1,10 @@
+from dotenv import load_dotenv
+
+# before the settings are read by `parking.config`
+load_dotenv()
+
+from .parking.asgi import create_asgi_app  # noqa: E402
+
+# uvicorn src.asgi:app --workers 4
+# gunicorn -k uvicorn.workers.UvicornWorker -w 4 src.asgi:app
+app = create_asgi_app()
@@ -0,0 +1,55 @@
+"""
+Настройки gunicorn (read from the working directory, `gunicorn manage:app`).
+
+The application is imported and created once in the master (`preload_app`),
+the workers are forked from it: the imports, the settings and the schema check
+are not repeated by every worker, the pool of the engine is reset in the
+workers (see `parking/engine.py`).
+
+The workers are threaded (gthread): an SSE stream (`/parkings/events`) or
+a long poll (`/parkings/changes`) holds one thread of a worker, not the
+worker, the gates are served by the other threads.
+"""
+
+import logging
+import os
+import secrets
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_CONCURRENCY", 4))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", 32))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 600))
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+# The shared memory segments of this master and its workers (see
+# `parking/shm.py`): new names on every start, removed on exit
+os.environ.setdefault("SHM_PREFIX", f"parking_{os.getpid()}_{secrets.token_hex(4)}")
+
+
+def when_ready(server):
+    """The schema check of the preloaded application, before the fork"""
+
+    if not preload_app:
+        return
+    app = server.app.wsgi()
+    with app.app_context():
+        engine = app.extensions["sqlalchemy"].engine
+        try:
+            app.extensions["schema_bootstrap"](engine)
+        except Exception:
+            # the database is not ready: every worker checks it on its first request
+            logging.getLogger("gunicorn.error").exception("Schema check failed")
+        finally:
+            engine.dispose()
+
+
+def on_exit(server):
+    """Removing the shared memory segments of the workers"""
+
+    # the working directory of gunicorn is `src` (see the Dockerfile)
+    from parking.shm import unlink_segments  # type: ignore[import-not-found]
+
+    removed = unlink_segments(os.environ["SHM_PREFIX"])
+    if removed:
+        logging.getLogger("gunicorn.error").info("Removed segments: %s", removed)
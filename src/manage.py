@@ -1,4 +1,9 @@
-from .parking.app import create_app
+from dotenv import load_dotenv
+
+# before the settings are read by `parking.config`
+load_dotenv()
+
+from .parking.app import create_app  # noqa: E402
 
 app = create_app()
 
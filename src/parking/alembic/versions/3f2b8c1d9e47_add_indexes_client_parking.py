@@ -0,0 +1,40 @@
+"""add indexes client_parking
+
+Revision ID: 3f2b8c1d9e47
+Revises: 775963414090
+Create Date: 2026-10-18 10:12:31.204518
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "3f2b8c1d9e47"
+down_revision: Union[str, None] = "775963414090"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index(
+        "ix_client_parking_client_id_parking_id",
+        "client_parking",
+        ["client_id", "parking_id"],
+    )
+    op.create_index(
+        "ix_client_parking_active",
+        "client_parking",
+        ["client_id", "parking_id"],
+        postgresql_where=sa.text("time_out IS NULL"),
+        sqlite_where=sa.text("time_out IS NULL"),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_client_parking_active", table_name="client_parking")
+    op.drop_index("ix_client_parking_client_id_parking_id", table_name="client_parking")
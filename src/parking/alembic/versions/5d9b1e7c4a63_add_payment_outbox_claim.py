@@ -0,0 +1,30 @@
+"""add payment outbox claim
+
+Revision ID: 5d9b1e7c4a63
+Revises: 0a7e5c3b9f21
+Create Date: 2026-10-18 19:12:07.318452
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "5d9b1e7c4a63"
+down_revision: Union[str, None] = "0a7e5c3b9f21"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column(
+        "payment_outbox", sa.Column("claim", sa.String(length=32), nullable=True)
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column("payment_outbox", "claim")
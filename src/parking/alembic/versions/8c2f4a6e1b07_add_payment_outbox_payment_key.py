@@ -0,0 +1,34 @@
+"""add payment outbox payment key
+
+Revision ID: 8c2f4a6e1b07
+Revises: 5d9b1e7c4a63
+Create Date: 2026-10-18 20:04:41.902316
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "8c2f4a6e1b07"
+down_revision: Union[str, None] = "5d9b1e7c4a63"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column(
+        "payment_outbox", sa.Column("payment_key", sa.String(length=64), nullable=True)
+    )
+    # every capture so far is the capture of its payment
+    op.execute("UPDATE payment_outbox SET payment_key = key")
+    op.create_index("ix_payment_outbox_payment_key", "payment_outbox", ["payment_key"])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_payment_outbox_payment_key", table_name="payment_outbox")
+    op.drop_column("payment_outbox", "payment_key")
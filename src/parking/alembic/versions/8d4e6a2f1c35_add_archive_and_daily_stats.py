@@ -0,0 +1,59 @@
+"""add archive and daily stats
+
+Revision ID: 8d4e6a2f1c35
+Revises: 3f2b8c1d9e47
+Create Date: 2026-10-18 12:40:12.118403
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "8d4e6a2f1c35"
+down_revision: Union[str, None] = "3f2b8c1d9e47"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "client_parking_archive",
+        sa.Column("id", sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column("client_id", sa.Integer(), nullable=False),
+        sa.Column("parking_id", sa.Integer(), nullable=False),
+        sa.Column("time_in", sa.DateTime(), nullable=True),
+        sa.Column("time_out", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_client_parking_archive_parking_id_time_out",
+        "client_parking_archive",
+        ["parking_id", "time_out"],
+    )
+    op.create_table(
+        "parking_daily_stats",
+        sa.Column("parking_id", sa.Integer(), nullable=False),
+        sa.Column("day", sa.Date(), nullable=False),
+        sa.Column("visits", sa.Integer(), nullable=False),
+        sa.Column("dwell_seconds", sa.BigInteger(), nullable=False),
+        sa.Column("peak_occupancy", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["parking_id"],
+            ["parkings.id"],
+        ),
+        sa.PrimaryKeyConstraint("parking_id", "day"),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table("parking_daily_stats")
+    op.drop_index(
+        "ix_client_parking_archive_parking_id_time_out",
+        table_name="client_parking_archive",
+    )
+    op.drop_table("client_parking_archive")
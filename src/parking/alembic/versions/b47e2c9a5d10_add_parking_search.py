@@ -0,0 +1,77 @@
+"""add parking search
+
+Revision ID: b47e2c9a5d10
+Revises: 8d4e6a2f1c35
+Create Date: 2026-10-18 14:05:47.630912
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "b47e2c9a5d10"
+down_revision: Union[str, None] = "8d4e6a2f1c35"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SQLITE_SEARCH = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS parkings_search USING fts5("
+    "name, address, content='parkings', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS parkings_search_insert AFTER INSERT ON parkings "
+    "BEGIN INSERT INTO parkings_search(rowid, name, address) "
+    "VALUES (new.id, new.name, new.address); END",
+    "CREATE TRIGGER IF NOT EXISTS parkings_search_delete AFTER DELETE ON parkings "
+    "BEGIN INSERT INTO parkings_search(parkings_search, rowid, name, address) "
+    "VALUES ('delete', old.id, old.name, old.address); END",
+    "CREATE TRIGGER IF NOT EXISTS parkings_search_update "
+    "AFTER UPDATE OF name, address ON parkings "
+    "BEGIN INSERT INTO parkings_search(parkings_search, rowid, name, address) "
+    "VALUES ('delete', old.id, old.name, old.address); "
+    "INSERT INTO parkings_search(rowid, name, address) "
+    "VALUES (new.id, new.name, new.address); END",
+    "INSERT INTO parkings_search(parkings_search) VALUES ('rebuild')",
+)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    dialect = op.get_bind().dialect.name
+    op.add_column("parkings", sa.Column("latitude", sa.Float(), nullable=True))
+    op.add_column("parkings", sa.Column("longitude", sa.Float(), nullable=True))
+    op.create_index(
+        "ix_parkings_opened_available", "parkings", ["opened", "count_available_places"]
+    )
+    op.create_index("ix_parkings_location", "parkings", ["latitude", "longitude"])
+    if dialect == "postgresql":
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        for column in ("name", "address"):
+            op.create_index(
+                f"ix_parkings_{column}_trgm",
+                "parkings",
+                [column],
+                postgresql_using="gin",
+                postgresql_ops={column: "gin_trgm_ops"},
+            )
+    elif dialect == "sqlite":
+        for statement in SQLITE_SEARCH:
+            op.execute(statement)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    dialect = op.get_bind().dialect.name
+    if dialect == "postgresql":
+        op.drop_index("ix_parkings_address_trgm", table_name="parkings")
+        op.drop_index("ix_parkings_name_trgm", table_name="parkings")
+    elif dialect == "sqlite":
+        for trigger in ("insert", "delete", "update"):
+            op.execute(f"DROP TRIGGER IF EXISTS parkings_search_{trigger}")
+        op.execute("DROP TABLE IF EXISTS parkings_search")
+    op.drop_index("ix_parkings_location", table_name="parkings")
+    op.drop_index("ix_parkings_opened_available", table_name="parkings")
+    # ALTER TABLE ... DROP COLUMN needs SQLite 3.35
+    op.drop_column("parkings", "longitude")
+    op.drop_column("parkings", "latitude")
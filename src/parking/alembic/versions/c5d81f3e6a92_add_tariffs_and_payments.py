@@ -0,0 +1,57 @@
+"""add tariffs and payments
+
+Revision ID: c5d81f3e6a92
+Revises: b47e2c9a5d10
+Create Date: 2026-10-18 15:20:31.402716
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "c5d81f3e6a92"
+down_revision: Union[str, None] = "b47e2c9a5d10"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "tariffs",
+        sa.Column("parking_id", sa.Integer(), nullable=False),
+        sa.Column("minute_rate", sa.Integer(), nullable=False),
+        sa.Column("hourly_cap", sa.Integer(), nullable=True),
+        sa.Column("daily_cap", sa.Integer(), nullable=True),
+        sa.Column("free_minutes", sa.Integer(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["parking_id"],
+            ["parkings.id"],
+        ),
+        sa.PrimaryKeyConstraint("parking_id"),
+    )
+    op.create_table(
+        "payments",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("key", sa.String(length=64), nullable=False),
+        sa.Column("visit_id", sa.Integer(), nullable=False),
+        sa.Column("client_id", sa.Integer(), nullable=False),
+        sa.Column("parking_id", sa.Integer(), nullable=False),
+        sa.Column("minutes", sa.Integer(), nullable=False),
+        sa.Column("amount", sa.Integer(), nullable=False),
+        sa.Column("billed_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("key"),
+    )
+    op.create_index("ix_payments_parking_id", "payments", ["parking_id"])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_payments_parking_id", table_name="payments")
+    op.drop_table("payments")
+    op.drop_table("tariffs")
@@ -0,0 +1,53 @@
+"""add client plate
+
+Revision ID: f6c3d2e8a417
+Revises: e3f1a7b4c9d2
+Create Date: 2026-10-18 16:48:09.273114
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "f6c3d2e8a417"
+down_revision: Union[str, None] = "e3f1a7b4c9d2"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# the normalization of `models.normalize_plate` at this revision
+LOOKALIKES = str.maketrans("АВЕКМНОРСТУХ", "ABEKMHOPCTYX")
+
+
+def normalize_plate(value: str) -> str:
+    return "".join(
+        char for char in value.upper().translate(LOOKALIKES) if char.isalnum()
+    )
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column("clients", sa.Column("plate", sa.String(length=10), nullable=True))
+    clients = sa.table(
+        "clients", sa.column("id", sa.Integer), sa.column("car_number", sa.String)
+    )
+    connection = op.get_bind()
+    rows = [
+        {"client_id": client_id, "plate": normalize_plate(car_number or "")}
+        for client_id, car_number in connection.execute(
+            sa.select(clients.c.id, clients.c.car_number)
+        )
+    ]
+    if rows:
+        connection.execute(
+            sa.text("UPDATE clients SET plate = :plate WHERE id = :client_id"), rows
+        )
+    op.create_index("ix_clients_plate", "clients", ["plate"])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_clients_plate", table_name="clients")
+    op.drop_column("clients", "plate")
@@ -0,0 +1,189 @@
+import datetime
+import math
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy.orm import Session
+
+from .archive import ONE_DAY, history, midnight
+from .cache import LRUCache
+from .models import get_session
+
+HOUR = 3600
+HOURS = 24
+CHUNK_SIZE = 10000
+
+
+def compute_days(
+    parking_id: int,
+    start: datetime.date,
+    end: datetime.date,
+    hourly_rate: float = 0.0,
+    now: Optional[datetime.datetime] = None,
+    session: Optional[Session] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Итоги парковки по дням [start, end) за один проход по визитам.
+
+    The visits (current and archived) are streamed by chunks of plain columns
+    and folded into per-hour accumulators: the partial hours of a visit are
+    added to their buckets, its full hours to a difference array, the cost is
+    linear in visits + hours. `hourly_occupancy` is the average number of
+    occupied places in the hour. A visit (its dwell time and revenue, every
+    started hour at `hourly_rate`) is counted on the day it ended, an active
+    visit occupies its place until `now`.
+    """
+
+    session = get_session(session)
+    now = now or datetime.datetime.now()
+    origin, closing = midnight(start), midnight(end)
+    days = (end - start).days
+    size = days * HOURS
+    limit = size * HOUR
+    seconds = [0.0] * size
+    full = [0] * (size + 1)
+    visits = [0] * days
+    dwell = [0.0] * days
+    revenue = [0.0] * days
+
+    rows = session.execute(
+        history(start, end, parking_id).execution_options(yield_per=CHUNK_SIZE)
+    )
+    for chunk in rows.partitions():
+        for _parking_id, time_in, time_out in chunk:
+            leave = time_out or now
+            begin = max((time_in - origin).total_seconds(), 0.0)
+            finish = min((leave - origin).total_seconds(), limit)
+            if finish > begin:
+                first, last = int(begin // HOUR), int(finish // HOUR)
+                if first == last:
+                    seconds[first] += finish - begin
+                else:
+                    seconds[first] += (first + 1) * HOUR - begin
+                    if last < size:
+                        seconds[last] += finish - last * HOUR
+                    full[first + 1] += 1
+                    full[last] -= 1
+            if time_out is not None and origin <= time_out < closing:
+                day = (time_out.date() - start).days
+                stay = (time_out - time_in).total_seconds()
+                visits[day] += 1
+                dwell[day] += stay
+                revenue[day] += math.ceil(stay / HOUR) * hourly_rate
+
+    running = 0
+    for hour in range(size):
+        running += full[hour]
+        seconds[hour] += running * HOUR
+
+    result = []
+    for index in range(days):
+        low = index * HOURS
+        high = low + HOURS
+        hours = seconds[low:high]
+        result.append(
+            {
+                "day": (start + index * ONE_DAY).isoformat(),
+                "hourly_occupancy": [round(value / HOUR, 2) for value in hours],
+                "visits": visits[index],
+                "dwell_seconds": int(dwell[index]),
+                "revenue": round(revenue[index], 2),
+            }
+        )
+    return result
+
+
+class ParkingAnalytics:
+    """
+    Аналитика занятости парковок с кэшем итогов по (парковка, день).
+
+    A day is immutable once it is older than `mutable_days` days (the late
+    events of the gate controllers are replayed within it), its result is
+    cached for the life of the process. The missing days of a request are
+    computed together in one pass.
+    """
+
+    def __init__(
+        self, hourly_rate: float = 0.0, cache_size: int = 20000, mutable_days: int = 2
+    ) -> None:
+        self.hourly_rate = hourly_rate
+        self.mutable_days = mutable_days
+        self.cache = LRUCache(cache_size)
+
+    def days(
+        self,
+        parking_id: int,
+        start: datetime.date,
+        end: datetime.date,
+        now: Optional[datetime.datetime] = None,
+    ) -> List[Dict[str, Any]]:
+        """Итоги по дням [start, end)"""
+
+        now = now or datetime.datetime.now()
+        immutable = now.date() - self.mutable_days * ONE_DAY
+        found: Dict[datetime.date, Dict[str, Any]] = {}
+        missing: List[datetime.date] = []
+        day = start
+        while day < end:
+            cached = self.cache.get((parking_id, day))
+            if cached is None:
+                missing.append(day)
+            else:
+                found[day] = cached
+            day += ONE_DAY
+
+        if missing:
+            computed = compute_days(
+                parking_id, missing[0], missing[-1] + ONE_DAY, self.hourly_rate, now
+            )
+            for result in computed:
+                day = datetime.date.fromisoformat(result["day"])
+                found.setdefault(day, result)
+                if day < immutable:
+                    self.cache.set((parking_id, day), result)
+        return [found[day] for day in sorted(found)]
+
+    def report(
+        self,
+        parking: Dict[str, Any],
+        start: datetime.date,
+        end: datetime.date,
+        now: Optional[datetime.datetime] = None,
+    ) -> Dict[str, Any]:
+        """
+        Отчёт по парковке за дни [start, end): итоги по дням и за период
+        (средняя кривая занятости, среднее время стоянки, оборот мест
+        в день, выручка)
+        """
+
+        days = self.days(parking["id"], start, end, now)
+        places = parking["count_places"] or 0
+        visits = sum(day["visits"] for day in days)
+        dwell = sum(day["dwell_seconds"] for day in days)
+        days = [
+            dict(
+                day,
+                avg_dwell_seconds=(
+                    day["dwell_seconds"] / day["visits"] if day["visits"] else None
+                ),
+                turnover=round(day["visits"] / places, 3) if places else None,
+            )
+            for day in days
+        ]
+        count = len(days) or 1
+        curve = [
+            round(sum(day["hourly_occupancy"][hour] for day in days) / count, 2)
+            for hour in range(HOURS)
+        ]
+        return {
+            "parking_id": parking["id"],
+            "from": start.isoformat(),
+            "to": (end - ONE_DAY).isoformat(),
+            "summary": {
+                "hourly_occupancy": curve,
+                "visits": visits,
+                "avg_dwell_seconds": dwell / visits if visits else None,
+                "turnover": round(visits / places / count, 3) if places else None,
+                "revenue": round(sum(day["revenue"] for day in days), 2),
+            },
+            "days": days,
+        }
@@ -1,10 +1,85 @@
-import datetime
+import functools
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Optional
 
-from flask import Flask, jsonify, render_template, request
-from sqlalchemy import inspect, select, update
-from sqlalchemy.exc import NoResultFound
+import click
+from flask import (
+    Flask,
+    Response,
+    g,
+    jsonify,
+    make_response,
+    render_template,
+    request,
+    stream_with_context,
+)
+from sqlalchemy import select
 
-from .config import SECRET_KEY, database
+from .config import (
+    ANALYTICS_CACHE_SIZE,
+    ANALYTICS_HOURLY_RATE,
+    ANALYTICS_MAX_DAYS,
+    ARCHIVE_AGE_DAYS,
+    ARCHIVE_BATCH_SIZE,
+    BILLING_BATCH_SIZE,
+    DB_PGBOUNCER,
+    DB_STATEMENT_TIMEOUT,
+    FAST_JSON,
+    HTTP_CACHE_MAX_AGE,
+    IDEMPOTENCY_CACHE_SIZE,
+    IDEMPOTENCY_LOCK_TIMEOUT,
+    IDEMPOTENCY_TTL,
+    LIMITS_BACKEND,
+    LIMITS_SHM_NAME,
+    LIVE_BACKEND,
+    LIVE_HEARTBEAT,
+    LIVE_LISTEN_URL,
+    LIVE_MAX_CLIENT_STREAMS,
+    LIVE_MAX_STREAMS,
+    LIVE_POLL_TIMEOUT,
+    LIVE_STREAM_TIMEOUT,
+    METRICS_BACKEND,
+    METRICS_SHM_NAME,
+    METRICS_SLOW_QUERY_MS,
+    OCCUPANCY_BACKEND,
+    OCCUPANCY_FLUSH_INTERVAL,
+    OCCUPANCY_SHM_NAME,
+    PAGE_MAX_LIMIT,
+    PARKINGS_CACHE_TTL,
+    PAYMENT_BATCH_SIZE,
+    PAYMENT_CAPTURE_TIMEOUT,
+    PAYMENT_INTERVAL,
+    PAYMENT_LEASE,
+    PAYMENT_MAX_ATTEMPTS,
+    PAYMENT_PROCESSOR,
+    PAYMENT_RETRY_BACKOFF,
+    PAYMENT_RETRY_MAX_BACKOFF,
+    PAYMENT_THREADS,
+    PLATE_CACHE_SIZE,
+    PLATE_LOOKUP_MAX,
+    PROXY_FIX_HOPS,
+    RATE_LIMIT_READ_BURST,
+    RATE_LIMIT_READ_RATE,
+    RATE_LIMIT_WRITE_BURST,
+    RATE_LIMIT_WRITE_RATE,
+    REPLICA_CHECK_INTERVAL,
+    REPLICA_DATABASE_URL,
+    REPLICA_MAX_LAG,
+    REVISIONS_BACKEND,
+    REVISIONS_SHM_NAME,
+    SECRET_KEY,
+    SHED_POOL_WAIT_MS,
+    SHED_READ_INFLIGHT,
+    SHED_RETRY_AFTER,
+    SHED_WRITE_INFLIGHT,
+    SHM_PREFIX,
+    WEB_CONCURRENCY,
+    database,
+    engine_options,
+    prepare_database,
+)
+from .serializers import FastJSONProvider
 
 
 def create_app(test_config=None):
@@ -18,32 +93,255 @@ def create_app(test_config=None):
         _db = "sqlite://"
 
     app = Flask(__name__, instance_relative_config=True)
+    if FAST_JSON:
+        app.json = FastJSONProvider(app)
     app.secret_key = SECRET_KEY
     app.config["SQLALCHEMY_DATABASE_URI"] = _db
-    from .models import Client, ClientParking, Parking, db
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(_db)
+    app.config.setdefault("PARKINGS_CACHE_TTL", PARKINGS_CACHE_TTL)
+    app.config.setdefault("PAGE_MAX_LIMIT", PAGE_MAX_LIMIT)
+    app.config.setdefault("PLATE_CACHE_SIZE", PLATE_CACHE_SIZE)
+    app.config.setdefault("IDEMPOTENCY_TTL", IDEMPOTENCY_TTL)
+    app.config.setdefault("IDEMPOTENCY_CACHE_SIZE", IDEMPOTENCY_CACHE_SIZE)
+    app.config.setdefault("IDEMPOTENCY_LOCK_TIMEOUT", IDEMPOTENCY_LOCK_TIMEOUT)
+    app.config.setdefault("PLATE_LOOKUP_MAX", PLATE_LOOKUP_MAX)
+    app.config.setdefault("SHM_PREFIX", SHM_PREFIX)
+    # the processes of the memory backends, see `create_occupancy`, `create_revisions`
+    app.config.setdefault("WEB_CONCURRENCY", WEB_CONCURRENCY)
+    app.config.setdefault("OCCUPANCY_BACKEND", OCCUPANCY_BACKEND)
+    app.config.setdefault("OCCUPANCY_FLUSH_INTERVAL", OCCUPANCY_FLUSH_INTERVAL)
+    app.config.setdefault("OCCUPANCY_SHM_NAME", OCCUPANCY_SHM_NAME)
+    app.config.setdefault("REVISIONS_BACKEND", REVISIONS_BACKEND)
+    app.config.setdefault("REVISIONS_SHM_NAME", REVISIONS_SHM_NAME)
+    app.config.setdefault("HTTP_CACHE_MAX_AGE", HTTP_CACHE_MAX_AGE)
+    app.config.setdefault("LIVE_BACKEND", LIVE_BACKEND)
+    app.config.setdefault("LIVE_LISTEN_URL", LIVE_LISTEN_URL)
+    app.config.setdefault("LIVE_STREAM_TIMEOUT", LIVE_STREAM_TIMEOUT)
+    app.config.setdefault("LIVE_HEARTBEAT", LIVE_HEARTBEAT)
+    app.config.setdefault("LIVE_POLL_TIMEOUT", LIVE_POLL_TIMEOUT)
+    app.config.setdefault("LIVE_MAX_STREAMS", LIVE_MAX_STREAMS)
+    app.config.setdefault("LIVE_MAX_CLIENT_STREAMS", LIVE_MAX_CLIENT_STREAMS)
+    app.config.setdefault("METRICS_BACKEND", METRICS_BACKEND)
+    app.config.setdefault("METRICS_SHM_NAME", METRICS_SHM_NAME)
+    app.config.setdefault("METRICS_SLOW_QUERY_MS", METRICS_SLOW_QUERY_MS)
+    app.config.setdefault("LIMITS_BACKEND", LIMITS_BACKEND)
+    app.config.setdefault("LIMITS_SHM_NAME", LIMITS_SHM_NAME)
+    app.config.setdefault("RATE_LIMIT_READ_RATE", RATE_LIMIT_READ_RATE)
+    app.config.setdefault("RATE_LIMIT_READ_BURST", RATE_LIMIT_READ_BURST)
+    app.config.setdefault("RATE_LIMIT_WRITE_RATE", RATE_LIMIT_WRITE_RATE)
+    app.config.setdefault("RATE_LIMIT_WRITE_BURST", RATE_LIMIT_WRITE_BURST)
+    app.config.setdefault("SHED_READ_INFLIGHT", SHED_READ_INFLIGHT)
+    app.config.setdefault("SHED_WRITE_INFLIGHT", SHED_WRITE_INFLIGHT)
+    app.config.setdefault("SHED_POOL_WAIT_MS", SHED_POOL_WAIT_MS)
+    app.config.setdefault("SHED_RETRY_AFTER", SHED_RETRY_AFTER)
+    app.config.setdefault("PROXY_FIX_HOPS", PROXY_FIX_HOPS)
+    app.config.setdefault("ARCHIVE_AGE_DAYS", ARCHIVE_AGE_DAYS)
+    app.config.setdefault("ARCHIVE_BATCH_SIZE", ARCHIVE_BATCH_SIZE)
+    app.config.setdefault("ANALYTICS_HOURLY_RATE", ANALYTICS_HOURLY_RATE)
+    app.config.setdefault("ANALYTICS_CACHE_SIZE", ANALYTICS_CACHE_SIZE)
+    app.config.setdefault("ANALYTICS_MAX_DAYS", ANALYTICS_MAX_DAYS)
+    app.config.setdefault("BILLING_BATCH_SIZE", BILLING_BATCH_SIZE)
+    app.config.setdefault("PAYMENT_PROCESSOR", PAYMENT_PROCESSOR)
+    app.config.setdefault("PAYMENT_THREADS", PAYMENT_THREADS)
+    app.config.setdefault("PAYMENT_BATCH_SIZE", PAYMENT_BATCH_SIZE)
+    app.config.setdefault("PAYMENT_INTERVAL", PAYMENT_INTERVAL)
+    app.config.setdefault("PAYMENT_MAX_ATTEMPTS", PAYMENT_MAX_ATTEMPTS)
+    app.config.setdefault("PAYMENT_RETRY_BACKOFF", PAYMENT_RETRY_BACKOFF)
+    app.config.setdefault("PAYMENT_RETRY_MAX_BACKOFF", PAYMENT_RETRY_MAX_BACKOFF)
+    app.config.setdefault("PAYMENT_LEASE", PAYMENT_LEASE)
+    app.config.setdefault("PAYMENT_CAPTURE_TIMEOUT", PAYMENT_CAPTURE_TIMEOUT)
+    app.config.setdefault(
+        "REPLICA_DATABASE_URL", REPLICA_DATABASE_URL if test_config is None else ""
+    )
+    app.config.setdefault("REPLICA_MAX_LAG", REPLICA_MAX_LAG)
+    app.config.setdefault("REPLICA_CHECK_INTERVAL", REPLICA_CHECK_INTERVAL)
+    if isinstance(test_config, dict):
+        app.config.update(test_config)
+    from .analytics import ParkingAnalytics
+    from .archive import run_archive
+    from .billing import FREE, rebill
+    from .bootstrap import SchemaBootstrap
+    from .bulk import CLIENTS, PARKINGS, bulk_import, read_rows
+    from .cache import LazyList, TTLCache
+    from .engine import configure_engine, dispose_after_fork, timed_pool
+    from .gates import GateError, apply_events, check_in, check_out
+    from .idempotency import (
+        BUSY,
+        LOST,
+        MISMATCH,
+        REPLAY,
+        StoredResponse,
+        create_idempotency,
+        fingerprint,
+        idempotency_key,
+    )
+    from .limits import GATE, READ, STREAM, WRITE, create_limiter
+    from .listing import keyset_page, keyset_stream, stream_json
+    from .live import availability, create_feed
+    from .metrics import create_metrics, instrument
+    from .models import Client, Parking, Tariff, db, get_session, normalize_plate
+    from .occupancy import create_occupancy
+    from .payments import create_payments
+    from .plates import PlateIndex
+    from .replica import create_replica
+    from .revisions import create_revisions, etag, revision_key
+    from .search import nearest_parkings, parking_filters
 
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = timed_pool(
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"]
+    )
+    prepare_database(app.config["SQLALCHEMY_DATABASE_URI"])
     db.init_app(app)
+    with app.app_context():
+        configure_engine(db.engine, DB_PGBOUNCER, DB_STATEMENT_TIMEOUT)
+        dispose_after_fork(db.engine)
+        live = create_feed(app.config, db.engine.dialect.name, DB_PGBOUNCER)
+    app.extensions["live"] = live
+    analytics = ParkingAnalytics(
+        hourly_rate=app.config["ANALYTICS_HOURLY_RATE"],
+        cache_size=app.config["ANALYTICS_CACHE_SIZE"],
+    )
+    app.extensions["analytics"] = analytics
+    bootstrap_schema = SchemaBootstrap()
+    app.extensions["schema_bootstrap"] = bootstrap_schema
+    idempotency = create_idempotency(app.config)
+    app.extensions["idempotency"] = idempotency
+    plate_index = PlateIndex(cache_size=app.config["PLATE_CACHE_SIZE"])
+    app.extensions["plate_index"] = plate_index
+    parkings_cache = TTLCache(ttl=app.config["PARKINGS_CACHE_TTL"])
+    app.extensions["parkings_cache"] = parkings_cache
+    occupancy = create_occupancy(app.config)
+    app.extensions["occupancy"] = occupancy
+    revisions = create_revisions(app.config)
+    app.extensions["revisions"] = revisions
+    payments = create_payments(app.config)
+    app.extensions["payments"] = payments
+    replica = create_replica(app.config)
+    app.extensions["replica"] = replica
+    limiter = create_limiter(app.config)
+    app.extensions["limiter"] = limiter
+    hops = app.config["PROXY_FIX_HOPS"]
+    if hops:
+        # the addresses of the clients (limiter) set by the trusted proxies
+        from werkzeug.middleware.proxy_fix import ProxyFix
+
+        app.wsgi_app = ProxyFix(  # type: ignore[method-assign]
+            app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops
+        )
+    if replica is not None:
+        configure_engine(replica.engine, DB_PGBOUNCER, DB_STATEMENT_TIMEOUT)
+        dispose_after_fork(replica.engine)
+
+    def changed(table: str, *row_ids) -> None:
+        """
+        Bumping the revisions of a table and of its changed rows,
+        called by the write paths after the commit.
+        """
+
+        if revisions is not None:
+            revisions.bump(table, *(revision_key(table, row_id) for row_id in row_ids))
+
+    if occupancy is not None:
+        occupancy.on_flush = lambda parking_ids: changed("parkings", *parking_ids)
+
+    def announce(deltas) -> None:
+        """
+        Sending the deltas of availability (None: a reset) to the live feed
+        in their own transaction, see `live.py`.
+        """
+
+        live.notify(get_session(), deltas)
+        db.session.commit()
+        live.committed(deltas)
+
+    def availability_snapshot():
+        """
+        Availability of all the parking lots for the live feed, the connection
+        is released at once: a stream must not hold it.
+        """
+
+        rows = db.session.execute(
+            select(Parking.id, Parking.count_available_places, Parking.opened)
+        )
+        parkings = [availability(row._mapping) for row in rows]
+        db.session.close()
+        if occupancy is not None:
+            for parking in parkings:
+                state = occupancy.get(parking["id"])
+                if state is not None:
+                    parking["count_available_places"], parking["opened"] = state
+        return parkings
+
+    # the gates (barriers and their cameras) are served first under load
+    gate_endpoints = {"get_client_parkings", "client_parkings_batch", "clients_lookup"}
+    unlimited_endpoints = {"static", "metrics_view"}
+    # they wait for the changes on their thread for minutes
+    streaming_endpoints = {"parkings_events", "parkings_changes"}
+
+    @app.before_request
+    def admit_request():
+        """
+        Ограничение частоты запросов клиента (429) и сброс нагрузки (503),
+        see `limits.py`. Registered first: a refused request costs nothing.
+        """
+
+        if limiter is None or request.endpoint in unlimited_endpoints:
+            return None
+        if request.endpoint in gate_endpoints:
+            priority = GATE
+        elif request.endpoint in streaming_endpoints:
+            priority = STREAM
+        elif request.method in ("GET", "HEAD", "OPTIONS"):
+            priority = READ
+        else:
+            priority = WRITE
+        refusal = limiter.admit(request.remote_addr or "", priority)
+        if refusal is not None:
+            error = "Too many requests" if refusal.status == 429 else "Unavailable"
+            headers = {"Retry-After": str(refusal.retry_after)}
+            return {error: refusal.status}, refusal.status, headers
+        g.parking_admitted = priority != STREAM
+        return None
+
+    @app.teardown_request
+    def release_request(exc):
+        if g.pop("parking_admitted", False) and limiter is not None:
+            limiter.done()
 
     @app.before_request
     def before_request():
         """
-        Проверка существуют ли таблицы в базе данных и создаются таблицы,
-        если они отсутствуют.
+        Однократная (на процесс) проверка схемы базы данных: таблицы создаются,
+        если они отсутствуют, ревизия alembic проверяется при первом запросе.
         """
 
-        tables = inspect(db.engine).get_table_names()
-        if not tables:
-            db.create_all()
+        g.pop("parking_read_engine", None)
+        if request.endpoint == "static":
+            return
+        bootstrap_schema(db.engine)
+        if occupancy is not None:
+            occupancy.start(app)
+        if payments is not None:
+            payments.start(app)
+        live.start(db.engine)
 
     @app.context_processor
     def get_parking():
         """
-        Добавлен контекст процессор для отображения всех парковок
+        Добавлен контекст процессор для отображения всех парковок.
+        Список загружается только если шаблон к нему обращается и кэшируется
+        на PARKINGS_CACHE_TTL секунд.
         """
 
-        parking_all = db.session.execute(select(Parking)).scalars().all()
-        _parkings = [parking.to_json() for parking in parking_all]
-        return dict(parkings=_parkings)
+        return dict(
+            parkings=LazyList(lambda: parkings_cache.get("parkings", load_parkings))
+        )
+
+    def load_parkings():
+        if replica is None:
+            return Parking.all()
+        with replica.reading():
+            return Parking.all()
 
     @app.route("/")
     def index():
@@ -55,10 +353,171 @@ def create_app(test_config=None):
     # =                     Routes for API                                  =
     # =======================================================================
 
+    def read_only(view):
+        """
+        The reads of a GET route go to the replica (see `replica.py`),
+        the other methods of the route and the writes stay on the primary.
+        """
+
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            if replica is not None and request.method == "GET":
+                replica.use_replica()
+            return view(**kwargs)
+
+        return wrapper
+
+    def conditional(table: str, private: bool = False):
+        """
+        HTTP cache of a GET route: strong ETag from the revision of the table
+        (or of the row for a route with an id), `If-None-Match` is answered
+        with 304 before the view reads the database.
+        """
+
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(**kwargs):
+                if revisions is None or request.method != "GET":
+                    return view(**kwargs)
+
+                key = revision_key(table, *kwargs.values())
+                tag, modified = etag(revisions, key, request.query_string.decode())
+                if replica is not None and (
+                    int(time.time()) - modified <= app.config["REPLICA_MAX_LAG"]
+                ):
+                    # a recent change may not be on the replica yet: the new ETag
+                    # must not be given to stale data
+                    replica.use_primary()
+                if request.if_none_match.contains_weak(tag):
+                    response = Response(status=304)
+                else:
+                    response = make_response(view(**kwargs))
+                    if response.status_code != 200:
+                        return response
+                response.set_etag(tag)
+                response.last_modified = datetime.fromtimestamp(modified, timezone.utc)
+                if private:
+                    response.cache_control.private = True
+                else:
+                    response.cache_control.public = True
+                max_age = app.config["HTTP_CACHE_MAX_AGE"]
+                if max_age:
+                    response.cache_control.max_age = max_age
+                else:
+                    response.cache_control.no_cache = True
+                return response
+
+            return wrapper
+
+        return decorator
+
+    def idempotent(view):
+        """
+        `Idempotency-Key` of a write route: the response of the first request
+        with the key is stored (see `idempotency.py`), a retry with the same
+        key and body gets it back without running the view again, a retry
+        while the first request runs gets 409 with `Retry-After`.
+        A failed request (an error, 5xx) does not keep its key unless its
+        write committed; a retry of a committed write whose response was lost
+        (a crash of the worker) gets 409 without `Retry-After`.
+        """
+
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            key = request.headers.get("Idempotency-Key")
+            if idempotency is None or key is None or request.method == "GET":
+                return view(**kwargs)
+            if not 0 < len(key) <= 255:
+                return {"Bad request": 400}, 400
+
+            scoped = idempotency_key(request.method, request.path, key)
+            digest = fingerprint(request.get_data())
+            state, stored = idempotency.reserve(scoped, digest)
+            if state == REPLAY and stored is not None:
+                response = Response(
+                    stored.body, status=stored.status, mimetype=stored.mimetype
+                )
+                response.headers["Idempotent-Replayed"] = "true"
+                return response
+            if state == BUSY:
+                return {"Conflict": 409}, 409, {"Retry-After": "1"}
+            if state == MISMATCH:
+                return {"Unprocessable Entity": 422}, 422
+            if state == LOST:
+                # the write is done, it must not run again
+                return {"Conflict": 409}, 409
+
+            try:
+                with idempotency.writing(scoped):
+                    response = make_response(view(**kwargs))
+            except Exception:
+                idempotency.release(scoped)
+                raise
+            if response.status_code >= 500 or response.is_streamed:
+                idempotency.release(scoped)
+            else:
+                idempotency.complete(
+                    scoped,
+                    StoredResponse(
+                        digest,
+                        response.status_code,
+                        response.get_data(),
+                        response.mimetype,
+                    ),
+                )
+            return response
+
+        return wrapper
+
+    def list_response(model, key: str, where=(), overlay=None):
+        """
+        Listing of a table for the GET routes.
+        Without parameters the entire list is returned,
+        `limit` and `after` return one page of the keyset pagination on `id`
+        with the `next` cursor, `stream=1` streams the list in chunks.
+        `where` are the conditions of the filters of the route, `overlay`
+        a generator of the rows to send from the rows read (a page may have
+        fewer than `limit` rows then, `next` follows the rows read).
+        """
+
+        limit = request.args.get("limit", type=int)
+        after = request.args.get("after", 0, type=int)
+        max_limit = app.config["PAGE_MAX_LIMIT"]
+        if limit is not None:
+            limit = max(1, min(limit, max_limit))
+
+        if request.args.get("stream", 0, type=int):
+            stream = keyset_stream(model, after=after, limit=limit, where=where)
+            if overlay is not None:
+                stream = overlay(stream)
+            return Response(
+                stream_with_context(stream_json(key, stream, app.json.dumps)),
+                mimetype="application/json",
+            )
+        if limit is None and not after:
+            if overlay is not None:
+                rows = keyset_page(model, limit=None, where=where)
+                return jsonify({key: list(overlay(rows))})
+            if where:
+                return jsonify({key: keyset_page(model, limit=None, where=where)})
+            return jsonify({key: model.all()})
+
+        rows = keyset_page(model, after=after, limit=limit or max_limit, where=where)
+        next_after = rows[-1]["id"] if len(rows) == (limit or max_limit) else None
+        if overlay is not None:
+            rows = list(overlay(rows))
+        return jsonify({key: rows, "next": next_after})
+
     @app.route("/clients", methods=["GET", "POST"])
+    @idempotent
+    @read_only
+    @conditional("clients", private=True)
     def clients():
         """
-        Display all clients
+        Method GET:
+        Displaying the list of clients (see `list_response`).
+        Method POST:
+        Creating a new client.
         """
 
         if request.method == "POST":
@@ -72,6 +531,8 @@ def create_app(test_config=None):
 
             db.session.add(client)
             db.session.commit()
+            plate_index.invalidate()
+            changed("clients", client.id)
 
             return (
                 jsonify(
@@ -80,27 +541,105 @@ def create_app(test_config=None):
                 201,
             )
         else:
-            _clients = Client.all()
-            return jsonify(clients=_clients)
+            return list_response(Client, "clients")
+
+    def bulk_response(spec, invalidate):
+        """
+        Bulk creation from a JSON array, NDJSON or CSV body
+        or from an uploaded file in the `file` field.
+        The chunks are committed one by one, so the caches of the route
+        (`invalidate(created)`, None if unknown) are invalidated even when the
+        body breaks midway (400 with the report of the committed rows) or the
+        import fails.
+        """
+
+        upload = request.files.get("file")
+        if upload is not None:
+            stream, mimetype = upload.stream, upload.mimetype
+            filename = upload.filename or ""
+        else:
+            stream, mimetype, filename = request.stream, request.mimetype, ""
+        rows = read_rows(stream, mimetype, key=spec.table.name, filename=filename)
+        try:
+            report = bulk_import(spec, rows)
+        except Exception:
+            db.session.rollback()
+            changed(spec.table.name)
+            invalidate(None)
+            raise
+        changed(spec.table.name)
+        invalidate(report["created"])
+        return jsonify(report), 201 if report["complete"] else 400
+
+    @app.route("/clients/bulk", methods=["POST"])
+    @idempotent
+    def clients_bulk():
+        """
+        Bulk creation of clients, conflicts on `car_number` are reported per row
+        """
+
+        return bulk_response(CLIENTS, lambda created: plate_index.invalidate())
+
+    @app.route("/clients/lookup", methods=["GET", "POST"])
+    @read_only
+    def clients_lookup():
+        """
+        Clients by car plate for the gate cameras: `plate` (repeated) of GET
+        or {"plates": [...]} of POST, PLATE_LOOKUP_MAX plates at most.
+        The plates are compared normalized (case, spaces, Cyrillic look-alike
+        letters), the client of an unknown plate is null, see `plates.py`.
+        """
+
+        if request.method == "POST":
+            data = request.get_json(silent=True)
+            plates = data.get("plates") if isinstance(data, dict) else data
+        else:
+            plates = request.args.getlist("plate")
+        if not isinstance(plates, list) or not plates:
+            return {"Bad request": 400}, 400
+        if len(plates) > app.config["PLATE_LOOKUP_MAX"]:
+            return {"Bad request": 400}, 400
+        if not all(isinstance(plate, str) for plate in plates):
+            return {"Bad request": 400}, 400
+        # an empty read of the camera matches no car
+        if not all(normalize_plate(plate) for plate in plates):
+            return {"Bad request": 400}, 400
+
+        found = plate_index.lookup(plates)
+        return jsonify(
+            clients=[
+                {"plate": plate, "client": found[normalize_plate(plate)]}
+                for plate in plates
+            ]
+        )
 
     @app.route("/clients/<int:client_id>", methods=["GET"])
+    @read_only
+    @conditional("clients", private=True)
     def client_by_id(client_id: int):
         """
         Display client by ID
         """
+        encoder = Client._encoder
         client = db.session.execute(
-            select(Client).where(Client.id == client_id)
-        ).scalar()
+            encoder.select().where(Client.id == client_id)
+        ).one_or_none()
         if not client:
             return {"Not found": 404}, 404
 
-        return jsonify(client=client.to_json())
+        return jsonify(client=encoder.from_row(client))
 
     @app.route("/parkings", methods=["GET", "POST"])
+    @idempotent
+    @read_only
+    @conditional("parkings")
     def parkings():
         """
         Method GET:
-        Displaying the entire parking list.
+        Displaying the parking list (see `list_response`), filtered by
+        `opened` (1/0), `min_free` (available places), `q` (substring of the
+        name or address) and `prefix` (start of the name or address).
+        With the occupancy counters the places and `opened` are theirs.
         Method POST:
         Creating a new parking lot.
         """
@@ -113,9 +652,14 @@ def create_app(test_config=None):
                 opened=data["opened"],  # type: ignore
                 count_places=data["count_places"],  # type: ignore
                 count_available_places=data["count_available_places"],  # type: ignore
+                latitude=data.get("latitude"),  # type: ignore
+                longitude=data.get("longitude"),  # type: ignore
             )
             db.session.add(parking)
             db.session.commit()
+            parkings_cache.invalidate()
+            changed("parkings", parking.id)
+            announce([availability(parking.to_json())])
 
             _parkings = Parking.all()
             return (
@@ -125,28 +669,229 @@ def create_app(test_config=None):
                 201,
             )
         else:
-            _parkings = Parking.all()
-            return jsonify(parkings=_parkings)
+            opened = request.args.get("opened")
+            if opened not in (None, "0", "1", "true", "false"):
+                return {"Bad request": 400}, 400
+            is_opened = None if opened is None else opened in ("1", "true")
+            min_free = request.args.get("min_free", type=int)
+            overlay = None
+            if occupancy is not None:
+                # the counters are ahead of the columns until the flush
+                overlay = functools.partial(current_parkings, is_opened, min_free)
+                is_opened = min_free = None
+            where = parking_filters(
+                opened=is_opened,
+                min_free=min_free,
+                search=request.args.get("q"),
+                prefix=request.args.get("prefix"),
+                dialect=db.session.get_bind().dialect.name,
+            )
+            return list_response(Parking, "parkings", where, overlay)
+
+    def current_parkings(opened, min_free, rows):
+        """
+        The parking lots of a listing with the state of the occupancy
+        counters, filtered by `opened` and `min_free` of it
+        """
+
+        for parking in rows:
+            state = occupancy.get(parking["id"]) if occupancy is not None else None
+            if state is not None:
+                parking["count_available_places"], parking["opened"] = state
+            if opened is not None and parking["opened"] != opened:
+                continue
+            if min_free is not None and parking["count_available_places"] < min_free:
+                continue
+            yield parking
+
+    @app.route("/parkings/bulk", methods=["POST"])
+    @idempotent
+    def parkings_bulk():
+        """
+        Bulk creation of parking lots, conflicts on `address` are reported per row
+        """
+
+        def invalidate(created):
+            parkings_cache.invalidate()
+            if created != 0:
+                announce(None)
+
+        return bulk_response(PARKINGS, invalidate)
 
     @app.route("/parkings/<int:parking_id>", methods=["GET"])
+    @read_only
+    @conditional("parkings")
     def get_parking_by_id(parking_id: int):
+        encoder = Parking._encoder
+        parking = db.session.execute(
+            encoder.select().where(Parking.id == parking_id)
+        ).one_or_none()
+        if not parking:
+            return {"Not found": 404}, 404
+
+        _parking = encoder.from_row(parking)
+        if occupancy is not None:
+            state = occupancy.get(parking_id)
+            if state is not None:
+                _parking["count_available_places"], _parking["opened"] = state
+        return jsonify(parking=_parking), 200
+
+    @app.route("/parkings/nearest", methods=["GET"])
+    @read_only
+    def nearest_parking():
+        """
+        The nearest open parking lot to `lat`, `lon` with at least `min_free`
+        (1 by default) available places, with its distance in metres
+        (see `search.py`)
+        """
+
+        latitude = request.args.get("lat", type=float)
+        longitude = request.args.get("lon", type=float)
+        min_free = max(request.args.get("min_free", 1, type=int), 1)
+        if latitude is None or longitude is None:
+            return {"Bad request": 400}, 400
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            return {"Bad request": 400}, 400
+
+        for parking, metres in nearest_parkings(latitude, longitude, min_free):
+            state = occupancy.get(parking["id"]) if occupancy is not None else None
+            if state is not None:
+                parking["count_available_places"], parking["opened"] = state
+            if parking["opened"] and parking["count_available_places"] >= min_free:
+                return jsonify(parking=dict(parking, distance_m=round(metres)))
+        return {"Not found": 404}, 404
+
+    @app.route("/parkings/<int:parking_id>/analytics", methods=["GET"])
+    @read_only
+    def parking_analytics(parking_id: int):
+        """
+        Occupancy analytics of a parking lot for the days `from`..`to`
+        (YYYY-MM-DD, inclusive, the last 7 days by default): hourly occupancy
+        curve, visits, average dwell time, turnover and estimated revenue
+        per day and for the period, see `analytics.py`.
+        """
+
+        encoder = Parking._encoder
         parking = db.session.execute(
-            select(Parking).where(Parking.id == parking_id)
-        ).scalar()
+            encoder.select().where(Parking.id == parking_id)
+        ).one_or_none()
         if not parking:
             return {"Not found": 404}, 404
 
-        return jsonify(parking=parking.to_json()), 200
+        today = datetime.now().date()
+        try:
+            end = date.fromisoformat(request.args.get("to", today.isoformat()))
+            start = date.fromisoformat(
+                request.args.get("from", (end - timedelta(days=6)).isoformat())
+            )
+        except ValueError:
+            return {"Bad request": 400}, 400
+        end += timedelta(days=1)
+        if not 0 < (end - start).days <= app.config["ANALYTICS_MAX_DAYS"]:
+            return {"Bad request": 400}, 400
+
+        return jsonify(analytics.report(encoder.from_row(parking), start, end))
+
+    @app.route("/parkings/<int:parking_id>/tariff", methods=["GET", "PUT"])
+    @idempotent
+    def parking_tariff(parking_id: int):
+        """
+        Method GET:
+        The tariff of the parking lot (free if it has none).
+        Method PUT:
+        Setting the tariff: `minute_rate`, `hourly_cap`, `daily_cap` (null - no
+        cap) and `free_minutes`, in kopecks and minutes. The payments of the
+        finished visits are recomputed by `flask rebill`.
+        """
+
+        if db.session.get(Parking, parking_id) is None:
+            return {"Not found": 404}, 404
+        tariff = db.session.get(Tariff, parking_id)
+        if request.method == "GET":
+            if tariff is None:
+                return jsonify(tariff=dict(FREE._asdict(), parking_id=parking_id))
+            return jsonify(tariff=tariff.to_json())
+
+        data = request.json
+        values: Dict[str, Optional[int]] = {}
+        for field, default in FREE._asdict().items():
+            value = data.get(field, default) if isinstance(data, dict) else None
+            if value is None and default is None:
+                values[field] = None
+            elif isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+                values[field] = value
+            else:
+                return {"Bad request": 400}, 400
+        if tariff is None:
+            tariff = Tariff(parking_id=parking_id)
+            db.session.add(tariff)
+        for field, value in values.items():
+            setattr(tariff, field, value)
+        tariff.updated_at = datetime.now()
+        db.session.commit()
+        return jsonify(tariff=tariff.to_json()), 200
+
+    @app.route("/parkings/events", methods=["GET"])
+    def parkings_events():
+        """
+        Server-sent events of the availability of the parking lots:
+        a "snapshot" event {"parkings": [{"id", "count_available_places",
+        "opened"}, ...]}, then "delta" events of the changed parking lots.
+        The stream is closed after LIVE_STREAM_TIMEOUT seconds, the client
+        reconnects with `Last-Event-ID` and gets only the missed deltas.
+        A stream holds a thread of the worker: 503 above LIVE_MAX_STREAMS
+        streams of the worker or LIVE_MAX_CLIENT_STREAMS of the client.
+        """
+
+        subscriber = request.remote_addr or ""
+        if not live.join(subscriber):
+            return feed_full()
+        cursor = request.headers.get("Last-Event-ID") or request.args.get("cursor")
+        stream = live.stream(
+            cursor,
+            availability_snapshot,
+            timeout=app.config["LIVE_STREAM_TIMEOUT"],
+            heartbeat=app.config["LIVE_HEARTBEAT"],
+        )
+        response = Response(
+            stream_with_context(stream),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+        response.call_on_close(lambda: live.leave(subscriber))
+        return response
+
+    @app.route("/parkings/changes", methods=["GET"])
+    def parkings_changes():
+        """
+        Long-poll fallback of `/parkings/events`: the changes since `cursor`
+        or a snapshot ("snapshot": true) if the cursor is missing or too old,
+        waits up to `timeout` seconds (LIVE_POLL_TIMEOUT at most) for a change.
+        A poll is a subscriber of the feed as a stream of `/parkings/events`.
+        """
+
+        max_timeout = app.config["LIVE_POLL_TIMEOUT"]
+        timeout = request.args.get("timeout", max_timeout, type=float)
+        subscriber = request.remote_addr or ""
+        if not live.join(subscriber):
+            return feed_full()
+        try:
+            changes, cursor = live.wait(
+                request.args.get("cursor"), max(0.0, min(timeout, max_timeout))
+            )
+            if changes is None:
+                parkings, cursor = live.snapshot(availability_snapshot)
+                return jsonify(cursor=cursor, snapshot=True, parkings=parkings)
+        finally:
+            live.leave(subscriber)
+        return jsonify(cursor=cursor, snapshot=False, parkings=changes)
 
-    def check_count_available_place(parking_id: int) -> int | bool:
-        count_available_place = db.session.execute(
-            select(Parking.count_available_places).where(Parking.id == parking_id)
-        ).scalar()
-        if count_available_place:
-            return count_available_place
-        return False
+    def feed_full():
+        headers = {"Retry-After": str(app.config["SHED_RETRY_AFTER"])}
+        return {"Unavailable": 503}, 503, headers
 
     @app.route("/client_parkings", methods=["POST", "DELETE"])
+    @idempotent
     def get_client_parkings():
         """Business logic for the arrival and departure of the customer to the parking lot.
         Using the "POST" method, the client enters the parking lot
@@ -154,91 +899,172 @@ def create_app(test_config=None):
         if there are no available spaces, then we close the parking lot: opened=False.
         Using the "DELETE" method, the client leaves the parking lot
         (we pass the client_id and parking_id, and increase the free space by 1)
+        Each counter change is a single guarded UPDATE or a change of
+        the occupancy counters, see `gates.py` and `occupancy.py`.
+        The charge of a departure is queued in `payment_outbox` and captured
+        from the card by the workers of `payments.py`, not in the request.
         """
         data = request.json
         client_id: int = data["client_id"]  # type: ignore
         parking_id: int = data["parking_id"]  # type: ignore
-        parking_opened = db.session.execute(
-            select(Parking.opened).where(Parking.id == parking_id)
-        ).scalar_one()
-        client_card = db.session.execute(
-            select(Client.credit_card).where(Client.id == client_id)
-        ).scalar_one()
 
-        if request.method == "POST":
-            if not parking_opened:
-                return {"No place": 404}, 404
-            if not client_card:
-                return {"Link the card to your account": 404}, 404
-            arrival = ClientParking(
-                client_id=client_id,
-                parking_id=parking_id,
-                time_in=datetime.datetime.now(),
-            )
-            db.session.add(arrival)
-
-            db.session.execute(
-                update(Parking)
-                .values(count_available_places=Parking.count_available_places - 1)
-                .where(Parking.id == parking_id)
-            )
-            count_available_place = check_count_available_place(parking_id=parking_id)
-            if count_available_place == 0:
-                db.session.execute(
-                    update(Parking).values(opened=False).where(Parking.id == parking_id)
-                )
+        try:
+            if request.method == "POST":
+                result = check_in(client_id, parking_id, occupancy=occupancy)
+            else:
+                result = check_out(client_id, parking_id, occupancy=occupancy)
+        except GateError as error:
+            db.session.rollback()
+            return error.to_json(), error.status
+        deltas = [availability(result["parking"])]
+        try:
+            live.notify(get_session(), deltas)
             db.session.commit()
-            parking: Parking = db.session.execute(
-                select(Parking).where(Parking.id == parking_id)
-            ).scalar_one()
+        except Exception:
+            db.session.rollback()
+            if "undo" in result:
+                result["undo"]()
+            raise
+        parkings_cache.invalidate()
+        changed("parkings", parking_id)
+        live.committed(deltas)
+
+        if request.method == "POST":
             client_info = {
-                "parking": parking.to_json(),
-                "card": client_card,
+                "parking": result["parking"],
+                "card": result["card"],
             }
             return (
                 jsonify(
-                    arrival=arrival.to_json(), client=client_info if test_config else ""
+                    arrival=result["arrival"],
+                    client=client_info if test_config else "",
                 ),
                 201,
             )
 
-        elif request.method == "DELETE":
+        departure_info = {
+            "departure": result["departure"],
+            "payment": result["payment"],
+            "parking": result["parking"],
+        }
+        return jsonify(departure=departure_info), 201
+
+    @app.route("/client_parkings/batch", methods=["POST"])
+    @idempotent
+    def client_parkings_batch():
+        """
+        Batch of arrivals and departures buffered by the gate controllers:
+        {"events": [{"client_id": 1, "parking_id": 1, "action": "arrival",
+        "time": "2025-05-01T10:00:00"}, ...]}, "action" is "arrival" or "departure",
+        "time" is optional. Returns the result of every event in the same order.
+        """
+
+        data = request.json
+        events = data.get("events") if isinstance(data, dict) else data
+        if not isinstance(events, list):
+            return {"Bad request": 400}, 400
+
+        parking_ids = set()
+        for event in events:
             try:
-                departure: ClientParking = db.session.execute(
-                    select(ClientParking).where(
-                        ClientParking.client_id == client_id,
-                        ClientParking.parking_id == parking_id,
-                    )
-                ).scalar_one()
-                if not departure.time_in:
-                    return {"The client did not enter the parking lot": 404}, 404
-            except NoResultFound:
-                return {"Not available": 404}, 404
-            departure.time_out = datetime.datetime.now()
-
-            db.session.execute(
-                update(Parking)
-                .values(count_available_places=Parking.count_available_places + 1)
-                .where(Parking.id == parking_id)
-            )
-            count_available_place = check_count_available_place(parking_id=parking_id)
+                parking_ids.add(int(event["parking_id"]))
+            except (KeyError, TypeError, ValueError):
+                pass
+        try:
+            result = apply_events(events, occupancy=occupancy)
+        except Exception:
+            # the parkings committed before the error are unknown
+            announce(None)
+            raise
+        finally:
+            # the parkings committed before an error are changed too
+            parkings_cache.invalidate()
+            changed("parkings", *parking_ids)
+        announce([availability(state) for state in result["parkings"]])
+        return jsonify(result), 200
 
-            if count_available_place > 0:
-                db.session.execute(
-                    update(Parking).values(opened=True).where(Parking.id == parking_id)
-                )
-            db.session.commit()
+    @app.route("/metrics", methods=["GET"])
+    def metrics_view():
+        """
+        Metrics of the requests in the Prometheus text format
+        (METRICS_BACKEND), see `metrics.py`.
+        """
 
-            parking = db.session.execute(
-                select(Parking).where(Parking.id == parking_id)
-            ).scalar_one()
-            departure_info = {
-                "departure": departure.to_json(),
-                "payment": True,
-                "parking": parking.to_json(),
-            }
-            return jsonify(departure=departure_info), 201
-        else:
-            return {"Contact the administrator": 404}, 404
+        if metrics is None:
+            return {"Not found": 404}, 404
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    # =======================================================================
+    # =                     CLI                                             =
+    # =======================================================================
+
+    @app.cli.command("archive-visits")
+    @click.option("--age-days", type=int, help="Default: ARCHIVE_AGE_DAYS")
+    @click.option("--batch-size", type=int, help="Default: ARCHIVE_BATCH_SIZE")
+    def archive_visits_command(age_days, batch_size):
+        """
+        Daily rollups of the finished days older than the age, then moving
+        their visits from `client_parking` to `client_parking_archive`.
+        """
+
+        bootstrap_schema(db.engine)
+        report = run_archive(
+            age_days if age_days is not None else app.config["ARCHIVE_AGE_DAYS"],
+            batch_size or app.config["ARCHIVE_BATCH_SIZE"],
+        )
+        click.echo(
+            f"Rollups: {report['rollups']}, archived visits: {report['archived']} "
+            f"(before {report['cutoff']})"
+        )
+
+    @app.cli.command("rebill")
+    @click.option(
+        "--parking-id", "parking_ids", type=int, multiple=True, help="Default: all"
+    )
+    @click.option(
+        "--since",
+        type=click.DateTime(),
+        help="Only the visits finished since the date",
+    )
+    @click.option("--batch-size", type=int, help="Default: BILLING_BATCH_SIZE")
+    def rebill_command(parking_ids, since, batch_size):
+        """
+        Recomputing the payments of the finished visits (current and archived)
+        with the current tariffs, see `billing.py`.
+        """
+
+        bootstrap_schema(db.engine)
+        report = rebill(
+            parking_ids or None,
+            since,
+            batch_size or app.config["BILLING_BATCH_SIZE"],
+        )
+        click.echo(f"Billed visits: {report['billed']}")
+
+    @app.cli.command("capture-payments")
+    def capture_payments_command():
+        """
+        Capturing the due payments of `payment_outbox` until none is left
+        (PAYMENT_PROCESSOR), see `payments.py`.
+        """
+
+        if payments is None:
+            raise click.ClickException("PAYMENT_PROCESSOR is not set")
+        bootstrap_schema(db.engine)
+        captured = 0
+        while True:
+            count = payments.drain()
+            if not count:
+                break
+            captured += count
+        click.echo(f"Processed captures: {captured}")
+
+    # the slots of the metrics are fixed by the routes registered above
+    metrics = create_metrics(app.config, list(app.view_functions))
+    app.extensions["metrics"] = metrics
+    if metrics is not None:
+        with app.app_context():
+            engines = [db.engine] if replica is None else [db.engine, replica.engine]
+            instrument(app, engines, metrics)
 
     return app
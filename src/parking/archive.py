@@ -0,0 +1,205 @@
+import datetime
+import itertools
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, cast
+
+from sqlalchemy import Table, delete, func, insert, or_, select
+from sqlalchemy.orm import Session
+
+from .models import ClientParking, ClientParkingArchive, ParkingDailyStats, get_session
+
+visits = cast(Table, ClientParking.__table__)
+archive = cast(Table, ClientParkingArchive.__table__)
+stats = cast(Table, ParkingDailyStats.__table__)
+
+ARCHIVE_BATCH_SIZE = 5000
+ROLLUP_WINDOW_DAYS = 31
+ONE_DAY = datetime.timedelta(days=1)
+
+# (parking_id, time_in, time_out)
+Visit = Tuple[int, datetime.datetime, Optional[datetime.datetime]]
+
+
+def midnight(day: datetime.date) -> datetime.datetime:
+    return datetime.datetime.combine(day, datetime.time())
+
+
+def history(start: datetime.date, end: datetime.date, parking_id: Optional[int] = None):
+    """
+    Визиты (текущие и архивные), пересекающие дни [start, end),
+    упорядоченные по парковке
+    """
+
+    parts = []
+    for table in (visits, archive):
+        query = select(table.c.parking_id, table.c.time_in, table.c.time_out).where(
+            table.c.time_in.is_not(None),
+            table.c.time_in < midnight(end),
+            or_(table.c.time_out.is_(None), table.c.time_out >= midnight(start)),
+        )
+        if parking_id is not None:
+            query = query.where(table.c.parking_id == parking_id)
+        parts.append(query)
+    union = parts[0].union_all(parts[1]).subquery()
+    return select(union).order_by(union.c.parking_id, union.c.time_in)
+
+
+def parking_days(
+    parking_id: int,
+    sessions: Iterable[Visit],
+    start: datetime.date,
+    end: datetime.date,
+) -> List[Dict[str, Any]]:
+    """
+    Дневные итоги одной парковки за дни [start, end).
+
+    A visit is counted (with its dwell time) on the day it ended.
+    The peak occupancy is swept over the arrivals and departures, the cars
+    parked before the day (or still parked) are carried into it.
+    """
+
+    begin, finish = midnight(start), midnight(end)
+    visits_per_day: Dict[datetime.date, int] = {}
+    dwell: Dict[datetime.date, float] = {}
+    # departures (-1) before arrivals (+1) at the same moment
+    events: List[Tuple[datetime.datetime, int]] = []
+    for _parking_id, time_in, time_out in sessions:
+        events.append((max(time_in, begin), 1))
+        if time_out is not None and time_out < finish:
+            events.append((time_out, -1))
+            day = time_out.date()
+            visits_per_day[day] = visits_per_day.get(day, 0) + 1
+            dwell[day] = dwell.get(day, 0.0) + (time_out - time_in).total_seconds()
+    events.sort()
+
+    peak: Dict[datetime.date, int] = {}
+    current = 0
+    last_day: Optional[datetime.date] = None
+    for moment, delta in events:
+        day = moment.date()
+        if day != last_day:
+            if last_day is not None:
+                for empty in _days(last_day + ONE_DAY, day):
+                    peak[empty] = current
+            peak[day] = max(peak.get(day, 0), current)
+            last_day = day
+        current += delta
+        peak[day] = max(peak[day], current)
+    if last_day is not None and current > 0:
+        for empty in _days(last_day + ONE_DAY, end):
+            peak[empty] = current
+
+    return [
+        {
+            "parking_id": parking_id,
+            "day": day,
+            "visits": visits_per_day.get(day, 0),
+            "dwell_seconds": int(dwell.get(day, 0)),
+            "peak_occupancy": peak.get(day, 0),
+        }
+        for day in sorted(set(peak) | set(visits_per_day))
+        if start <= day < end and (peak.get(day) or visits_per_day.get(day))
+    ]
+
+
+def _days(start: datetime.date, end: datetime.date) -> Iterator[datetime.date]:
+    day = start
+    while day < end:
+        yield day
+        day += ONE_DAY
+
+
+def rollup(
+    start: datetime.date, end: datetime.date, session: Optional[Session] = None
+) -> int:
+    """
+    (Пере)расчёт дневных итогов за дни [start, end) в одной транзакции,
+    returns the number of rows of `parking_daily_stats`.
+    """
+
+    session = get_session(session)
+    rows = session.execute(history(start, end).execution_options(yield_per=10000))
+    days: List[Dict[str, Any]] = []
+    for parking_id, sessions in itertools.groupby(rows, key=lambda row: row[0]):
+        days.extend(parking_days(parking_id, sessions, start, end))
+
+    session.execute(delete(stats).where(stats.c.day >= start, stats.c.day < end))
+    if days:
+        session.execute(insert(stats), days)
+    session.commit()
+    return len(days)
+
+
+def rollup_until(end: datetime.date, session: Optional[Session] = None) -> int:
+    """
+    Итоги всех дней до `end`, которых ещё нет в `parking_daily_stats`,
+    by windows of ROLLUP_WINDOW_DAYS days
+    """
+
+    session = get_session(session)
+    last = session.scalar(select(func.max(stats.c.day)))
+    if last is not None:
+        start = last + ONE_DAY
+    else:
+        firsts = [
+            session.scalar(select(func.min(table.c.time_in)))
+            for table in (visits, archive)
+        ]
+        if not any(firsts):
+            return 0
+        start = min(first for first in firsts if first is not None).date()
+
+    count = 0
+    while start < end:
+        window_end = min(start + ROLLUP_WINDOW_DAYS * ONE_DAY, end)
+        count += rollup(start, window_end, session)
+        start = window_end
+    return count
+
+
+def archive_visits(
+    cutoff: datetime.datetime,
+    batch_size: int = ARCHIVE_BATCH_SIZE,
+    session: Optional[Session] = None,
+) -> int:
+    """
+    Перенос визитов, завершённых до `cutoff`, в `client_parking_archive`
+    порциями по `batch_size`, каждая в своей транзакции
+    """
+
+    session = get_session(session)
+    columns = [column.name for column in visits.columns]
+    moved = 0
+    while True:
+        ids = session.scalars(
+            select(visits.c.id)
+            .where(visits.c.time_out < cutoff)
+            .order_by(visits.c.id)
+            .limit(batch_size)
+        ).all()
+        if not ids:
+            return moved
+        session.execute(
+            insert(archive).from_select(
+                columns, select(*visits.columns).where(visits.c.id.in_(ids))
+            )
+        )
+        session.execute(delete(visits).where(visits.c.id.in_(ids)))
+        session.commit()
+        moved += len(ids)
+
+
+def run_archive(
+    age_days: int,
+    batch_size: int = ARCHIVE_BATCH_SIZE,
+    now: Optional[datetime.datetime] = None,
+) -> Dict[str, Any]:
+    """
+    Итоги завершённых дней старше `age_days`, затем перенос их визитов
+    в архив. Must run in an app context.
+    """
+
+    now = now or datetime.datetime.now()
+    end = (now - datetime.timedelta(days=age_days)).date()
+    rows = rollup_until(end)
+    archived = archive_visits(midnight(end), batch_size)
+    return {"cutoff": midnight(end).isoformat(), "rollups": rows, "archived": archived}
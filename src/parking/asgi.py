@@ -0,0 +1,538 @@
+import json
+import re
+from collections import abc
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+)
+from urllib.parse import parse_qs
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from . import config
+from .bootstrap import check_schema, schema_file_lock
+from .engine import configure_engine, dispose_after_fork
+from .gates import GateError, apply_events, check_in, check_out
+from .idempotency import (
+    BUSY,
+    LOST,
+    MISMATCH,
+    REPLAY,
+    StoredResponse,
+    create_idempotency,
+    fingerprint,
+    idempotency_key,
+)
+from .limits import GATE, READ, WRITE, create_limiter
+from .live import availability, create_feed
+from .models import Client, Parking
+from .revisions import create_revisions, revision_key
+from .search import parking_filters
+from .serializers import RowEncoder, dumps
+
+Body = Any
+Headers = List[Tuple[bytes, bytes]]
+Handler = Callable[["Request", AsyncSession], Awaitable[Tuple[int, Body]]]
+
+
+def settings() -> Dict[str, Any]:
+    """The settings of `config.py`, as `app.config` of the sync application"""
+
+    return {name: getattr(config, name) for name in dir(config) if name.isupper()}
+
+
+def async_url(url: str) -> str:
+    """
+    The URL of the asyncio driver for the URL of the sync application
+    """
+
+    scheme, _, rest = url.partition("://")
+    dialect = scheme.split("+")[0]
+    if dialect == "postgresql":
+        return f"postgresql+asyncpg://{rest}"
+    if dialect == "sqlite":
+        return f"sqlite+aiosqlite://{rest}"
+    return url
+
+
+def async_engine_options(url: str) -> Dict[str, Any]:
+    """
+    `config.engine_options` translated to the asyncio drivers: the statement
+    timeout is a server setting of asyncpg, prepared statements are disabled
+    behind PgBouncer.
+    """
+
+    if url.startswith("sqlite"):
+        if url.endswith("://") or ":memory:" in url:
+            return {"poolclass": StaticPool}
+        return {}
+
+    options = config.engine_options(url)
+    options.pop("connect_args", None)
+    if url.startswith("postgresql+asyncpg"):
+        connect_args: Dict[str, Any] = {}
+        if config.DB_STATEMENT_TIMEOUT and not config.DB_PGBOUNCER:
+            connect_args["server_settings"] = {
+                "statement_timeout": str(config.DB_STATEMENT_TIMEOUT)
+            }
+        if config.DB_PGBOUNCER:
+            connect_args["statement_cache_size"] = 0
+            connect_args["prepared_statement_cache_size"] = 0
+        options["connect_args"] = connect_args
+    return options
+
+
+class Request:
+    """
+    Запрос ASGI: метод, путь, параметры строки запроса и тело JSON
+    """
+
+    def __init__(self, scope: Dict[str, Any], body: bytes) -> None:
+        self.method: str = scope["method"]
+        self.path: str = scope["path"]
+        self.client: str = (scope.get("client") or ("",))[0]
+        self.headers = {
+            name.decode("latin-1").lower(): value.decode("latin-1")
+            for name, value in scope.get("headers", [])
+        }
+        self.args = {
+            key: values[-1]
+            for key, values in parse_qs(scope.get("query_string", b"").decode()).items()
+        }
+        self.body = body
+        self.params: Dict[str, str] = {}
+
+    @property
+    def json(self) -> Any:
+        return json.loads(self.body) if self.body else None
+
+    def int_arg(self, name: str, default: Optional[int] = None) -> Optional[int]:
+        try:
+            return int(self.args[name])
+        except (KeyError, ValueError):
+            return default
+
+
+class ParkingASGI:
+    """
+    Асинхронный режим API парковок (ASGI, например uvicorn).
+
+    The routes of the API of `app.py` served here share the mapping of
+    `models.py` and the sync functions of the gates (`gates.py`), filters
+    (`search.py`), idempotency and rate limiting, run with
+    `AsyncSession.run_sync()`. A write bumps the revisions of the ETags
+    and notifies the live feed like the sync application: next to its
+    workers on one machine REVISIONS_SHM_NAME names the shared segment of
+    both, LIVE_BACKEND "postgres" carries the deltas.
+
+    Served by the sync application only: the templates, the live feed,
+    the lookups, the bulk imports, the tariffs and the analytics. The
+    occupancy counters of the sync workers are not shared:
+    OCCUPANCY_BACKEND is refused, the gates update the rows.
+    """
+
+    def __init__(self, url: str, overrides: Optional[Mapping[str, Any]] = None) -> None:
+        self.settings = settings()
+        self.settings.update(overrides or {})
+        if self.settings.get("OCCUPANCY_BACKEND"):
+            raise ValueError(
+                "OCCUPANCY_BACKEND is not supported by the ASGI application:"
+                " the counters are the ones of the sync workers"
+            )
+        self.url = async_url(url)
+        self.engine = create_async_engine(self.url, **async_engine_options(self.url))
+        configure_engine(
+            self.engine.sync_engine, config.DB_PGBOUNCER, config.DB_STATEMENT_TIMEOUT
+        )
+        dispose_after_fork(self.engine.sync_engine)
+        self.sessions = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.dialect = self.engine.dialect.name
+        self.live = create_feed(self.settings, self.dialect, config.DB_PGBOUNCER)
+        self.revisions = create_revisions(self.settings)
+        self.idempotency = create_idempotency(self.settings)
+        self.limiter = create_limiter(self.settings)
+        self.gates = {self.client_parkings, self.batch}
+        self.routes: List[Tuple[str, "re.Pattern[str]", Handler]] = [
+            ("GET", re.compile(r"/clients"), self.list_clients),
+            ("POST", re.compile(r"/clients"), self.create_client),
+            ("GET", re.compile(r"/clients/(?P<id>\d+)"), self.client_by_id),
+            ("GET", re.compile(r"/parkings"), self.list_parkings),
+            ("POST", re.compile(r"/parkings"), self.create_parking),
+            ("GET", re.compile(r"/parkings/(?P<id>\d+)"), self.parking_by_id),
+            ("POST", re.compile(r"/client_parkings"), self.client_parkings),
+            ("DELETE", re.compile(r"/client_parkings"), self.client_parkings),
+            ("POST", re.compile(r"/client_parkings/batch"), self.batch),
+        ]
+
+    async def startup(self) -> None:
+        with schema_file_lock(self.engine.url):
+            async with self.engine.begin() as connection:
+                await connection.run_sync(check_schema)
+
+    async def shutdown(self) -> None:
+        await self.engine.dispose()
+
+    # =======================================================================
+    # =                     ASGI protocol                                   =
+    # =======================================================================
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        request = Request(scope, body)
+        status, response, headers = await self.dispatch(request)
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type", b"application/json"), *headers],
+            }
+        )
+        if isinstance(response, abc.AsyncIterator):
+            async for chunk in response:
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": chunk.encode(),
+                        "more_body": True,
+                    }
+                )
+            await send({"type": "http.response.body", "body": b""})
+        elif isinstance(response, bytes):
+            await send({"type": "http.response.body", "body": response})
+        else:
+            await send({"type": "http.response.body", "body": dumps(response).encode()})
+
+    async def _lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await self.startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def dispatch(self, request: Request) -> Tuple[int, Body, Headers]:
+        allowed = False
+        for method, pattern, handler in self.routes:
+            match = pattern.fullmatch(request.path)
+            if match is None:
+                continue
+            allowed = True
+            if method != request.method:
+                continue
+            request.params = match.groupdict()
+            return await self._admitted(request, handler)
+        if allowed:
+            return 405, {"Method not allowed": 405}, []
+        return 404, {"Not found": 404}, []
+
+    async def _admitted(
+        self, request: Request, handler: Handler
+    ) -> Tuple[int, Body, Headers]:
+        """Rate limiting and load shedding as `admit_request` of `app.py`"""
+
+        if self.limiter is None:
+            return await self._handle(request, handler)
+        if handler in self.gates:
+            priority = GATE
+        elif request.method == "GET":
+            priority = READ
+        else:
+            priority = WRITE
+        refusal = self.limiter.admit(request.client, priority)
+        if refusal is not None:
+            error = "Too many requests" if refusal.status == 429 else "Unavailable"
+            headers = [(b"retry-after", str(refusal.retry_after).encode())]
+            return refusal.status, {error: refusal.status}, headers
+        try:
+            return await self._handle(request, handler)
+        finally:
+            self.limiter.done()
+
+    async def _handle(
+        self, request: Request, handler: Handler
+    ) -> Tuple[int, Body, Headers]:
+        if request.args.get("stream") == "1" and request.method == "GET":
+            return 200, self._stream(request, handler), []
+        async with self.sessions() as session:
+            try:
+                if request.method == "GET":
+                    status, body = await handler(request, session)
+                    return status, body, []
+                return await self._idempotent(request, handler, session)
+            except IntegrityError:
+                # a duplicate `car_number` or `address`
+                await session.rollback()
+                return 400, {"Bad request": 400}, []
+            except (KeyError, TypeError, ValueError):
+                return 400, {"Bad request": 400}, []
+
+    async def _idempotent(
+        self, request: Request, handler: Handler, session: AsyncSession
+    ) -> Tuple[int, Body, Headers]:
+        """`Idempotency-Key` of a write as `idempotent` of `app.py`"""
+
+        key = request.headers.get("idempotency-key")
+        store = self.idempotency
+        if store is None or key is None:
+            status, body = await handler(request, session)
+            return status, body, []
+        if not 0 < len(key) <= 255:
+            return 400, {"Bad request": 400}, []
+
+        scoped = idempotency_key(request.method, request.path, key)
+        digest = fingerprint(request.body)
+        state, stored = await session.run_sync(
+            lambda sync_session: store.reserve(scoped, digest, sync_session)
+        )
+        if state == REPLAY and stored is not None:
+            return stored.status, stored.body, [(b"idempotent-replayed", b"true")]
+        if state == BUSY:
+            return 409, {"Conflict": 409}, [(b"retry-after", b"1")]
+        if state == MISMATCH:
+            return 422, {"Unprocessable Entity": 422}, []
+        if state == LOST:
+            return 409, {"Conflict": 409}, []
+
+        try:
+            with store.writing(scoped, session.sync_session):
+                status, body = await handler(request, session)
+        except BaseException:
+            await session.run_sync(
+                lambda sync_session: store.release(scoped, sync_session)
+            )
+            raise
+        if status >= 500:
+            await session.run_sync(
+                lambda sync_session: store.release(scoped, sync_session)
+            )
+            return status, body, []
+        response = StoredResponse(
+            digest, status, dumps(body).encode(), "application/json"
+        )
+        await session.run_sync(
+            lambda sync_session: store.complete(scoped, response, sync_session)
+        )
+        return status, response.body, []
+
+    async def _stream(self, request: Request, handler: Handler) -> AsyncIterator[str]:
+        # the session lives as long as the response is being sent
+        async with self.sessions() as session:
+            _status, rows = await handler(request, session)
+            async for chunk in rows:
+                yield chunk
+
+    # =======================================================================
+    # =                     Routes for API                                  =
+    # =======================================================================
+
+    async def _listing(
+        self,
+        request: Request,
+        session: AsyncSession,
+        model: Any,
+        key: str,
+        where: Any = (),
+    ) -> Tuple[int, Body]:
+        limit = request.int_arg("limit")
+        after = request.int_arg("after", 0)
+        max_limit = self.settings["PAGE_MAX_LIMIT"]
+        if limit is not None:
+            limit = max(1, min(limit, max_limit))
+        encoder: RowEncoder = model._encoder
+        query = encoder.select().where(model.id > after, *where).order_by(model.id)
+
+        if request.args.get("stream") == "1":
+            if limit is not None:
+                query = query.limit(limit)
+            return 200, self._stream_rows(session, query, encoder, key)
+        if limit is None and not after:
+            return 200, {key: encoder.from_rows(await session.execute(query))}
+
+        page_size = limit or max_limit
+        page = encoder.from_rows(await session.execute(query.limit(page_size)))
+        next_after = page[-1]["id"] if len(page) == page_size else None
+        return 200, {key: page, "next": next_after}
+
+    async def _stream_rows(
+        self,
+        session: AsyncSession,
+        query,
+        encoder: RowEncoder,
+        key: str,
+        chunk_size: int = 1000,
+    ) -> AsyncIterator[str]:
+        yield '{"%s": [' % key
+        separator = ""
+        result = await session.stream(query.execution_options(yield_per=chunk_size))
+        async for partition in result.partitions(chunk_size):
+            yield separator + ", ".join(
+                dumps(row) for row in encoder.from_rows(partition)
+            )
+            separator = ", "
+        yield "]}"
+
+    async def list_clients(self, request: Request, session: AsyncSession):
+        return await self._listing(request, session, Client, "clients")
+
+    async def list_parkings(self, request: Request, session: AsyncSession):
+        opened = request.args.get("opened")
+        if opened not in (None, "0", "1", "true", "false"):
+            return 400, {"Bad request": 400}
+        where = parking_filters(
+            opened=None if opened is None else opened in ("1", "true"),
+            min_free=request.int_arg("min_free"),
+            search=request.args.get("q"),
+            prefix=request.args.get("prefix"),
+            dialect=self.dialect,
+        )
+        return await self._listing(request, session, Parking, "parkings", where)
+
+    async def client_by_id(self, request: Request, session: AsyncSession):
+        client = await session.get(Client, int(request.params["id"]))
+        if client is None:
+            return 404, {"Not found": 404}
+        return 200, {"client": client.to_json()}
+
+    async def parking_by_id(self, request: Request, session: AsyncSession):
+        parking = await session.get(Parking, int(request.params["id"]))
+        if parking is None:
+            return 404, {"Not found": 404}
+        return 200, {"parking": parking.to_json()}
+
+    async def create_client(self, request: Request, session: AsyncSession):
+        data = request.json
+        client = Client(
+            name=data["name"],
+            surname=data["surname"],
+            credit_card=data["credit_card"],
+            car_number=data["car_number"],
+        )
+        session.add(client)
+        await session.commit()
+        self._changed("clients", client.id)
+        return 201, {"client": client.to_json(), "clients": ""}
+
+    async def create_parking(self, request: Request, session: AsyncSession):
+        data = request.json
+        parking = Parking(
+            name=data["name"],
+            address=data["address"],
+            opened=data["opened"],
+            count_places=data["count_places"],
+            count_available_places=data["count_available_places"],
+            latitude=data.get("latitude"),
+            longitude=data.get("longitude"),
+        )
+        session.add(parking)
+        await session.flush()
+        deltas = [availability(parking.to_json())]
+        await self._commit(session, deltas)
+        self._changed("parkings", parking.id)
+        return 201, {"parking": parking.to_json(), "parkings": ""}
+
+    async def client_parkings(self, request: Request, session: AsyncSession):
+        data = request.json
+        client_id, parking_id = int(data["client_id"]), int(data["parking_id"])
+        gate = check_in if request.method == "POST" else check_out
+        try:
+            result = await session.run_sync(
+                lambda sync_session: gate(client_id, parking_id, session=sync_session)
+            )
+        except GateError as error:
+            await session.rollback()
+            return error.status, error.to_json()
+        await self._commit(session, [availability(result["parking"])])
+        self._changed("parkings", parking_id)
+
+        if request.method == "POST":
+            return 201, {"arrival": result["arrival"], "client": ""}
+        return 201, {
+            "departure": {
+                "departure": result["departure"],
+                "payment": result["payment"],
+                "parking": result["parking"],
+            }
+        }
+
+    async def batch(self, request: Request, session: AsyncSession):
+        data = request.json
+        events = data.get("events") if isinstance(data, dict) else data
+        if not isinstance(events, list):
+            return 400, {"Bad request": 400}
+        parking_ids = set()
+        for event in events:
+            try:
+                parking_ids.add(int(event["parking_id"]))
+            except (KeyError, TypeError, ValueError):
+                pass
+        try:
+            results = await session.run_sync(
+                lambda sync_session: apply_events(events, session=sync_session)
+            )
+        except Exception:
+            # the parkings committed before the error are unknown
+            await session.rollback()
+            await self._commit(session, None)
+            raise
+        finally:
+            self._changed("parkings", *parking_ids)
+        await self._commit(
+            session, [availability(state) for state in results["parkings"]]
+        )
+        return 200, results
+
+    async def _commit(self, session: AsyncSession, deltas) -> None:
+        """
+        The commit of a write with the deltas of the live feed (`NOTIFY` of
+        the "postgres" backend in the transaction, see `live.py`).
+        """
+
+        await session.run_sync(
+            lambda sync_session: self.live.notify(sync_session, deltas)
+        )
+        await session.commit()
+        self.live.committed(deltas)
+
+    def _changed(self, table: str, *row_ids) -> None:
+        """Bumping the revisions of the ETags after a commit, `changed` of `app.py`"""
+
+        if self.revisions is not None:
+            keys = (revision_key(table, row_id) for row_id in row_ids)
+            self.revisions.bump(table, *keys)
+
+
+def create_asgi_app(
+    url: Optional[str] = None, overrides: Optional[Mapping[str, Any]] = None
+) -> ParkingASGI:
+    """
+    Создание асинхронного приложения, по умолчанию с базой данных и настройками
+    из `config.py` (`overrides` - вместо настроек, как `test_config`)
+    """
+
+    url = url or config.ASYNC_DATABASE_URL or config.database
+    config.prepare_database(url)
+    return ParkingASGI(url, overrides)
@@ -0,0 +1,396 @@
+import datetime
+import math
+from typing import (
+    Any,
+    Collection,
+    Dict,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Union,
+    cast,
+)
+
+from sqlalchemy import Table, bindparam, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from .models import (
+    ClientParking,
+    ClientParkingArchive,
+    Payment,
+    PaymentOutbox,
+    Tariff,
+    get_session,
+)
+from .payments import CANCELLED, CAPTURED, FAILED, PENDING
+
+visits = cast(Table, ClientParking.__table__)
+archive = cast(Table, ClientParkingArchive.__table__)
+payments = cast(Table, Payment.__table__)
+tariffs = cast(Table, Tariff.__table__)
+outbox = cast(Table, PaymentOutbox.__table__)
+
+REBILL_BATCH_SIZE = 10000
+MINUTES_PER_HOUR = 60
+MINUTES_PER_DAY = 24 * MINUTES_PER_HOUR
+
+
+class Rates(NamedTuple):
+    """Тариф парковки, суммы в копейках (None - без потолка)"""
+
+    minute_rate: int = 0
+    hourly_cap: Optional[int] = None
+    daily_cap: Optional[int] = None
+    free_minutes: int = 0
+
+
+# a parking lot without a tariff
+FREE = Rates()
+
+
+def _capped(amount: int, cap: Optional[int]) -> int:
+    return amount if cap is None else min(amount, cap)
+
+
+def billed_minutes(time_in: datetime.datetime, time_out: datetime.datetime) -> int:
+    """Started minutes of a stay"""
+
+    return max(0, math.ceil((time_out - time_in).total_seconds() / 60))
+
+
+def _day_charge(rates: Rates, minutes: int) -> int:
+    hours, rest = divmod(minutes, MINUTES_PER_HOUR)
+    hour = _capped(MINUTES_PER_HOUR * rates.minute_rate, rates.hourly_cap)
+    amount = hours * hour + _capped(rest * rates.minute_rate, rates.hourly_cap)
+    return _capped(amount, rates.daily_cap)
+
+
+def charge(rates: Rates, minutes: int) -> int:
+    """
+    Стоимость стоянки длиной `minutes` начатых минут, в копейках.
+
+    The first `free_minutes` are free. Every billed minute costs `minute_rate`,
+    an hour of the billed time (counted from its start) `hourly_cap` at most
+    and a day of it `daily_cap` at most.
+    """
+
+    billable = minutes - rates.free_minutes
+    if billable <= 0:
+        return 0
+    days, rest = divmod(billable, MINUTES_PER_DAY)
+    amount = days * _day_charge(rates, MINUTES_PER_DAY) if days else 0
+    return amount + _day_charge(rates, rest)
+
+
+def payment_key(visit_id: int) -> str:
+    return f"visit:{visit_id}"
+
+
+def load_rates(
+    parking_ids: Optional[Collection[int]] = None, session: Optional[Session] = None
+) -> Dict[int, Rates]:
+    """Тарифы парковок (все или `parking_ids`) by parking id"""
+
+    session = get_session(session)
+    query = select(
+        tariffs.c.parking_id,
+        tariffs.c.minute_rate,
+        tariffs.c.hourly_cap,
+        tariffs.c.daily_cap,
+        tariffs.c.free_minutes,
+    )
+    if parking_ids is not None:
+        query = query.where(tariffs.c.parking_id.in_(parking_ids))
+    return {row[0]: Rates(*row[1:]) for row in session.execute(query)}
+
+
+def _on_conflict_insert(
+    session: Session, table: Table
+) -> Union[postgresql.Insert, sqlite.Insert, None]:
+    """`INSERT ... ON CONFLICT` of the database, None if it has none"""
+
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(table)
+    if dialect == "sqlite":
+        return sqlite.insert(table)
+    return None
+
+
+def _existing(
+    session: Session, table: Table, rows: List[Dict[str, Any]], *columns
+) -> Dict[str, Any]:
+    """The rows of `table` with the keys of `rows`, by key"""
+
+    keys = [row["key"] for row in rows]
+    query = select(table.c.key, *columns).where(table.c.key.in_(keys))
+    return {row.key: row for row in session.execute(query)}
+
+
+def _insert_new(session: Session, table: Table, rows: List[Dict[str, Any]]) -> None:
+    """
+    Inserting the rows whose key is not in `table` yet: `ON CONFLICT DO
+    NOTHING` on PostgreSQL and SQLite, the existing keys are read first in
+    the transaction on the other databases (e.g. MySQL).
+    """
+
+    if not rows:
+        return
+    statement = _on_conflict_insert(session, table)
+    if statement is not None:
+        session.execute(statement.on_conflict_do_nothing(index_elements=["key"]), rows)
+        return
+    existing = _existing(session, table, rows)
+    new = [row for row in rows if row["key"] not in existing]
+    if new:
+        session.execute(insert(table), new)
+
+
+def _payment(
+    visit: Mapping[Any, Any], rates: Rates, now: datetime.datetime
+) -> Dict[str, Any]:
+    minutes = billed_minutes(visit["time_in"], visit["time_out"])
+    return {
+        "key": payment_key(visit["id"]),
+        "visit_id": visit["id"],
+        "client_id": visit["client_id"],
+        "parking_id": visit["parking_id"],
+        "minutes": minutes,
+        "amount": charge(rates, minutes),
+        "billed_at": now,
+    }
+
+
+def _capture(
+    key: str,
+    payment: str,
+    row: Mapping[str, Any],
+    amount: int,
+    now: datetime.datetime,
+) -> Dict[str, Any]:
+    return {
+        "key": key,
+        "payment_key": payment,
+        "client_id": row["client_id"],
+        "amount": amount,
+        "next_attempt_at": now,
+        "created_at": now,
+    }
+
+
+def _captures(
+    rows: List[Dict[str, Any]], now: datetime.datetime
+) -> List[Dict[str, Any]]:
+    """The outbox rows of the charged payments"""
+
+    return [
+        _capture(row["key"], row["key"], row, row["amount"], now)
+        for row in rows
+        if row["amount"] > 0
+    ]
+
+
+def bill_visits(
+    finished: Sequence[Mapping[str, Any]],
+    session: Optional[Session] = None,
+    now: Optional[datetime.datetime] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Начисления за визиты, завершённые при выезде (id, client_id, parking_id,
+    time_in, time_out), в транзакции выезда.
+
+    A visit already billed keeps its payment (the key is unique). A charge
+    is not captured here: it is queued in `payment_outbox` in the same
+    transaction for the workers of `payments.py`. Returns {"key", "minutes",
+    "amount"} of every visit.
+    """
+
+    if not finished:
+        return []
+    session = get_session(session)
+    now = now or datetime.datetime.now()
+    rates = load_rates({visit["parking_id"] for visit in finished}, session)
+    rows = [
+        _payment(visit, rates.get(visit["parking_id"], FREE), now) for visit in finished
+    ]
+    _insert_new(session, payments, rows)
+    _insert_new(session, outbox, _captures(rows, now))
+    return [
+        {"key": row["key"], "minutes": row["minutes"], "amount": row["amount"]}
+        for row in rows
+    ]
+
+
+def _upsert(session: Session, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Writing the payments of a chunk: the current payments are read with
+    one query, the changed ones are updated with one executemany, the new
+    ones inserted; an unchanged charge is not rewritten. Plain SQL of
+    every database. Returns the changed and the new payments.
+    """
+
+    existing = _existing(session, payments, rows, payments.c.minutes, payments.c.amount)
+    billed = {key: (row.minutes, row.amount) for key, row in existing.items()}
+    changed = []
+    for row in rows:
+        priced = (row["minutes"], row["amount"])
+        # a new payment is inserted below
+        if billed.get(row["key"], priced) != priced:
+            changed.append(row)
+    if changed:
+        session.execute(
+            update(payments)
+            .where(payments.c.key == bindparam("b_key"))
+            .values(
+                minutes=bindparam("b_minutes"),
+                amount=bindparam("b_amount"),
+                billed_at=bindparam("b_billed_at"),
+            ),
+            [
+                {
+                    "b_key": row["key"],
+                    "b_minutes": row["minutes"],
+                    "b_amount": row["amount"],
+                    "b_billed_at": row["billed_at"],
+                }
+                for row in changed
+            ],
+        )
+    new = [row for row in rows if row["key"] not in existing]
+    _insert_new(session, payments, new)
+    return changed + new
+
+
+def _requeue(
+    session: Session, rows: List[Dict[str, Any]], now: datetime.datetime
+) -> None:
+    """
+    Bringing the captures of the re-billed payments in line with them: the
+    pending and captured rows of a payment add up to its amount. The
+    difference goes to a pending capture of the payment not claimed by a
+    worker (cancelled when it comes to zero), else to a new adjustment row
+    "<key>:<n>" (a refund when negative): a captured or claimed amount is
+    never rewritten. A payment whose capture failed is left alone. The rows
+    are locked, so a worker does not claim them meanwhile.
+    """
+
+    if not rows:
+        return
+    queued: Dict[str, List[Any]] = {row["key"]: [] for row in rows}
+    query = (
+        select(
+            outbox.c.id,
+            outbox.c.payment_key,
+            outbox.c.amount,
+            outbox.c.status,
+            outbox.c.claim,
+        )
+        .where(outbox.c.payment_key.in_(list(queued)))
+        .order_by(outbox.c.id)
+        .with_for_update()
+    )
+    for capture in session.execute(query):
+        queued[capture.payment_key].append(capture)
+    pending = []
+    new = []
+    for row in rows:
+        captures = queued[row["key"]]
+        if any(capture.status == FAILED for capture in captures):
+            continue
+        due = sum(
+            capture.amount
+            for capture in captures
+            if capture.status in (PENDING, CAPTURED)
+        )
+        difference = row["amount"] - due
+        if not difference:
+            continue
+        unclaimed = [
+            capture
+            for capture in captures
+            if capture.status == PENDING and capture.claim is None
+        ]
+        if unclaimed:
+            amount = unclaimed[-1].amount + difference
+            pending.append(
+                {
+                    "b_id": unclaimed[-1].id,
+                    "b_amount": amount,
+                    "b_status": PENDING if amount else CANCELLED,
+                    "b_processed_at": None if amount else now,
+                }
+            )
+        else:
+            key = f"{row['key']}:{len(captures)}" if captures else row["key"]
+            new.append(_capture(key, row["key"], row, difference, now))
+    if pending:
+        session.execute(
+            update(outbox)
+            .where(outbox.c.id == bindparam("b_id"))
+            .values(
+                amount=bindparam("b_amount"),
+                status=bindparam("b_status"),
+                processed_at=bindparam("b_processed_at"),
+            ),
+            pending,
+        )
+    _insert_new(session, outbox, new)
+
+
+def rebill(
+    parking_ids: Optional[Collection[int]] = None,
+    since: Optional[datetime.datetime] = None,
+    batch_size: int = REBILL_BATCH_SIZE,
+    session: Optional[Session] = None,
+    now: Optional[datetime.datetime] = None,
+) -> Dict[str, int]:
+    """
+    Перерасчёт начислений завершённых визитов (текущих и архивных)
+    по действующим тарифам, e.g. at night after a change of the tariffs.
+
+    The visits are read by keyset chunks of `batch_size` plain rows on the
+    primary key (no ORM objects), a chunk is priced in memory and upserted
+    on the key with one executemany in its own transaction: an interrupted
+    run is resumed by running it again. The captures of the changed
+    payments are adjusted in the same transaction (`_requeue`).
+    Returns the number of billed visits.
+    """
+
+    session = get_session(session)
+    now = now or datetime.datetime.now()
+    rates = load_rates(parking_ids, session)
+    billed = 0
+    for table in (visits, archive):
+        query = (
+            select(
+                table.c.id,
+                table.c.client_id,
+                table.c.parking_id,
+                table.c.time_in,
+                table.c.time_out,
+            )
+            .where(table.c.time_in.is_not(None), table.c.time_out.is_not(None))
+            .order_by(table.c.id)
+            .limit(batch_size)
+        )
+        if parking_ids is not None:
+            query = query.where(table.c.parking_id.in_(parking_ids))
+        if since is not None:
+            query = query.where(table.c.time_out >= since)
+        after = 0
+        while True:
+            rows = session.execute(query.where(table.c.id > after)).all()
+            if not rows:
+                break
+            priced = [
+                _payment(row._mapping, rates.get(row.parking_id, FREE), now)
+                for row in rows
+            ]
+            _requeue(session, _upsert(session, priced), now)
+            session.commit()
+            billed += len(rows)
+            after = rows[-1].id
+    return {"billed": billed}
@@ -0,0 +1,191 @@
+import contextlib
+import fcntl
+import logging
+import threading
+from pathlib import Path
+from typing import Iterator, Optional, Set
+
+from alembic import command
+from alembic.config import Config
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import URL, Connection, Engine
+
+from .models import db
+
+logger = logging.getLogger(__name__)
+
+ALEMBIC_DIR = Path(__file__).parent / "alembic"
+
+# The revision of the schema created by `create_all()` before the database
+# was stamped by the application (the tables of the first release)
+BASELINE_REVISION = "775963414090"
+BASELINE_TABLES = {"clients", "parkings", "client_parking"}
+
+# The lock of the schema check between the workers (PostgreSQL, MySQL)
+SCHEMA_LOCK = "parking_schema"
+SCHEMA_LOCK_KEY = 0x7061726B  # "park"
+
+
+def alembic_head() -> Optional[str]:
+    """
+    The head revision of the migrations in `src/parking/alembic`
+    """
+
+    return ScriptDirectory(str(ALEMBIC_DIR)).get_current_head()
+
+
+def _is_current(connection: Connection, tables: Set[str]) -> bool:
+    """Every table and column of the models exists"""
+
+    inspector = inspect(connection)
+    for name, table in db.metadata.tables.items():
+        if name not in tables:
+            return False
+        columns = {column["name"] for column in inspector.get_columns(name)}
+        if not set(table.columns.keys()) <= columns:
+            return False
+    return True
+
+
+def _alembic_config(connection: Connection) -> Config:
+    """The alembic config of the migrations run on `connection`, see env.py"""
+
+    config = Config()
+    config.set_main_option("script_location", str(ALEMBIC_DIR))
+    config.attributes.update(connection=connection, target_metadata=db.metadata)
+    return config
+
+
+def upgrade_schema(connection: Connection, destination: str) -> None:
+    """
+    `alembic upgrade <destination>` on the connection, in its transaction
+    """
+
+    command.upgrade(_alembic_config(connection), destination)
+
+
+def stamp_schema(connection: Connection, revision: str) -> None:
+    """
+    `alembic stamp <revision>` on the connection, in its transaction
+    """
+
+    command.stamp(_alembic_config(connection), revision)
+
+
+@contextlib.contextmanager
+def schema_file_lock(url: URL) -> Iterator[None]:
+    """
+    Lock of the schema check of a SQLite file between the processes (a file
+    lock next to the database). The other databases are locked in the
+    transaction of the check, see `_schema_lock`.
+    """
+
+    database = url.database
+    if url.get_backend_name() != "sqlite" or database in (None, "", ":memory:"):
+        yield
+        return
+    with open(f"{database}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+@contextlib.contextmanager
+def _schema_lock(connection: Connection) -> Iterator[None]:
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        # released by the end of the transaction, PgBouncer keeps it
+        connection.execute(
+            text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY}
+        )
+    elif dialect == "mysql":
+        # the DDL of MySQL commits, the lock is held by the session
+        connection.execute(text("SELECT GET_LOCK(:name, -1)"), {"name": SCHEMA_LOCK})
+        try:
+            yield
+        finally:
+            connection.execute(
+                text("SELECT RELEASE_LOCK(:name)"), {"name": SCHEMA_LOCK}
+            )
+        return
+    yield
+
+
+def check_schema(connection: Connection) -> Optional[str]:
+    """
+    Checking the database schema and returning the alembic revision.
+
+    An empty database (or the complete schema of the models, e.g. created by
+    `db.create_all()`) is created with `create_all()` and stamped with the
+    head revision. The tables of the first release, created by `create_all()`
+    without alembic, are stamped with BASELINE_REVISION and upgraded to the
+    head. A database managed by alembic is left untouched, a warning is
+    logged if it is behind the head. The check holds a lock of the database:
+    the workers started together (without `preload_app`) check it one by
+    one, the next ones find it done.
+    """
+
+    with _schema_lock(connection):
+        return _check_schema(connection)
+
+
+def _check_schema(connection: Connection) -> Optional[str]:
+    head = alembic_head()
+    tables = set(inspect(connection).get_table_names())
+    if "alembic_version" not in tables:
+        known = tables & set(db.metadata.tables)
+        if not known or _is_current(connection, tables):
+            db.metadata.create_all(connection)
+            if head:
+                stamp_schema(connection, head)
+            return head
+        if known != BASELINE_TABLES:
+            raise RuntimeError(
+                f"The tables {sorted(known)} are not managed by alembic and are "
+                "not the first release, stamp their revision with `alembic stamp`"
+            )
+        logger.warning(
+            "Tables without alembic revision: upgrading from %s", BASELINE_REVISION
+        )
+        stamp_schema(connection, BASELINE_REVISION)
+        if head:
+            upgrade_schema(connection, head)
+        return MigrationContext.configure(connection).get_current_revision()
+
+    current = MigrationContext.configure(connection).get_current_revision()
+    if current != head:
+        logger.warning(
+            "Database revision %s is not the head %s, run `alembic upgrade head`",
+            current,
+            head,
+        )
+    return current
+
+
+def ensure_schema(engine: Engine) -> Optional[str]:
+    """
+    `check_schema` in its own transaction
+    """
+
+    with schema_file_lock(engine.url), engine.begin() as connection:
+        return check_schema(connection)
+
+
+class SchemaBootstrap:
+    """
+    Однократная (на процесс) проверка схемы базы данных
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.ready = False
+        self.revision: Optional[str] = None
+
+    def __call__(self, engine: Engine) -> None:
+        if self.ready:
+            return
+        with self._lock:
+            if not self.ready:
+                self.revision = ensure_schema(engine)
+                self.ready = True
@@ -0,0 +1,314 @@
+import csv
+import io
+import json
+from itertools import islice
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Tuple,
+    cast,
+)
+
+from sqlalchemy import Table, insert, select
+from sqlalchemy.exc import IntegrityError
+
+from .models import Client, Parking, db, normalize_plate
+
+BULK_CHUNK_SIZE = 1000
+
+
+def _to_bool(value: Any) -> bool:
+    if isinstance(value, str):
+        if value.strip().lower() in ("1", "true", "yes", "y", "t"):
+            return True
+        if value.strip().lower() in ("0", "false", "no", "n", "f", ""):
+            return False
+        raise ValueError(value)
+    return bool(value)
+
+
+def _to_optional_str(value: Any) -> Any:
+    return None if value is None else str(value)
+
+
+def _to_optional_float(value: Any) -> Any:
+    return None if value in (None, "") else float(value)
+
+
+class BulkSpec(NamedTuple):
+    """
+    Описание массовой загрузки модели: уникальный ключ и поля с конвертерами
+    """
+
+    model: Any
+    key: str
+    required: Dict[str, Callable[[Any], Any]]
+    optional: Dict[str, Callable[[Any], Any]]
+    defaults: Callable[[Dict[str, Any]], Dict[str, Any]]
+    # columns computed from the converted row
+    derived: Dict[str, Callable[[Dict[str, Any]], Any]] = {}
+
+    @property
+    def table(self) -> Table:
+        return cast(Table, self.model.__table__)
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self.required) + list(self.optional) + list(self.derived)
+
+
+CLIENTS = BulkSpec(
+    model=Client,
+    key="car_number",
+    required={"name": str, "surname": str, "car_number": str},
+    optional={"credit_card": _to_optional_str},
+    defaults=lambda row: {"credit_card": None},
+    derived={"plate": lambda row: normalize_plate(row["car_number"])},
+)
+
+PARKINGS = BulkSpec(
+    model=Parking,
+    key="address",
+    required={"address": str, "count_places": int},
+    optional={
+        "name": _to_optional_str,
+        "opened": _to_bool,
+        "count_available_places": int,
+        "latitude": _to_optional_float,
+        "longitude": _to_optional_float,
+    },
+    defaults=lambda row: {
+        "name": None,
+        "opened": True,
+        "count_available_places": row["count_places"],
+        "latitude": None,
+        "longitude": None,
+    },
+)
+
+
+EXTENSIONS = {
+    ".csv": "text/csv",
+    ".ndjson": "application/x-ndjson",
+    ".jsonl": "application/x-ndjson",
+    ".json": "application/json",
+}
+
+
+def read_rows(
+    stream: IO[bytes], mimetype: str, key: str, filename: str = ""
+) -> Iterator[Any]:
+    """
+    Чтение строк загрузки: JSON массив (или {"<key>": [...]}), NDJSON или CSV.
+    NDJSON и CSV читаются из потока построчно. Формат загруженного файла
+    определяется по расширению имени.
+    """
+
+    for extension, extension_mimetype in EXTENSIONS.items():
+        if filename.lower().endswith(extension):
+            mimetype = extension_mimetype
+    if mimetype in ("text/csv", "application/csv"):
+        yield from csv.DictReader(io.TextIOWrapper(stream, encoding="utf-8"))
+    elif mimetype in ("application/x-ndjson", "application/jsonlines"):
+        for line in io.TextIOWrapper(stream, encoding="utf-8"):
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
+    else:
+        data = json.load(stream)
+        if isinstance(data, dict):
+            data = data.get(key)
+        if not isinstance(data, list):
+            raise ValueError("A list of rows is expected")
+        yield from data
+
+
+def _convert(spec: BulkSpec, raw: Any) -> Dict[str, Any]:
+    if not isinstance(raw, dict):
+        raise ValueError("row is not an object")
+    row: Dict[str, Any] = {}
+    for name, converter in spec.required.items():
+        if raw.get(name) in (None, ""):
+            raise ValueError(f"missing field '{name}'")
+        row[name] = converter(raw[name])
+    row.update(spec.defaults(row))
+    for name, converter in spec.optional.items():
+        if raw.get(name) is not None:
+            row[name] = converter(raw[name])
+    for name, derive in spec.derived.items():
+        row[name] = derive(row)
+    return row
+
+
+def _copy_rows(spec: BulkSpec, rows: List[Dict[str, Any]]) -> None:
+    """
+    Загрузка порции через `COPY ... FROM STDIN` (Postgres + psycopg2)
+    """
+
+    def text(value: Any) -> str:
+        if value is None:
+            return "\\N"
+        if isinstance(value, bool):
+            return "t" if value else "f"
+        return (
+            str(value)
+            .replace("\\", "\\\\")
+            .replace("\t", "\\t")
+            .replace("\n", "\\n")
+            .replace("\r", "\\r")
+        )
+
+    columns = spec.columns
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(text(row[name]) for name in columns) + "\n")
+    buffer.seek(0)
+
+    dbapi_connection = db.session.connection().connection
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.copy_expert(  # type: ignore[attr-defined]
+            f"COPY {spec.table.name} ({', '.join(columns)}) FROM STDIN", buffer
+        )
+    finally:
+        cursor.close()
+
+
+def _use_copy() -> bool:
+    dialect = db.session.get_bind().dialect
+    return dialect.name == "postgresql" and dialect.driver == "psycopg2"
+
+
+def _insert_chunk(
+    spec: BulkSpec, rows: List[Tuple[int, Dict[str, Any]]], conflicts: List[Any]
+) -> int:
+    """
+    Вставка порции одним executemany (или COPY), при гонке с параллельной
+    вставкой порция повторяется построчно в savepoint'ах.
+    """
+
+    values = [row for _index, row in rows]
+    try:
+        with db.session.begin_nested():
+            if _use_copy():
+                _copy_rows(spec, values)
+            else:
+                db.session.execute(insert(spec.table), values)
+        return len(values)
+    except IntegrityError:
+        pass
+
+    created = 0
+    for index, row in rows:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(spec.table), [row])
+            created += 1
+        except IntegrityError:
+            conflicts.append(
+                {"row": index, spec.key: row[spec.key], "error": "already exists"}
+            )
+    return created
+
+
+def _readable(rows: Iterable[Any], errors: List[Dict[str, Any]]) -> Iterator[Any]:
+    """
+    Строки загрузки до первой нечитаемой: a body broken midway (invalid
+    UTF-8, CSV or JSON) ends the rows, its error is added to `errors`.
+    """
+
+    iterator = iter(rows)
+    index = 0
+    while True:
+        try:
+            raw = next(iterator)
+        except StopIteration:
+            return
+        except (ValueError, csv.Error) as error:
+            errors.append({"row": index, "error": f"unreadable body: {error}"})
+            return
+        yield raw
+        index += 1
+
+
+def _chunks(iterable: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def bulk_import(
+    spec: BulkSpec, rows: Iterable[Any], chunk_size: int = BULK_CHUNK_SIZE
+) -> Dict[str, Any]:
+    """Bulk creation of rows with a per-row report.
+
+    Rows are converted, deduplicated on the unique key inside the upload and
+    against the database, and inserted in chunks committed one by one.
+    A conflict or an invalid row is reported and does not abort the batch.
+    A body broken midway stops the import after the rows read so far:
+    `complete` is false, `committed` counts the rows of the committed chunks
+    and `failed` the errors.
+    """
+
+    key_column = spec.table.c[spec.key]
+    seen = set()
+    created = 0
+    conflicts: List[Dict[str, Any]] = []
+    errors: List[Dict[str, Any]] = []
+    broken: List[Dict[str, Any]] = []
+    committed = 0
+
+    for chunk in _chunks(enumerate(_readable(rows, broken)), chunk_size):
+        candidates: List[Tuple[int, Dict[str, Any]]] = []
+        for index, raw in chunk:
+            try:
+                row = _convert(spec, raw)
+            except (TypeError, ValueError) as error:
+                errors.append({"row": index, "error": str(error)})
+                continue
+            if row[spec.key] in seen:
+                conflicts.append(
+                    {"row": index, spec.key: row[spec.key], "error": "duplicate"}
+                )
+                continue
+            seen.add(row[spec.key])
+            candidates.append((index, row))
+
+        existing = set(
+            db.session.execute(
+                select(key_column).where(
+                    key_column.in_([row[spec.key] for _index, row in candidates])
+                )
+            ).scalars()
+        )
+        fresh = []
+        for index, row in candidates:
+            if row[spec.key] in existing:
+                conflicts.append(
+                    {"row": index, spec.key: row[spec.key], "error": "already exists"}
+                )
+            else:
+                fresh.append((index, row))
+
+        if fresh:
+            created += _insert_chunk(spec, fresh, conflicts)
+        db.session.commit()
+        committed += len(chunk)
+
+    errors += broken
+    return {
+        "created": created,
+        "conflicts": conflicts,
+        "errors": errors,
+        "committed": committed,
+        "failed": len(errors),
+        "complete": not broken,
+    }
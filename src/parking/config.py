@@ -1,16 +1,102 @@
 import os
 from pathlib import Path
+from typing import Any, Dict
 
-from dotenv import load_dotenv
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool
 
-load_dotenv()
+# The settings are read from the environment once, at import: the `.env` file
+# is loaded by the entry points (`manage.py`, `asgi.py`, the flask CLI)
+# before this module is imported, nothing is written to the disk here.
 
 # Settings application
 SECRET_KEY = os.getenv("SECRET_KEY")
 
+# Settings JSON: orjson is used if it is installed and FAST_JSON=1
+FAST_JSON = os.getenv("FAST_JSON", "1") == "1"
+
+# Settings cache
+PARKINGS_CACHE_TTL = float(os.getenv("PARKINGS_CACHE_TTL", 5))
+
+# Settings API
+PAGE_MAX_LIMIT = int(os.getenv("PAGE_MAX_LIMIT", 1000))
+
+# Settings idempotency keys of the write routes (Idempotency-Key): seconds a
+# response is kept (0 - off), responses cached per process, seconds a key stays
+# reserved by a request that did not finish
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", 86400))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", 10000))
+IDEMPOTENCY_LOCK_TIMEOUT = float(os.getenv("IDEMPOTENCY_LOCK_TIMEOUT", 30))
+
+# Settings lookup of the clients by car plate: cached clients per process,
+# plates per request
+PLATE_CACHE_SIZE = int(os.getenv("PLATE_CACHE_SIZE", 10000))
+PLATE_LOOKUP_MAX = int(os.getenv("PLATE_LOOKUP_MAX", 1000))
+
+# Settings shared memory: the segments of the stores below are named
+# "<SHM_PREFIX>_<store>" unless <STORE>_SHM_NAME is set; gunicorn.conf.py sets
+# a new prefix on every start of the master and removes its segments on exit,
+# a configured name is kept
+SHM_PREFIX = os.getenv("SHM_PREFIX", "")
+
+# Settings occupancy counters: "" (in the database), "memory" or "shared"
+OCCUPANCY_BACKEND = os.getenv("OCCUPANCY_BACKEND", "")
+OCCUPANCY_FLUSH_INTERVAL = float(os.getenv("OCCUPANCY_FLUSH_INTERVAL", 1))
+OCCUPANCY_SHM_NAME = os.getenv("OCCUPANCY_SHM_NAME", "")
+
+# Settings HTTP cache: revisions of the ETags "" (no ETags), "memory" (one
+# process, WEB_CONCURRENCY 1) or "shared"
+REVISIONS_BACKEND = os.getenv("REVISIONS_BACKEND", "")
+REVISIONS_SHM_NAME = os.getenv("REVISIONS_SHM_NAME", "")
+# max-age of Cache-Control, 0 is "no-cache" (revalidation with If-None-Match)
+HTTP_CACHE_MAX_AGE = int(os.getenv("HTTP_CACHE_MAX_AGE", 0))
+
+# Settings live availability feed: "" (LISTEN/NOTIFY on Postgres), "memory" or
+# "postgres"; an SSE stream (a long poll) holds a worker thread for
+# LIVE_STREAM_TIMEOUT (LIVE_POLL_TIMEOUT) seconds, their number is bounded by
+# LIVE_MAX_STREAMS below. LISTEN is a state of the session: behind a PgBouncer
+# in transaction mode LIVE_LISTEN_URL is a direct URL of Postgres for it.
+LIVE_BACKEND = os.getenv("LIVE_BACKEND", "")
+LIVE_LISTEN_URL = os.getenv("LIVE_LISTEN_URL", "")
+LIVE_STREAM_TIMEOUT = float(os.getenv("LIVE_STREAM_TIMEOUT", 300))
+LIVE_HEARTBEAT = float(os.getenv("LIVE_HEARTBEAT", 15))
+LIVE_POLL_TIMEOUT = float(os.getenv("LIVE_POLL_TIMEOUT", 25))
+
+# Settings metrics of the requests (/metrics, Server-Timing): "" (off),
+# "memory" (per process) or "shared" (summed over the workers)
+METRICS_BACKEND = os.getenv("METRICS_BACKEND", "")
+METRICS_SHM_NAME = os.getenv("METRICS_SHM_NAME", "")
+METRICS_SLOW_QUERY_MS = float(os.getenv("METRICS_SLOW_QUERY_MS", 200))
+
+# Settings archive of the visits (flask archive-visits)
+ARCHIVE_AGE_DAYS = int(os.getenv("ARCHIVE_AGE_DAYS", 90))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 5000))
+
+# Settings analytics: estimated price of a started hour, cached days
+ANALYTICS_HOURLY_RATE = float(os.getenv("ANALYTICS_HOURLY_RATE", 0))
+ANALYTICS_CACHE_SIZE = int(os.getenv("ANALYTICS_CACHE_SIZE", 20000))
+ANALYTICS_MAX_DAYS = int(os.getenv("ANALYTICS_MAX_DAYS", 366))
+
+# Settings billing: visits per transaction of the re-billing (flask rebill)
+BILLING_BATCH_SIZE = int(os.getenv("BILLING_BATCH_SIZE", 10000))
+
+# Settings capture of the payments: PAYMENT_PROCESSOR "" (off, the captures wait
+# in payment_outbox) or "stub"; PAYMENT_THREADS calls of the processor per process,
+# a claimed batch is retried by another worker after PAYMENT_LEASE seconds, or
+# longer for a batch that may take longer: PAYMENT_CAPTURE_TIMEOUT seconds at
+# most per call of the processor (the timeout of its client)
+PAYMENT_PROCESSOR = os.getenv("PAYMENT_PROCESSOR", "")
+PAYMENT_THREADS = int(os.getenv("PAYMENT_THREADS", 4))
+PAYMENT_BATCH_SIZE = int(os.getenv("PAYMENT_BATCH_SIZE", 100))
+PAYMENT_INTERVAL = float(os.getenv("PAYMENT_INTERVAL", 1))
+PAYMENT_MAX_ATTEMPTS = int(os.getenv("PAYMENT_MAX_ATTEMPTS", 8))
+PAYMENT_RETRY_BACKOFF = float(os.getenv("PAYMENT_RETRY_BACKOFF", 5))
+PAYMENT_RETRY_MAX_BACKOFF = float(os.getenv("PAYMENT_RETRY_MAX_BACKOFF", 3600))
+PAYMENT_LEASE = float(os.getenv("PAYMENT_LEASE", 60))
+PAYMENT_CAPTURE_TIMEOUT = float(os.getenv("PAYMENT_CAPTURE_TIMEOUT", 10))
+
 # Settings database
 BASE_DIR = Path(__file__).parent / "database"
-BASE_DIR.mkdir(exist_ok=True, parents=True)
 
 DB_BASE_URL = os.getenv("DB_BASE_URL")
 DB_USER = os.getenv("DB_USER")
@@ -19,8 +105,112 @@ DB_HOST = os.getenv("DB_HOST", "app_parking")
 DB_PORT = os.getenv("DB_PORT")
 DB_NAME = os.getenv("DB_NAME")
 
+# Read replica of the GET routes ("" - everything on the primary), not used while
+# it is more than REPLICA_MAX_LAG seconds behind (checked every
+# REPLICA_CHECK_INTERVAL seconds) or for REPLICA_MAX_LAG seconds after a change
+# of the data of a route (with REVISIONS_BACKEND)
+REPLICA_DATABASE_URL = os.getenv("REPLICA_DATABASE_URL", "")
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", 5))
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", 1))
+
+# URL for the asyncio engine of `asgi.py`, derived from `database` if empty
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", "")
+
 try:
     if os.environ["TERM_PROGRAM"] == "vscode":
         database = f"{DB_BASE_URL}:///{BASE_DIR}/{DB_NAME}"
 except KeyError:
     database = f"{DB_BASE_URL}://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+# A complete URL of the database overrides the settings above (e.g. benchmarks)
+database = os.getenv("DATABASE_URL") or database
+
+# Settings connection pool (per gunicorn worker)
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 4))
+GUNICORN_THREADS = int(os.getenv("GUNICORN_THREADS", 32))
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", 40))
+DB_POOL_SIZE = os.getenv("DB_POOL_SIZE")
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 0))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", 30000))
+# "1" behind a PgBouncer in transaction mode: no pool in the application
+# and no session level settings, the statement timeout is set per transaction
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "0") == "1"
+
+# Settings rate limiting and load shedding: LIMITS_BACKEND "" (off), "memory"
+# (per process) or "shared" (summed over the workers); requests per second and
+# burst of a client (0 - no limit), the gates are never limited
+LIMITS_BACKEND = os.getenv("LIMITS_BACKEND", "")
+LIMITS_SHM_NAME = os.getenv("LIMITS_SHM_NAME", "")
+RATE_LIMIT_READ_RATE = float(os.getenv("RATE_LIMIT_READ_RATE", 20))
+RATE_LIMIT_READ_BURST = float(os.getenv("RATE_LIMIT_READ_BURST", 40))
+RATE_LIMIT_WRITE_RATE = float(os.getenv("RATE_LIMIT_WRITE_RATE", 5))
+RATE_LIMIT_WRITE_BURST = float(os.getenv("RATE_LIMIT_WRITE_BURST", 20))
+# the subscribers of the live feed (SSE, long poll) per worker and per client
+# of a worker, each one holds a thread: the others are refused (503, 0 - no
+# limit), they are not counted in flight below
+LIVE_MAX_STREAMS = int(os.getenv("LIVE_MAX_STREAMS", max(1, GUNICORN_THREADS // 2)))
+LIVE_MAX_CLIENT_STREAMS = int(os.getenv("LIVE_MAX_CLIENT_STREAMS", 2))
+# the reads are refused at SHED_READ_INFLIGHT requests in flight per worker
+# (summed over the workers with the "shared" backend) or an average wait of
+# SHED_POOL_WAIT_MS for a connection, the other writes at SHED_WRITE_INFLIGHT
+# requests or twice the wait (0 - off), the gates never. The defaults leave
+# the gates at least one thread of a worker full of subscribers
+SHED_READ_INFLIGHT = int(
+    os.getenv("SHED_READ_INFLIGHT", max(1, GUNICORN_THREADS - LIVE_MAX_STREAMS - 2))
+)
+SHED_WRITE_INFLIGHT = int(
+    os.getenv("SHED_WRITE_INFLIGHT", max(1, GUNICORN_THREADS - LIVE_MAX_STREAMS - 1))
+)
+SHED_POOL_WAIT_MS = float(os.getenv("SHED_POOL_WAIT_MS", 250))
+SHED_RETRY_AFTER = int(os.getenv("SHED_RETRY_AFTER", 1))
+# the number of the reverse proxies (nginx, the load balancer) in front of the
+# app whose X-Forwarded-For/-Proto/-Host are trusted; 0 - none: the clients
+# are limited on the address of the peer, behind a proxy it is the proxy's
+PROXY_FIX_HOPS = int(os.getenv("PROXY_FIX_HOPS", 0))
+
+
+def prepare_database(url: str) -> None:
+    """
+    Создание каталога файла базы SQLite (вызывается из `create_app`,
+    не при импорте)
+    """
+
+    parsed = make_url(url)
+    path = parsed.database
+    if parsed.get_backend_name() == "sqlite" and path and path != ":memory:":
+        Path(path).parent.mkdir(exist_ok=True, parents=True)
+
+
+def engine_options(url: str) -> Dict[str, Any]:
+    """
+    Параметры `create_engine` для SQLALCHEMY_ENGINE_OPTIONS.
+
+    The pool of every worker gets its share of DB_MAX_CONNECTIONS so that
+    all the workers together stay below the budget, unless DB_POOL_SIZE
+    is set. SQLite keeps the defaults of Flask-SQLAlchemy.
+    """
+
+    if url.startswith("sqlite"):
+        return {}
+    if DB_PGBOUNCER:
+        return {"poolclass": NullPool}
+
+    if DB_POOL_SIZE:
+        pool_size = int(DB_POOL_SIZE)
+    else:
+        pool_size = max(1, DB_MAX_CONNECTIONS // WEB_CONCURRENCY - DB_MAX_OVERFLOW)
+    options: Dict[str, Any] = {
+        "pool_size": pool_size,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+    if url.startswith("postgresql") and DB_STATEMENT_TIMEOUT:
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT}"
+        }
+    return options
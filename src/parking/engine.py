@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+import weakref
+from typing import Any, Dict
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool, Pool, QueuePool
+
+_forked_engines: "weakref.WeakSet[Engine]" = weakref.WeakSet()
+
+
+def set_transaction_timeout(engine: Engine, timeout: int) -> None:
+    """
+    `SET LOCAL statement_timeout` at the beginning of every transaction.
+
+    Behind a PgBouncer in transaction mode the server connection changes
+    between transactions, so the timeout can't be a session setting
+    (startup `options` are rejected by PgBouncer).
+    """
+
+    @event.listens_for(engine, "begin")
+    def begin(connection):
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout)}")
+
+
+def configure_engine(engine: Engine, pgbouncer: bool, statement_timeout: int) -> None:
+    """
+    Настройка движка после создания
+    """
+
+    if pgbouncer and engine.dialect.name == "postgresql" and statement_timeout:
+        set_transaction_timeout(engine, statement_timeout)
+
+
+def _after_fork() -> None:
+    for engine in list(_forked_engines):
+        # the connections belong to the parent: dropped, not closed
+        engine.dispose(close=False)
+
+
+def dispose_after_fork(engine: Engine) -> None:
+    """
+    Сброс пула движка в дочернем процессе после fork.
+
+    With `preload_app` gunicorn creates the application (and its engine) in
+    the master and forks the workers from it: a connection opened in the master
+    (e.g. by the schema check) must not be shared by the workers.
+    """
+
+    if not _forked_engines and hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=_after_fork)
+    _forked_engines.add(engine)
+
+
+class PoolWait:
+    """
+    Скользящее среднее (EWMA) ожидания соединения пула в процессе.
+
+    Every checkout adds its wait with the weight `weight`: a pool that is
+    exhausted (QueuePool) or a PgBouncer that queues the clients (NullPool)
+    raises the average within a few requests, it decays as fast.
+    """
+
+    def __init__(self, weight: float = 0.2) -> None:
+        self.weight = weight
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self.value += self.weight * (seconds - self.value)
+
+
+pool_wait = PoolWait()
+
+
+class _TimedPool(Pool):
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            # a timeout of the pool is the longest wait
+            pool_wait.record(time.perf_counter() - started)
+
+
+class TimedQueuePool(_TimedPool, QueuePool):
+    pass
+
+
+class TimedNullPool(_TimedPool, NullPool):
+    pass
+
+
+_TIMED_POOLS = {QueuePool: TimedQueuePool, NullPool: TimedNullPool}
+
+
+def timed_pool(options: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Параметры `config.engine_options` с пулом, измеряющим ожидание соединения
+    (`pool_wait`, see `limits.py`). SQLite keeps its pool.
+    """
+
+    if not options:
+        return options
+    poolclass = _TIMED_POOLS.get(options.get("poolclass", QueuePool))
+    return options if poolclass is None else {**options, "poolclass": poolclass}
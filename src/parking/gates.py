@@ -0,0 +1,499 @@
+import datetime
+from typing import Any, Dict, List, Optional, Tuple, Union, cast
+
+from sqlalchemy import Table, select, update
+from sqlalchemy.orm import Session
+
+from .billing import bill_visits
+from .models import Client, ClientParking, Parking, get_session
+from .occupancy import OccupancyService, State, next_state
+
+parkings = cast(Table, Parking.__table__)
+visits = cast(Table, ClientParking.__table__)
+
+
+class GateError(Exception):
+    """
+    Отказ в заезде или выезде, `message` совпадает с ответом API
+    """
+
+    def __init__(self, message: str, status: int = 404) -> None:
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+    def to_json(self) -> Dict[str, int]:
+        return {self.message: self.status}
+
+
+def _refuse_check_in(session: Session, client_id: int, parking_id: int) -> GateError:
+    """
+    Explaining why the guarded UPDATE of the check-in did not match a row,
+    runs only on the refusal path.
+    """
+
+    opened = session.execute(
+        select(Parking.opened).where(Parking.id == parking_id)
+    ).one_or_none()
+    client = session.execute(
+        select(Client.credit_card).where(Client.id == client_id)
+    ).one_or_none()
+    if opened is None or client is None:
+        return GateError("Not found")
+    if not opened.opened:
+        return GateError("No place")
+    if not client.credit_card:
+        return GateError("Link the card to your account")
+    return GateError("No place")
+
+
+def _check_in_counted(
+    session: Session, client_id: int, parking_id: int, occupancy: OccupancyService
+) -> Dict[str, Any]:
+    """
+    Arrival with the occupancy counters: the place is reserved in the counter,
+    the `parkings` row is not locked, the reservation is released if
+    the arrival is refused.
+    """
+
+    state = occupancy.reserve(parking_id)
+    if state is None:
+        raise GateError("No place" if occupancy.get(parking_id) else "Not found")
+    try:
+        client = session.execute(
+            select(Client.credit_card).where(Client.id == client_id)
+        ).one_or_none()
+        if client is None:
+            raise GateError("Not found")
+        if not client.credit_card:
+            raise GateError("Link the card to your account")
+        arrival = ClientParking(
+            client_id=client_id,
+            parking_id=parking_id,
+            time_in=datetime.datetime.now(),
+        )
+        session.add(arrival)
+        session.flush()
+        parking = dict(
+            session.execute(select(parkings).where(parkings.c.id == parking_id))
+            .one()
+            ._mapping
+        )
+    except Exception:
+        occupancy.release(parking_id)
+        raise
+
+    parking["count_available_places"], parking["opened"] = state
+    return {
+        "arrival": arrival.to_json(),
+        "parking": parking,
+        "card": client.credit_card,
+        "undo": lambda: occupancy.release(parking_id),
+    }
+
+
+def check_in(
+    client_id: int,
+    parking_id: int,
+    occupancy: Optional[OccupancyService] = None,
+    session: Optional[Session] = None,
+) -> Dict[str, Any]:
+    """Arrival of the client to the parking lot.
+
+    A single guarded `UPDATE ... RETURNING` takes a place only if the parking
+    is opened, has available places and the client has a linked card,
+    `opened` is recomputed in the same statement. With the occupancy counters
+    the place is taken in the counter instead. The transaction is left
+    open for the caller to commit, `undo` of the result reverts the counter
+    if the commit fails.
+    """
+
+    session = get_session(session)
+    if occupancy is not None:
+        return _check_in_counted(session, client_id, parking_id, occupancy)
+
+    card = select(Client.credit_card).where(Client.id == client_id).scalar_subquery()
+    row = session.execute(
+        update(parkings)
+        .where(
+            parkings.c.id == parking_id,
+            parkings.c.opened.is_(True),
+            parkings.c.count_available_places > 0,
+            card != "",
+        )
+        .values(
+            count_available_places=parkings.c.count_available_places - 1,
+            opened=parkings.c.count_available_places > 1,
+        )
+        .returning(parkings, card.label("card"))
+    ).one_or_none()
+    if row is None:
+        raise _refuse_check_in(session, client_id, parking_id)
+
+    arrival = ClientParking(
+        client_id=client_id,
+        parking_id=parking_id,
+        time_in=datetime.datetime.now(),
+    )
+    session.add(arrival)
+    session.flush()
+
+    parking = dict(row._mapping)
+    return {
+        "arrival": arrival.to_json(),
+        "parking": {c.name: parking[c.name] for c in parkings.columns},
+        "card": parking["card"],
+    }
+
+
+def active_visit(client_id: int, parking_id: int):
+    """
+    The latest visit of the client that is not finished (`time_out IS NULL`),
+    served by the partial index `ix_client_parking_active`.
+    """
+
+    return (
+        select(visits.c.id)
+        .where(
+            visits.c.client_id == client_id,
+            visits.c.parking_id == parking_id,
+            visits.c.time_out.is_(None),
+        )
+        .order_by(visits.c.id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+
+
+def check_out(
+    client_id: int,
+    parking_id: int,
+    occupancy: Optional[OccupancyService] = None,
+    session: Optional[Session] = None,
+) -> Dict[str, Any]:
+    """Departure of the client from the parking lot.
+
+    The active visit is closed by a guarded `UPDATE ... RETURNING` (a visit
+    can't be closed twice), a second `UPDATE ... RETURNING` frees the place
+    and reopens the parking, with the occupancy counters the place is freed
+    in the counter instead. The charge of the visit is written to `payments`
+    in the same transaction (see `billing.py`). The transaction is left open
+    for the caller to commit.
+    """
+
+    session = get_session(session)
+    departure = session.execute(
+        update(visits)
+        .where(
+            visits.c.id == active_visit(client_id, parking_id),
+            visits.c.time_out.is_(None),
+            visits.c.time_in.is_not(None),
+        )
+        .values(time_out=datetime.datetime.now())
+        .returning(visits)
+    ).one_or_none()
+    if departure is None:
+        entered = session.execute(
+            select(visits.c.time_in).where(
+                visits.c.id == active_visit(client_id, parking_id)
+            )
+        ).one_or_none()
+        if entered is None:
+            raise GateError("Not available")
+        raise GateError("The client did not enter the parking lot")
+    payment = bill_visits([departure._mapping], session)[0]
+
+    if occupancy is not None:
+        state = occupancy.release(parking_id)
+        row = session.execute(
+            select(parkings).where(parkings.c.id == parking_id)
+        ).one_or_none()
+        if state is None or row is None:
+            raise GateError("Not found")
+        parking = dict(row._mapping)
+        parking["count_available_places"], parking["opened"] = state
+        return {
+            "departure": dict(departure._mapping),
+            "payment": payment,
+            "parking": parking,
+            "undo": lambda: occupancy.counters.apply(parking_id, -1),
+        }
+
+    row = session.execute(
+        update(parkings)
+        .where(parkings.c.id == parking_id)
+        .values(
+            count_available_places=parkings.c.count_available_places + 1,
+            opened=parkings.c.count_available_places + 1 > 0,
+        )
+        .returning(parkings)
+    ).one_or_none()
+    if row is None:
+        raise GateError("Not found")
+
+    return {
+        "departure": dict(departure._mapping),
+        "payment": payment,
+        "parking": dict(row._mapping),
+    }
+
+
+ARRIVAL = "arrival"
+DEPARTURE = "departure"
+
+
+def _failed(message: str, status: int = 404) -> Dict[str, Any]:
+    return {"status": status, "error": message}
+
+
+def _event_time(event: Dict[str, Any]) -> datetime.datetime:
+    """
+    The time of the event in the convention of the stored visits: the naive
+    local time, an offset of the controller is converted to it.
+    """
+
+    if event.get("time"):
+        time = datetime.datetime.fromisoformat(event["time"])
+        if time.tzinfo is not None:
+            time = time.astimezone().replace(tzinfo=None)
+        return time
+    return datetime.datetime.now()
+
+
+class _RowLedger:
+    """
+    Counter of a parking row locked with `FOR UPDATE`, the result of all
+    the events is written with one UPDATE.
+    """
+
+    def __init__(self, session: Session, parking_id: int, state: State) -> None:
+        self.session = session
+        self.parking_id = parking_id
+        self.state = state
+
+    def apply(self, delta: int) -> Optional[State]:
+        new_state = next_state(self.state, delta)
+        if new_state is not None:
+            self.state = new_state
+        return new_state
+
+    def save(self) -> None:
+        available, opened = self.state
+        self.session.execute(
+            update(parkings)
+            .where(parkings.c.id == self.parking_id)
+            .values(count_available_places=available, opened=opened)
+        )
+
+    def undo(self) -> None:
+        pass
+
+
+class _CounterLedger:
+    """
+    Counter of the occupancy layer, every event is applied to it at once
+    and reverted if the transaction of the parking lot fails.
+    """
+
+    def __init__(self, occupancy: OccupancyService, parking_id: int) -> None:
+        self.occupancy = occupancy
+        self.parking_id = parking_id
+        self.deltas: List[int] = []
+
+    @property
+    def state(self) -> Optional[State]:
+        return self.occupancy.get(self.parking_id)
+
+    def apply(self, delta: int) -> Optional[State]:
+        new_state = self.occupancy.counters.apply(self.parking_id, delta)
+        if new_state is not None:
+            self.deltas.append(delta)
+        return new_state
+
+    def save(self) -> None:
+        pass
+
+    def undo(self) -> None:
+        for delta in reversed(self.deltas):
+            self.occupancy.counters.apply(self.parking_id, -delta)
+        self.deltas = []
+
+
+def _apply_parking_events(
+    session: Session,
+    parking_id: int,
+    events: List[Tuple[int, Dict[str, Any]]],
+    cards: Dict[int, Optional[str]],
+    results: List[Optional[Dict[str, Any]]],
+    ledger: Union[_RowLedger, _CounterLedger],
+) -> Optional[Dict[str, Any]]:
+    """
+    Applying the events of one parking lot with the rules of
+    `check_in`/`check_out` to the ledger of the parking counter.
+    """
+
+    client_ids = {event["client_id"] for _index, event in events}
+    active: Dict[int, List[ClientParking]] = {}
+    for visit in session.execute(
+        select(ClientParking)
+        .where(
+            ClientParking.parking_id == parking_id,
+            ClientParking.client_id.in_(client_ids),
+            ClientParking.time_out.is_(None),
+        )
+        .order_by(ClientParking.id)
+    ).scalars():
+        active.setdefault(visit.client_id, []).append(visit)
+
+    applied: List[Tuple[int, str, ClientParking]] = []
+    for index, event in events:
+        client_id = event["client_id"]
+        if event["action"] == ARRIVAL:
+            state = ledger.state
+            if state is None or next_state(state, -1) is None:
+                results[index] = _failed("No place")
+                continue
+            if client_id not in cards:
+                results[index] = _failed("Not found")
+                continue
+            if not cards[client_id]:
+                results[index] = _failed("Link the card to your account")
+                continue
+            if ledger.apply(-1) is None:
+                results[index] = _failed("No place")
+                continue
+            visit = ClientParking(
+                client_id=client_id, parking_id=parking_id, time_in=event["time"]
+            )
+            session.add(visit)
+            active.setdefault(client_id, []).append(visit)
+            applied.append((index, ARRIVAL, visit))
+        else:
+            if not active.get(client_id):
+                results[index] = _failed("Not available")
+                continue
+            visit = active[client_id][-1]
+            if not visit.time_in:
+                results[index] = _failed("The client did not enter the parking lot")
+                continue
+            if event["time"] < visit.time_in:
+                results[index] = _failed("The departure precedes the arrival", 400)
+                continue
+            visit.time_out = event["time"]
+            active[client_id].pop()
+            ledger.apply(1)
+            applied.append((index, DEPARTURE, visit))
+
+    if applied:
+        ledger.save()
+        session.flush()
+        departures = [
+            {
+                "id": visit.id,
+                "client_id": visit.client_id,
+                "parking_id": visit.parking_id,
+                "time_in": visit.time_in,
+                "time_out": visit.time_out,
+            }
+            for _index, action, visit in applied
+            if action == DEPARTURE
+        ]
+        payments = iter(bill_visits(departures, session))
+        for index, action, visit in applied:
+            result = {"status": 201, action: visit.to_json()}
+            if action == DEPARTURE:
+                result["payment"] = next(payments)
+            results[index] = result
+    state = ledger.state
+    if state is None:
+        return None
+    available, opened = state
+    return {
+        "id": parking_id,
+        "opened": opened,
+        "count_available_places": available,
+    }
+
+
+def _ledger(
+    session: Session, parking_id: int, occupancy: Optional[OccupancyService]
+) -> Union[_RowLedger, _CounterLedger, None]:
+    if occupancy is not None:
+        if occupancy.get(parking_id) is None:
+            return None
+        return _CounterLedger(occupancy, parking_id)
+    parking = session.execute(
+        select(Parking.opened, Parking.count_available_places)
+        .where(Parking.id == parking_id)
+        .with_for_update()
+    ).one_or_none()
+    if parking is None:
+        return None
+    return _RowLedger(
+        session, parking_id, (parking.count_available_places, bool(parking.opened))
+    )
+
+
+def apply_events(
+    events: List[Dict[str, Any]],
+    occupancy: Optional[OccupancyService] = None,
+    session: Optional[Session] = None,
+) -> Dict[str, Any]:
+    """Batch of arrivals and departures replayed by the gate controllers.
+
+    Events are grouped by parking, every parking is processed and committed
+    in its own transaction with one aggregated counter UPDATE (the parking
+    row is locked `FOR UPDATE`) or with the occupancy counters if they are
+    enabled. The order of the events inside a parking is kept. Returns the result of every event
+    in the order of the request and the final state of the parking lots.
+    """
+
+    session = get_session(session)
+    results: List[Optional[Dict[str, Any]]] = [None] * len(events)
+    by_parking: Dict[int, List[Tuple[int, Dict[str, Any]]]] = {}
+    for index, raw in enumerate(events):
+        try:
+            event = {
+                "client_id": int(raw["client_id"]),
+                "parking_id": int(raw["parking_id"]),
+                "action": raw.get("action", ARRIVAL),
+                "time": _event_time(raw),
+            }
+        except (KeyError, TypeError, ValueError, AttributeError):
+            results[index] = _failed("Bad request", 400)
+            continue
+        if event["action"] not in (ARRIVAL, DEPARTURE):
+            results[index] = _failed("Bad request", 400)
+            continue
+        by_parking.setdefault(event["parking_id"], []).append((index, event))
+
+    client_ids = {
+        event["client_id"] for group in by_parking.values() for _i, event in group
+    }
+    cards: Dict[int, Optional[str]] = {
+        row.id: row.credit_card
+        for row in session.execute(
+            select(Client.id, Client.credit_card).where(Client.id.in_(client_ids))
+        )
+    }
+
+    states = []
+    for parking_id, group in by_parking.items():
+        ledger = _ledger(session, parking_id, occupancy)
+        if ledger is None:
+            for index, _event in group:
+                results[index] = _failed("Not found")
+            session.rollback()
+            continue
+        try:
+            state = _apply_parking_events(
+                session, parking_id, group, cards, results, ledger
+            )
+            session.commit()
+        except Exception:
+            session.rollback()
+            ledger.undo()
+            raise
+        if state is not None:
+            states.append(state)
+    return {"results": results, "parkings": states}
@@ -0,0 +1,246 @@
+import contextlib
+import datetime
+import hashlib
+import threading
+import time
+from typing import Callable, Iterator, NamedTuple, Optional, Tuple, cast
+
+from sqlalchemy import Table, delete, event, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, scoped_session
+
+from .cache import LRUCache
+from .models import IdempotencyKey, get_session
+
+keys = cast(Table, IdempotencyKey.__table__)
+
+# outcomes of `IdempotencyStore.reserve`
+NEW = "new"
+REPLAY = "replay"
+BUSY = "busy"
+MISMATCH = "mismatch"
+LOST = "lost"
+
+# the status of a key whose request committed its write, before the response
+# is stored
+WRITTEN = 0
+
+PURGE_BATCH_SIZE = 1000
+
+
+class StoredResponse(NamedTuple):
+    fingerprint: str
+    status: int
+    body: bytes
+    mimetype: Optional[str]
+
+
+def idempotency_key(method: str, path: str, key: str) -> str:
+    """The key of the store: the key of the client scoped to the route"""
+
+    return hashlib.sha256(f"{method} {path}\n{key}".encode()).hexdigest()
+
+
+def fingerprint(body: bytes) -> str:
+    return hashlib.sha256(body).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    Ответы завершённых запросов с ключом идемпотентности.
+
+    The table `idempotency_keys` is shared by the workers, the responses read
+    or written by this process are also kept in an LRU cache of `cache_size`
+    entries. A key is reserved by the first request (a row without
+    response) for `lock_timeout` seconds: a retry that comes in the meantime
+    is told to wait, the reservation of a crashed request expires.
+    A response is kept `ttl` seconds, the expired rows are deleted by the
+    requests at most every `purge_interval` seconds.
+
+    The response is stored after the commit of the view, so the commit also
+    marks the key WRITTEN in its own transaction (`writing`): a retry never
+    runs a committed write again, even if the worker died before storing
+    the response (LOST).
+    """
+
+    def __init__(
+        self,
+        ttl: float = 86400.0,
+        cache_size: int = 10000,
+        lock_timeout: float = 30.0,
+        purge_interval: float = 300.0,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.purge_interval = purge_interval
+        self.cache = LRUCache(cache_size)
+        self._clock = clock
+        self._purged = clock()
+        self._purge_lock = threading.Lock()
+
+    def _now(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self._clock())
+
+    def _cached(self, key: str) -> Optional[StoredResponse]:
+        entry = self.cache.get(key)
+        if entry is None or entry[0] <= self._clock():
+            return None
+        return cast(StoredResponse, entry[1])
+
+    def _remember(self, key: str, stored: StoredResponse) -> None:
+        self.cache.set(key, (self._clock() + self.ttl, stored))
+
+    def reserve(
+        self, key: str, digest: str, session: Optional[Session] = None
+    ) -> Tuple[str, Optional[StoredResponse]]:
+        """
+        NEW: the key is reserved for this request, REPLAY with the stored
+        response, BUSY: the first request is not finished, MISMATCH: the key
+        was used with another body, LOST: the write of the first request
+        committed but its response was not stored.
+        """
+
+        cached = self._cached(key)
+        if cached is not None:
+            return (
+                (REPLAY, cached) if cached.fingerprint == digest else (MISMATCH, None)
+            )
+
+        session = get_session(session)
+        self._purge(session)
+        now = self._now()
+        lease = now + datetime.timedelta(seconds=self.lock_timeout)
+        try:
+            with session.begin_nested():
+                session.execute(
+                    insert(keys).values(
+                        key=key, fingerprint=digest, created_at=now, expires_at=lease
+                    )
+                )
+            session.commit()
+            return NEW, None
+        except IntegrityError:
+            session.rollback()
+
+        row = session.execute(select(keys).where(keys.c.key == key)).one_or_none()
+        if row is None:
+            return BUSY, None
+        if row.expires_at <= now:
+            # an expired response or the reservation of a crashed request
+            taken = session.execute(
+                update(keys)
+                .where(keys.c.key == key, keys.c.expires_at == row.expires_at)
+                .values(
+                    fingerprint=digest,
+                    status=None,
+                    body=None,
+                    mimetype=None,
+                    created_at=now,
+                    expires_at=lease,
+                )
+            ).rowcount
+            session.commit()
+            return (NEW, None) if taken else (BUSY, None)
+        session.commit()
+        if row.fingerprint != digest:
+            return MISMATCH, None
+        if row.status is None:
+            return BUSY, None
+        if row.status == WRITTEN:
+            lease = row.created_at + datetime.timedelta(seconds=self.lock_timeout)
+            return (BUSY, None) if lease > now else (LOST, None)
+        stored = StoredResponse(row.fingerprint, row.status, row.body, row.mimetype)
+        self._remember(key, stored)
+        return REPLAY, stored
+
+    @contextlib.contextmanager
+    def writing(self, key: str, session: Optional[Session] = None) -> Iterator[None]:
+        """
+        Marking `key` WRITTEN (and keeping it `ttl` seconds) in every
+        transaction committed by the session in the block: the view of the
+        request that reserved the key runs in it.
+
+        The listener is one of the session of this request: a listener of
+        the scoped session would be one of its class and would mark the key
+        on the commits of all the threads.
+        """
+
+        session = get_session(session)
+        if isinstance(session, scoped_session):
+            session = session()
+
+        def mark(session: Session) -> None:
+            session.execute(
+                update(keys)
+                .where(keys.c.key == key, keys.c.status.is_(None))
+                .values(
+                    status=WRITTEN,
+                    expires_at=self._now() + datetime.timedelta(seconds=self.ttl),
+                )
+            )
+
+        event.listen(session, "before_commit", mark)
+        try:
+            yield
+        finally:
+            event.remove(session, "before_commit", mark)
+
+    def complete(
+        self, key: str, stored: StoredResponse, session: Optional[Session] = None
+    ) -> None:
+        """Storing the response of the request that reserved the key"""
+
+        session = get_session(session)
+        session.execute(
+            update(keys)
+            .where(keys.c.key == key)
+            .values(
+                status=stored.status,
+                body=stored.body,
+                mimetype=stored.mimetype,
+                expires_at=self._now() + datetime.timedelta(seconds=self.ttl),
+            )
+        )
+        session.commit()
+        self._remember(key, stored)
+
+    def release(self, key: str, session: Optional[Session] = None) -> None:
+        """
+        Dropping the reservation of a failed request, a retry runs again. The
+        key of a request that committed its write is kept.
+        """
+
+        session = get_session(session)
+        session.rollback()
+        session.execute(delete(keys).where(keys.c.key == key, keys.c.status.is_(None)))
+        session.commit()
+
+    def _purge(self, session: Session) -> None:
+        if self._clock() - self._purged < self.purge_interval:
+            return
+        if not self._purge_lock.acquire(blocking=False):
+            return
+        try:
+            self._purged = self._clock()
+            expired = (
+                select(keys.c.key)
+                .where(keys.c.expires_at < self._now())
+                .limit(PURGE_BATCH_SIZE)
+            )
+            session.execute(delete(keys).where(keys.c.key.in_(expired)))
+            session.commit()
+        finally:
+            self._purge_lock.release()
+
+
+def create_idempotency(config) -> Optional[IdempotencyStore]:
+    """Хранилище ответов, если IDEMPOTENCY_TTL не 0"""
+
+    if not config.get("IDEMPOTENCY_TTL"):
+        return None
+    return IdempotencyStore(
+        ttl=config["IDEMPOTENCY_TTL"],
+        cache_size=config["IDEMPOTENCY_CACHE_SIZE"],
+        lock_timeout=config["IDEMPOTENCY_LOCK_TIMEOUT"],
+    )
@@ -0,0 +1,300 @@
+import math
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Callable, NamedTuple, Optional, Tuple, Union
+
+from .engine import pool_wait
+from .shm import SharedSegment, segment_name
+
+# priorities of the requests, the first one is shed last
+GATE = "gate"
+WRITE = "write"
+READ = "read"
+# a live feed (SSE, long poll): limited as a read, not counted in flight
+STREAM = "stream"
+
+# tokens and times are stored as integer micro-units
+MICRO = 1_000_000
+
+
+class Refusal(NamedTuple):
+    status: int
+    retry_after: int
+
+
+def _refill(
+    tokens: float, updated: float, rate: float, burst: float, now: float
+) -> Tuple[float, float]:
+    """The tokens after the refill and the seconds to wait for a token (0)"""
+
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryBuckets:
+    """
+    Корзины токенов клиентов в памяти процесса (один процесс).
+
+    The `capacity` most recently seen clients are kept, a forgotten client
+    starts again with a full bucket.
+    """
+
+    def __init__(self, capacity: int = 65536) -> None:
+        self.capacity = capacity
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: float, now: float) -> float:
+        """Taking a token of `key`: 0 or the seconds to wait for one"""
+
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens, wait = _refill(tokens, updated, rate, burst, now)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.capacity:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class SharedBuckets(SharedSegment):
+    """
+    Корзины токенов клиентов в разделяемой памяти, общие для всех воркеров
+    gunicorn на одной машине.
+
+    A key is hashed to one of `capacity` slots (tokens, time of the last
+    take), the clients of a collision share their bucket. The time is the
+    monotonic clock of the system, the same in every process.
+    """
+
+    FIELDS = 2
+
+    def __init__(self, name: str, capacity: int = 65536) -> None:
+        self.name = name
+        self.capacity = capacity
+        super().__init__(name, capacity * self.FIELDS)
+        self._slots = self.slots
+
+    def take(self, key: str, rate: float, burst: float, now: float) -> float:
+        offset = zlib.crc32(key.encode()) % self.capacity * self.FIELDS
+        with self.locked():
+            updated = self._slots[offset + 1]
+            if updated:
+                tokens = self._slots[offset] / MICRO
+                tokens, wait = _refill(tokens, updated / MICRO, rate, burst, now)
+            else:
+                tokens, wait = burst - 1, 0.0
+            self._slots[offset] = int(tokens * MICRO)
+            self._slots[offset + 1] = max(1, int(now * MICRO))
+        return wait
+
+
+class MemoryInflight:
+    """Запросы в обработке в этом процессе"""
+
+    def __init__(self) -> None:
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def total(self) -> int:
+        return self._count
+
+    def processes(self) -> int:
+        return 1
+
+    def add(self, delta: int) -> None:
+        with self._lock:
+            self._count += delta
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedInflight(SharedSegment):
+    """
+    Запросы в обработке всех воркеров gunicorn на одной машине.
+
+    Every process counts its requests in its own slot (pid, count) of the
+    segment, the total is the sum of the slots. A slot is taken at the first
+    request of the process, the slots of the dead processes (a killed
+    worker) are freed then.
+    """
+
+    FIELDS = 2
+
+    def __init__(self, name: str, capacity: int = 1024) -> None:
+        self.name = name
+        self.capacity = capacity
+        super().__init__(name, capacity * self.FIELDS)
+        self._slots = self.slots
+        self._owner = 0
+        self._offset = 0
+        self._slot_lock = threading.Lock()
+
+    def _claim(self) -> int:
+        pid = os.getpid()
+        free = None
+        with self.locked():
+            for offset in range(0, self.capacity * self.FIELDS, self.FIELDS):
+                owner = self._slots[offset]
+                if owner and owner != pid and not _alive(owner):
+                    self._slots[offset] = self._slots[offset + 1] = 0
+                    owner = 0
+                if owner == pid or (not owner and free is None):
+                    free = offset
+            if free is None:
+                raise RuntimeError(f"No free slot in {self.name}")
+            if self._slots[free] != pid:
+                self._slots[free], self._slots[free + 1] = pid, 0
+        self._owner, self._offset = pid, free
+        return free
+
+    def total(self) -> int:
+        slots = self._slots
+        return sum(slots[offset + 1] for offset in range(0, len(slots), self.FIELDS))
+
+    def processes(self) -> int:
+        """The processes with a slot, the limits in flight are per process"""
+
+        slots = self._slots
+        owners = range(0, len(slots), self.FIELDS)
+        return max(1, sum(1 for offset in owners if slots[offset]))
+
+    def add(self, delta: int) -> None:
+        # only this process writes its slot
+        with self._slot_lock:
+            offset = self._offset if self._owner == os.getpid() else self._claim()
+            self._slots[offset + 1] += delta
+
+
+Buckets = Union[MemoryBuckets, SharedBuckets]
+Inflight = Union[MemoryInflight, SharedInflight]
+
+
+class Limiter:
+    """
+    Ограничение частоты запросов клиентов и сброс нагрузки по приоритетам.
+
+    Rate limiting: every client (address and priority) has a token bucket
+    of `burst` requests refilled with `rate` requests per second (0 - no
+    limit), an empty bucket is answered 429 with the seconds until the next
+    token. The gates are never limited: a barrier must open.
+
+    Load shedding: the reads are refused (503) while `read_inflight`
+    requests per process are in flight (the average of the workers with
+    the shared store) or
+    while the average wait for a connection of the pool (`pool_wait`,
+    seconds) is above `max_pool_wait`; the other writes at `write_inflight`
+    requests or twice the wait. The gates are always admitted, the
+    refused reads keep the workers and the connections free for them.
+
+    A live feed holds its thread for minutes while waiting for the changes,
+    not a connection: it takes the tokens of the reads and is refused on
+    the wait for a connection, it is not counted in flight. The number of
+    the subscribers is bounded by the feed (`live.AvailabilityFeed.join`).
+    """
+
+    def __init__(
+        self,
+        buckets: Buckets,
+        inflight: Inflight,
+        pool_wait: Callable[[], float],
+        read_rate: float = 0.0,
+        read_burst: float = 1.0,
+        write_rate: float = 0.0,
+        write_burst: float = 1.0,
+        read_inflight: int = 0,
+        write_inflight: int = 0,
+        max_pool_wait: float = 0.0,
+        retry_after: int = 1,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.buckets = buckets
+        self.inflight = inflight
+        self.pool_wait = pool_wait
+        self.rates = {READ: (read_rate, read_burst), WRITE: (write_rate, write_burst)}
+        self.read_inflight = read_inflight
+        self.write_inflight = write_inflight
+        self.max_pool_wait = max_pool_wait
+        self.retry_after = retry_after
+        self._clock = clock
+
+    def _shed(self, priority: str) -> bool:
+        if priority == GATE:
+            return False
+        if priority == STREAM:
+            return bool(self.max_pool_wait) and self.pool_wait() > self.max_pool_wait
+        limit, factor = (
+            (self.read_inflight, 1) if priority == READ else (self.write_inflight, 2)
+        )
+        if limit and self.inflight.total() >= limit * self.inflight.processes():
+            return True
+        return bool(self.max_pool_wait) and (
+            self.pool_wait() > self.max_pool_wait * factor
+        )
+
+    def admit(self, client: str, priority: str) -> Optional[Refusal]:
+        """
+        None: the request is admitted and counted in flight until `done()`
+        (a STREAM is not), or the refusal.
+        """
+
+        bucket = READ if priority == STREAM else priority
+        rate, burst = self.rates.get(bucket, (0.0, 0.0))
+        if rate:
+            wait = self.buckets.take(f"{bucket}:{client}", rate, burst, self._clock())
+            if wait:
+                return Refusal(429, math.ceil(wait))
+        if self._shed(priority):
+            return Refusal(503, self.retry_after)
+        if priority != STREAM:
+            self.inflight.add(1)
+        return None
+
+    def done(self) -> None:
+        self.inflight.add(-1)
+
+
+def create_limiter(config) -> Optional[Limiter]:
+    """
+    Ограничитель по настройке LIMITS_BACKEND: "" (выключен), "memory" (один
+    процесс) или "shared" (несколько воркеров на одной машине).
+    """
+
+    backend = config.get("LIMITS_BACKEND")
+    if not backend:
+        return None
+    buckets: Buckets
+    inflight: Inflight
+    if backend == "memory":
+        buckets, inflight = MemoryBuckets(), MemoryInflight()
+    elif backend == "shared":
+        name = segment_name(config, "limits")
+        buckets = SharedBuckets(f"{name}_buckets")
+        inflight = SharedInflight(f"{name}_inflight")
+    else:
+        raise ValueError(f"Unknown LIMITS_BACKEND: {backend}")
+    return Limiter(
+        buckets,
+        inflight,
+        lambda: pool_wait.value,
+        read_rate=config["RATE_LIMIT_READ_RATE"],
+        read_burst=config["RATE_LIMIT_READ_BURST"],
+        write_rate=config["RATE_LIMIT_WRITE_RATE"],
+        write_burst=config["RATE_LIMIT_WRITE_BURST"],
+        read_inflight=config["SHED_READ_INFLIGHT"],
+        write_inflight=config["SHED_WRITE_INFLIGHT"],
+        max_pool_wait=config["SHED_POOL_WAIT_MS"] / 1000,
+        retry_after=config["SHED_RETRY_AFTER"],
+    )
@@ -0,0 +1,69 @@
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+from .models import db
+from .serializers import RowEncoder
+
+STREAM_CHUNK_SIZE = 1000
+
+
+def keyset_page(
+    model: Any,
+    after: int = 0,
+    limit: Optional[int] = 100,
+    where: Sequence[Any] = (),
+) -> List[Dict[str, Any]]:
+    """
+    Одна страница списка по ключу `id`: записи с `id > after` по возрастанию `id`
+    (все записи при `limit=None`), `where` - условия фильтра
+    """
+
+    encoder: RowEncoder = model._encoder
+    query = encoder.select().where(model.id > after, *where).order_by(model.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return encoder.from_rows(db.session.execute(query))
+
+
+def keyset_stream(
+    model: Any,
+    after: int = 0,
+    limit: Optional[int] = None,
+    chunk_size: int = STREAM_CHUNK_SIZE,
+    where: Sequence[Any] = (),
+) -> Iterator[Dict[str, Any]]:
+    """
+    Потоковое чтение таблицы порциями `chunk_size` (server side cursor на Postgres),
+    в памяти находится не более одной порции.
+    """
+
+    encoder = model._encoder
+    query = encoder.select().where(model.id > after, *where).order_by(model.id)
+    if limit is not None:
+        query = query.limit(limit)
+    result = db.session.execute(query.execution_options(yield_per=chunk_size))
+    for partition in result.partitions():
+        yield from encoder.from_rows(partition)
+
+
+def stream_json(
+    key: str,
+    rows: Iterator[Dict[str, Any]],
+    dumps: Callable[[Any], str],
+    chunk_size: int = STREAM_CHUNK_SIZE,
+) -> Iterator[str]:
+    """
+    Генератор JSON документа `{"<key>": [...]}`, отдаётся клиенту порциями
+    """
+
+    yield '{"%s": [' % key
+    chunk: List[str] = []
+    separator = ""
+    for row in rows:
+        chunk.append(dumps(row))
+        if len(chunk) >= chunk_size:
+            yield separator + ", ".join(chunk)
+            separator = ", "
+            chunk = []
+    if chunk:
+        yield separator + ", ".join(chunk)
+    yield "]}"
@@ -0,0 +1,345 @@
+import json
+import logging
+import secrets
+import select as select_module
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterator, List, Mapping, Optional, Tuple
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+
+from .serializers import dumps
+from .shm import renew_after_fork
+
+logger = logging.getLogger(__name__)
+
+# {"id": 1, "count_available_places": 7, "opened": True}
+Delta = Dict[str, Any]
+Snapshot = Callable[[], List[Delta]]
+
+CHANNEL = "parking_availability"
+# NOTIFY payloads are limited to 8000 bytes
+NOTIFY_CHUNK = 50
+
+
+def availability(parking: Mapping[Any, Any]) -> Delta:
+    """
+    The delta of a parking lot: only the fields changed by the gates
+    """
+
+    return {
+        "id": parking["id"],
+        "count_available_places": parking["count_available_places"],
+        "opened": bool(parking["opened"]),
+    }
+
+
+class AvailabilityFeed:
+    """
+    Лента изменений свободных мест парковок для подписчиков (SSE, long-poll).
+
+    One publisher fans out to any number of subscribers: the deltas are kept
+    in a ring buffer of `size` events numbered by a sequence, a subscriber
+    only holds its cursor ("<epoch>-<sequence>") and waits on one condition.
+    The changes since a cursor are coalesced per parking lot (the latest
+    state wins). A cursor of another epoch (another worker, a restart,
+    a lost notification) or one that fell out of the buffer needs a snapshot.
+
+    A subscriber holds a thread of the worker while it waits: at most
+    `max_streams` subscribers per process and `max_client_streams` per
+    client are admitted (`join`), the others are refused (0 - no limit).
+
+    With the "postgres" backend the write paths send the deltas with
+    `NOTIFY` in their transaction and every worker publishes the
+    notifications received by its `LISTEN` thread: a connection of the
+    engine of the app or of `listen_url`, a direct one when the app is
+    behind a PgBouncer in transaction mode.
+    """
+
+    def __init__(
+        self,
+        channel: Optional[str] = None,
+        size: int = 1024,
+        max_streams: int = 0,
+        max_client_streams: int = 0,
+        listen_url: Optional[str] = None,
+    ) -> None:
+        self.channel = channel
+        self.listen_url = listen_url
+        self.max_streams = max_streams
+        self.max_client_streams = max_client_streams
+        self._subscribers: Dict[str, int] = {}
+        self._subscribers_lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._events: Deque[Tuple[int, Delta]] = deque(maxlen=size)
+        self._epoch = secrets.randbits(32)
+        self._sequence = 0
+        self._lock = threading.Lock()
+        renew_after_fork(self)
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._snapshot: Optional[Tuple[str, List[Delta]]] = None
+
+    @property
+    def cursor(self) -> str:
+        return f"{self._epoch:x}-{self._sequence}"
+
+    # =======================================================================
+    # =                     Publisher                                       =
+    # =======================================================================
+
+    def notify(self, session: Session, deltas: Optional[List[Delta]]) -> None:
+        """
+        Sending the deltas (None: a reset) to the other workers with `NOTIFY`,
+        before the commit of `session`. Nothing to do in one process.
+        """
+
+        if self.channel is None:
+            return
+        if deltas is None:
+            payloads = [dumps(None)]
+        else:
+            payloads = []
+            for start in range(0, len(deltas), NOTIFY_CHUNK):
+                end = start + NOTIFY_CHUNK
+                payloads.append(dumps(deltas[start:end]))
+        for payload in payloads:
+            session.execute(select(func.pg_notify(self.channel, payload)))
+
+    def committed(self, deltas: Optional[List[Delta]]) -> None:
+        """
+        Publishing the deltas after the commit, the notifications of the
+        "postgres" backend are published by the `LISTEN` thread instead.
+        """
+
+        if self.channel is None:
+            self.publish(deltas)
+
+    def publish(self, deltas: Optional[List[Delta]]) -> None:
+        """Fan out of the deltas (None: a reset) to the subscribers"""
+
+        with self._condition:
+            if deltas is None:
+                self._reset()
+            else:
+                for delta in deltas:
+                    self._sequence += 1
+                    self._events.append((self._sequence, delta))
+            self._condition.notify_all()
+
+    def reset(self) -> None:
+        """All subscribers need a snapshot, e.g. after a lost notification"""
+
+        with self._condition:
+            self._reset()
+            self._condition.notify_all()
+
+    def renew(self) -> None:
+        """A new epoch in a forked worker: the cursors of the master never match"""
+
+        self._condition = threading.Condition()
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._subscribers_lock = threading.Lock()
+        # the LISTEN thread of the master is not in the worker
+        self._thread = None
+        self._stop = threading.Event()
+        self._reset()
+
+    def _reset(self) -> None:
+        self._epoch = secrets.randbits(32)
+        self._sequence = 0
+        self._events.clear()
+
+    # =======================================================================
+    # =                     Subscribers                                     =
+    # =======================================================================
+
+    def join(self, client: str) -> bool:
+        """Admitting a subscriber of `client`, False: the feed is full"""
+
+        with self._subscribers_lock:
+            count = self._subscribers.get(client, 0)
+            if self.max_client_streams and count >= self.max_client_streams:
+                return False
+            if self.max_streams and self.subscribers() >= self.max_streams:
+                return False
+            self._subscribers[client] = count + 1
+        return True
+
+    def leave(self, client: str) -> None:
+        with self._subscribers_lock:
+            count = self._subscribers.pop(client, 0) - 1
+            if count > 0:
+                self._subscribers[client] = count
+
+    def subscribers(self) -> int:
+        return sum(self._subscribers.values())
+
+    def _position(self, cursor: Optional[str]) -> Optional[int]:
+        try:
+            epoch, sequence = cursor.split("-")  # type: ignore[union-attr]
+            epoch_value, position = int(epoch, 16), int(sequence)
+        except (AttributeError, ValueError):
+            return None
+        oldest = self._events[0][0] if self._events else self._sequence + 1
+        if epoch_value != self._epoch or not oldest - 1 <= position <= self._sequence:
+            return None
+        return position
+
+    def wait(
+        self, cursor: Optional[str], timeout: float
+    ) -> Tuple[Optional[List[Delta]], str]:
+        """
+        The changes since `cursor` and the new cursor, waits up to `timeout`
+        seconds for a change. None instead of the changes: a snapshot is needed.
+        """
+
+        with self._condition:
+            position = self._position(cursor)
+            if position is not None:
+                self._condition.wait_for(
+                    lambda: self._position(cursor) != self._sequence, timeout
+                )
+                position = self._position(cursor)
+            if position is None:
+                return None, self.cursor
+            changes: Dict[Any, Delta] = {}
+            for sequence, delta in self._events:
+                if sequence > position:
+                    changes[delta["id"]] = delta
+            return list(changes.values()), self.cursor
+
+    def snapshot(self, loader: Snapshot) -> Tuple[List[Delta], str]:
+        """
+        All the parking lots and the cursor taken before they were read.
+        The snapshot is shared by the subscribers until the next change.
+        """
+
+        cursor = self.cursor
+        cached = self._snapshot
+        if cached is not None and cached[0] == cursor:
+            return cached[1], cursor
+        parkings = loader()
+        self._snapshot = (cursor, parkings)
+        return parkings, cursor
+
+    def stream(
+        self,
+        cursor: Optional[str],
+        snapshot: Snapshot,
+        timeout: float,
+        heartbeat: float = 15,
+    ) -> Iterator[str]:
+        """
+        Server-sent events: a "snapshot" event of all the parking lots if
+        the cursor is unknown, then "delta" events and a heartbeat comment,
+        for `timeout` seconds (the client reconnects with `Last-Event-ID`).
+        """
+
+        yield "retry: 3000\n\n"
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            changes, cursor = self.wait(cursor, min(heartbeat, remaining))
+            if changes is None:
+                parkings, cursor = self.snapshot(snapshot)
+                yield sse_event("snapshot", {"parkings": parkings}, cursor)
+            elif changes:
+                yield sse_event("delta", {"parkings": changes}, cursor)
+            else:
+                yield ": heartbeat\n\n"
+
+    # =======================================================================
+    # =                     LISTEN thread                                   =
+    # =======================================================================
+
+    def start(self, engine: Engine) -> None:
+        """Starting the `LISTEN` thread of the "postgres" backend, once per process"""
+
+        if self.channel is None or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                if self.listen_url:
+                    engine = create_engine(self.listen_url, poolclass=NullPool)
+                self._thread = threading.Thread(
+                    target=self._listen,
+                    args=(engine,),
+                    name="parking-listen",
+                    daemon=True,
+                )
+                self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _listen(self, engine: Engine) -> None:
+        while not self._stop.is_set():
+            connection = None
+            try:
+                connection = engine.raw_connection()
+                connection.detach()
+                driver = connection.driver_connection
+                driver.autocommit = True  # type: ignore[union-attr]
+                cursor = driver.cursor()  # type: ignore[union-attr]
+                cursor.execute(f"LISTEN {self.channel}")
+                # the notifications sent while the thread was not listening
+                # are lost, the subscribers take a snapshot
+                self.reset()
+                while not self._stop.is_set():
+                    if select_module.select([driver], [], [], 5) == ([], [], []):
+                        continue
+                    driver.poll()  # type: ignore[union-attr]
+                    while driver.notifies:  # type: ignore[union-attr]
+                        notice = driver.notifies.pop(0)  # type: ignore[union-attr]
+                        self.publish(json.loads(notice.payload))
+            except Exception:
+                logger.exception("The LISTEN connection of the parking feed failed")
+                self._stop.wait(1)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+
+def sse_event(event: str, data: Any, event_id: str) -> str:
+    return f"id: {event_id}\nevent: {event}\ndata: {dumps(data)}\n\n"
+
+
+def create_feed(config, dialect: str, pgbouncer: bool = False) -> AvailabilityFeed:
+    """
+    Лента по настройке LIVE_BACKEND: "memory" (один процесс), "postgres"
+    (LISTEN/NOTIFY между воркерами) или "" ("postgres" на Postgres).
+
+    Behind a PgBouncer in transaction mode a LISTEN of a pooled connection
+    would never get the notifications: LIVE_LISTEN_URL is required then.
+    """
+
+    backend = config.get("LIVE_BACKEND") or (
+        "postgres" if dialect == "postgresql" else "memory"
+    )
+    limits = {
+        "max_streams": config.get("LIVE_MAX_STREAMS", 0),
+        "max_client_streams": config.get("LIVE_MAX_CLIENT_STREAMS", 0),
+    }
+    if backend == "memory":
+        return AvailabilityFeed(**limits)
+    if backend == "postgres":
+        listen_url = config.get("LIVE_LISTEN_URL") or None
+        if pgbouncer and listen_url is None:
+            raise ValueError(
+                "The postgres LIVE_BACKEND behind PgBouncer needs LIVE_LISTEN_URL"
+                " (a direct connection) or LIVE_BACKEND=memory"
+            )
+        return AvailabilityFeed(
+            channel=config.get("LIVE_CHANNEL") or CHANNEL,
+            listen_url=listen_url,
+            **limits,
+        )
+    raise ValueError(f"Unknown LIVE_BACKEND: {backend}")
@@ -0,0 +1,275 @@
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, List, Optional, Sequence, Union
+
+from flask import Flask, request, request_finished, request_started
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .shm import SharedSegment, segment_name
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+STATUSES = ("1xx", "2xx", "3xx", "4xx", "5xx")
+OTHER = "other"
+
+# seconds are stored as integer microseconds
+MICRO = 1_000_000
+
+
+class RequestStats:
+    """SQL statements of one request"""
+
+    __slots__ = ("started", "queries", "db_time", "slowest")
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.slowest = 0.0
+
+
+_current: ContextVar[Optional[RequestStats]] = ContextVar("parking_request_stats")
+
+
+class _Layout:
+    """
+    Slots of one endpoint: requests per status class, the histograms
+    (buckets + infinity, sum) of the duration, the statements and the time
+    in the database, the slowest statement.
+    """
+
+    def __init__(self) -> None:
+        self.statuses = 0
+        self.duration = self.statuses + len(STATUSES)
+        self.queries = self.duration + len(DURATION_BUCKETS) + 2
+        self.db_time = self.queries + len(QUERY_BUCKETS) + 2
+        self.slowest = self.db_time + len(DURATION_BUCKETS) + 2
+        self.size = self.slowest + 1
+
+
+LAYOUT = _Layout()
+
+
+def _bucket(buckets: Sequence[float], value: float) -> int:
+    for index, bound in enumerate(buckets):
+        if value <= bound:
+            return index
+    return len(buckets)
+
+
+class MemoryStore:
+    """Слоты метрик в памяти процесса"""
+
+    def __init__(self, size: int) -> None:
+        self.slots: Union[List[int], memoryview] = [0] * size
+        self._lock = threading.Lock()
+
+    def locked(self) -> threading.Lock:
+        return self._lock
+
+
+class SharedStore(SharedSegment):
+    """
+    Слоты метрик в разделяемой памяти: метрики всех воркеров gunicorn
+    на одной машине суммируются, любой воркер отвечает на `/metrics`.
+    """
+
+
+class Metrics:
+    """
+    Метрики запросов по эндпоинтам: длительность, число SQL запросов, время
+    в базе и самый медленный запрос. Recording a request is one lock and
+    a few integer increments, the slots of the endpoints are fixed by
+    the routes of the application (the same in every worker).
+    """
+
+    def __init__(
+        self, endpoints: Sequence[str], store: Any = None, slow_query: float = 0.2
+    ) -> None:
+        self.endpoints = sorted(set(endpoints) | {OTHER})
+        self._index = {name: i for i, name in enumerate(self.endpoints)}
+        self.store = store or MemoryStore(len(self.endpoints) * LAYOUT.size)
+        self.slow_query = slow_query
+
+    def record(self, endpoint: str, status: int, stats: RequestStats) -> float:
+        """Recording a finished request, returns its duration in seconds"""
+
+        duration = time.perf_counter() - stats.started
+        base = self._index.get(endpoint, self._index[OTHER]) * LAYOUT.size
+        status_index = min(max(status // 100 - 1, 0), len(STATUSES) - 1)
+        slots = self.store.slots
+        with self.store.locked():
+            slots[base + LAYOUT.statuses + status_index] += 1
+            for offset, buckets, value in (
+                (LAYOUT.duration, DURATION_BUCKETS, duration),
+                (LAYOUT.queries, QUERY_BUCKETS, stats.queries),
+                (LAYOUT.db_time, DURATION_BUCKETS, stats.db_time),
+            ):
+                start = base + offset
+                slots[start + _bucket(buckets, value)] += 1
+                scale = 1 if buckets is QUERY_BUCKETS else MICRO
+                slots[start + len(buckets) + 1] += int(value * scale)
+            slowest = base + LAYOUT.slowest
+            slots[slowest] = max(slots[slowest], int(stats.slowest * MICRO))
+        return duration
+
+    def render(self) -> str:
+        """Метрики в текстовом формате Prometheus"""
+
+        with self.store.locked():
+            slots = list(self.store.slots)
+        lines: List[str] = []
+        histograms = (
+            (
+                "parking_request_duration_seconds",
+                "Duration of the requests",
+                LAYOUT.duration,
+                DURATION_BUCKETS,
+                MICRO,
+            ),
+            (
+                "parking_request_queries",
+                "SQL statements per request",
+                LAYOUT.queries,
+                QUERY_BUCKETS,
+                1,
+            ),
+            (
+                "parking_request_db_seconds",
+                "Time in the database per request",
+                LAYOUT.db_time,
+                DURATION_BUCKETS,
+                MICRO,
+            ),
+        )
+
+        lines.append("# HELP parking_requests_total Requests per status class")
+        lines.append("# TYPE parking_requests_total counter")
+        for endpoint, base in self._bases():
+            for index, status in enumerate(STATUSES):
+                value = slots[base + LAYOUT.statuses + index]
+                if value:
+                    lines.append(
+                        f'parking_requests_total{{endpoint="{endpoint}",'
+                        f'status="{status}"}} {value}'
+                    )
+
+        for name, description, offset, buckets, scale in histograms:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} histogram")
+            for endpoint, base in self._bases():
+                start = base + offset
+                end = start + len(buckets) + 1
+                count = sum(slots[start:end])
+                if not count:
+                    continue
+                cumulative = 0
+                for index, bound in enumerate((*buckets, "+Inf")):
+                    cumulative += slots[start + index]
+                    lines.append(
+                        f'{name}_bucket{{endpoint="{endpoint}",le="{bound}"}} '
+                        f"{cumulative}"
+                    )
+                total = slots[start + len(buckets) + 1] / scale
+                lines.append(f'{name}_sum{{endpoint="{endpoint}"}} {total}')
+                lines.append(f'{name}_count{{endpoint="{endpoint}"}} {count}')
+
+        lines.append(
+            "# HELP parking_slowest_query_seconds Slowest SQL statement per endpoint"
+        )
+        lines.append("# TYPE parking_slowest_query_seconds gauge")
+        for endpoint, base in self._bases():
+            value = slots[base + LAYOUT.slowest]
+            if value:
+                lines.append(
+                    f'parking_slowest_query_seconds{{endpoint="{endpoint}"}} '
+                    f"{value / MICRO}"
+                )
+        return "\n".join(lines) + "\n"
+
+    def _bases(self):
+        for index, endpoint in enumerate(self.endpoints):
+            yield endpoint, index * LAYOUT.size
+
+
+# =======================================================================
+# =                     Hooks                                           =
+# =======================================================================
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and _current.get(None) is not None:
+        context._parking_started = time.perf_counter()
+
+
+def instrument(app: Flask, engines: Sequence[Engine], metrics: Metrics) -> None:
+    """
+    Counting the SQL statements of every request with the events of the
+    engines (the primary and the read replica) and recording the requests
+    with the signals of Flask, the `Server-Timing` header reports the
+    database time of the request.
+    """
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        stats = _current.get(None)
+        started = getattr(context, "_parking_started", None)
+        if stats is None or started is None:
+            return
+        elapsed = time.perf_counter() - started
+        stats.queries += 1
+        stats.db_time += elapsed
+        if elapsed > stats.slowest:
+            stats.slowest = elapsed
+        if elapsed >= metrics.slow_query:
+            logger.warning(
+                "Slow SQL statement (%.1f ms) in %s: %s",
+                elapsed * 1000,
+                request.endpoint,
+                " ".join(statement.split())[:500],
+            )
+
+    def started(sender, **extra) -> None:
+        _current.set(RequestStats())
+
+    def finished(sender, response, **extra) -> None:
+        stats = _current.get(None)
+        if stats is None:
+            return
+        _current.set(None)
+        endpoint = request.url_rule.endpoint if request.url_rule else OTHER
+        duration = metrics.record(endpoint, response.status_code, stats)
+        response.headers["Server-Timing"] = (
+            f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries", '
+            f"db-slowest;dur={stats.slowest * 1000:.1f}, "
+            f"total;dur={duration * 1000:.1f}"
+        )
+
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    request_started.connect(started, app, weak=False)
+    request_finished.connect(finished, app, weak=False)
+
+
+def create_metrics(config, endpoints: Sequence[str]) -> Optional[Metrics]:
+    """
+    Метрики по настройке METRICS_BACKEND: "" (выключены), "memory"
+    (один процесс) или "shared" (сумма воркеров на одной машине).
+    """
+
+    backend = config.get("METRICS_BACKEND")
+    slow_query = config.get("METRICS_SLOW_QUERY_MS", 200) / 1000
+    if not backend:
+        return None
+    size = (len(set(endpoints) | {OTHER})) * LAYOUT.size
+    if backend == "memory":
+        return Metrics(endpoints, MemoryStore(size), slow_query)
+    if backend == "shared":
+        store = SharedStore(segment_name(config, "metrics"), size)
+        return Metrics(endpoints, store, slow_query)
+    raise ValueError(f"Unknown METRICS_BACKEND: {backend}")
@@ -1,16 +1,66 @@
 import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, ClassVar, Dict, List, Optional, cast
 
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Boolean, ForeignKey, Integer, String, UniqueConstraint, select
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
+from sqlalchemy import (
+    DDL,
+    BigInteger,
+    Boolean,
+    Date,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    String,
+    UniqueConstraint,
+    event,
+    text,
+)
+from sqlalchemy.orm import (
+    DeclarativeBase,
+    Mapped,
+    Session,
+    mapped_column,
+    relationship,
+    validates,
+)
+
+from .replica import RoutingSession
+from .serializers import RowEncoder
 
 
 class Base(DeclarativeBase):
     pass
 
 
-db: SQLAlchemy = SQLAlchemy(model_class=Base)
+db: SQLAlchemy = SQLAlchemy(
+    model_class=Base, session_options={"class_": RoutingSession}
+)
+
+
+def get_session(session: Optional[Session] = None) -> Session:
+    """
+    The session of the request (Flask-SQLAlchemy) or the given one,
+    e.g. the sync session of an `AsyncSession.run_sync()`.
+    """
+
+    return cast(Session, db.session) if session is None else session
+
+
+# Cyrillic letters of the Russian plates and their Latin look-alikes
+PLATE_LOOKALIKES = str.maketrans("АВЕКМНОРСТУХ", "ABEKMHOPCTYX")
+
+
+def normalize_plate(value: str) -> str:
+    """
+    Номер автомобиля для поиска: без пробелов и разделителей, в верхнем
+    регистре, кириллица заменена латинскими буквами того же начертания
+    """
+
+    return "".join(
+        char for char in value.upper().translate(PLATE_LOOKALIKES) if char.isalnum()
+    )
 
 
 class Client(Base):
@@ -19,10 +69,12 @@ class Client(Base):
     """
 
     __tablename__ = "clients"
+    _encoder: ClassVar[RowEncoder]
     __table_args__ = (
         UniqueConstraint(
             "car_number",
         ),
+        Index("ix_clients_plate", "plate"),
     )
 
     id: Mapped[int] = mapped_column(primary_key=True)
@@ -30,6 +82,8 @@ class Client(Base):
     surname: Mapped[str] = mapped_column(String(50))
     credit_card: Mapped[Optional[str]] = mapped_column(String(50))
     car_number: Mapped[str] = mapped_column(String(10))
+    # normalized `car_number` (see `normalize_plate`)
+    plate: Mapped[Optional[str]] = mapped_column(String(10))
     parkings: Mapped[List["Parking"]] = relationship(
         secondary="client_parking", back_populates="clients"
     )
@@ -37,13 +91,17 @@ class Client(Base):
     def __repr__(self) -> str:
         return f"Client(name={self.name}; car_number={self.car_number})"
 
+    @validates("car_number")
+    def _set_plate(self, _key: str, car_number: str) -> str:
+        self.plate = normalize_plate(car_number)
+        return car_number
+
     def to_json(self) -> Dict[str, Any]:
-        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+        return self._encoder.from_object(self)
 
     @classmethod
     def all(cls):
-        query = db.session.execute(select(cls)).scalars().all()
-        return [client.to_json() for client in query]
+        return cls._encoder.from_rows(db.session.execute(cls._encoder.select()))
 
 
 class Parking(Base):
@@ -52,10 +110,26 @@ class Parking(Base):
     """
 
     __tablename__ = "parkings"
+    _encoder: ClassVar[RowEncoder]
     __table_args__ = (
         UniqueConstraint(
             "address",
         ),
+        Index("ix_parkings_opened_available", "opened", "count_available_places"),
+        Index("ix_parkings_location", "latitude", "longitude"),
+        # substring search (ILIKE) on Postgres, FTS5 `parkings_search` on SQLite
+        Index(
+            "ix_parkings_name_trgm",
+            "name",
+            postgresql_using="gin",
+            postgresql_ops={"name": "gin_trgm_ops"},
+        ).ddl_if(dialect="postgresql"),
+        Index(
+            "ix_parkings_address_trgm",
+            "address",
+            postgresql_using="gin",
+            postgresql_ops={"address": "gin_trgm_ops"},
+        ).ddl_if(dialect="postgresql"),
     )
 
     id: Mapped[int] = mapped_column(primary_key=True)
@@ -64,6 +138,8 @@ class Parking(Base):
     opened: Mapped[Optional[bool]] = mapped_column(Boolean, default=True)
     count_places: Mapped[int] = mapped_column(Integer)
     count_available_places: Mapped[int] = mapped_column(Integer)
+    latitude: Mapped[Optional[float]] = mapped_column(Float)
+    longitude: Mapped[Optional[float]] = mapped_column(Float)
     clients: Mapped[List["Client"]] = relationship(
         secondary="client_parking", back_populates="parkings"
     )
@@ -72,12 +148,11 @@ class Parking(Base):
         return f"Parking(address={self.address}; opened={self.opened})"
 
     def to_json(self) -> Dict[str, Any]:
-        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+        return self._encoder.from_object(self)
 
     @classmethod
     def all(cls):
-        query = db.session.execute(select(cls)).scalars().all()
-        return [parking.to_json() for parking in query]
+        return cls._encoder.from_rows(db.session.execute(cls._encoder.select()))
 
 
 class ClientParking(Base):
@@ -86,6 +161,17 @@ class ClientParking(Base):
     """
 
     __tablename__ = "client_parking"
+    _encoder: ClassVar[RowEncoder]
+    __table_args__ = (
+        Index("ix_client_parking_client_id_parking_id", "client_id", "parking_id"),
+        Index(
+            "ix_client_parking_active",
+            "client_id",
+            "parking_id",
+            postgresql_where=text("time_out IS NULL"),
+            sqlite_where=text("time_out IS NULL"),
+        ),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     client_id: Mapped[int] = mapped_column(ForeignKey("clients.id"))
@@ -97,4 +183,208 @@ class ClientParking(Base):
         return f"Client(id={self.client_id}); Parking(id={self.parking_id})"
 
     def to_json(self) -> Dict[str, Any]:
-        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+        return self._encoder.from_object(self)
+
+
+class ClientParkingArchive(Base):
+    """
+    Архив завершённых визитов `client_parking` (перенесены `archive.py`)
+    """
+
+    __tablename__ = "client_parking_archive"
+    _encoder: ClassVar[RowEncoder]
+    __table_args__ = (
+        Index(
+            "ix_client_parking_archive_parking_id_time_out", "parking_id", "time_out"
+        ),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    client_id: Mapped[int] = mapped_column(Integer)
+    parking_id: Mapped[int] = mapped_column(Integer)
+    time_in: Mapped[Optional[datetime.datetime]] = mapped_column()
+    time_out: Mapped[Optional[datetime.datetime]] = mapped_column()
+
+    def to_json(self) -> Dict[str, Any]:
+        return self._encoder.from_object(self)
+
+
+class ParkingDailyStats(Base):
+    """
+    Дневные итоги парковки: завершённые визиты, их суммарное время
+    и пиковая занятость
+    """
+
+    __tablename__ = "parking_daily_stats"
+    _encoder: ClassVar[RowEncoder]
+
+    parking_id: Mapped[int] = mapped_column(ForeignKey("parkings.id"), primary_key=True)
+    day: Mapped[datetime.date] = mapped_column(Date, primary_key=True)
+    visits: Mapped[int] = mapped_column(Integer, default=0)
+    dwell_seconds: Mapped[int] = mapped_column(BigInteger, default=0)
+    peak_occupancy: Mapped[int] = mapped_column(Integer, default=0)
+
+    def to_json(self) -> Dict[str, Any]:
+        data = self._encoder.from_object(self)
+        data["avg_dwell_seconds"] = (
+            self.dwell_seconds / self.visits if self.visits else None
+        )
+        return data
+
+
+class Tariff(Base):
+    """
+    Тариф парковки: цена минуты, потолки за час и за сутки, бесплатные минуты
+    (суммы в копейках, see `billing.py`)
+    """
+
+    __tablename__ = "tariffs"
+    _encoder: ClassVar[RowEncoder]
+
+    parking_id: Mapped[int] = mapped_column(ForeignKey("parkings.id"), primary_key=True)
+    minute_rate: Mapped[int] = mapped_column(Integer, default=0)
+    hourly_cap: Mapped[Optional[int]] = mapped_column(Integer)
+    daily_cap: Mapped[Optional[int]] = mapped_column(Integer)
+    free_minutes: Mapped[int] = mapped_column(Integer, default=0)
+    updated_at: Mapped[Optional[datetime.datetime]] = mapped_column()
+
+    def to_json(self) -> Dict[str, Any]:
+        return self._encoder.from_object(self)
+
+
+class Payment(Base):
+    """
+    Начисление за завершённый визит, `key` - ключ идемпотентности
+    ("visit:<id of client_parking>"): the checkout and the re-billing write
+    one row per visit.
+    """
+
+    __tablename__ = "payments"
+    _encoder: ClassVar[RowEncoder]
+    __table_args__ = (
+        UniqueConstraint("key"),
+        Index("ix_payments_parking_id", "parking_id"),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    key: Mapped[str] = mapped_column(String(64))
+    visit_id: Mapped[int] = mapped_column(Integer)
+    client_id: Mapped[int] = mapped_column(Integer)
+    parking_id: Mapped[int] = mapped_column(Integer)
+    minutes: Mapped[int] = mapped_column(Integer)
+    amount: Mapped[int] = mapped_column(Integer)
+    billed_at: Mapped[datetime.datetime] = mapped_column()
+
+    def to_json(self) -> Dict[str, Any]:
+        return self._encoder.from_object(self)
+
+
+class PaymentOutbox(Base):
+    """
+    Очередь списаний с карты клиента (transactional outbox): the row is
+    written in the transaction of the departure and captured later by the
+    workers of `payments.py`.
+    """
+
+    __tablename__ = "payment_outbox"
+    _encoder: ClassVar[RowEncoder]
+    __table_args__ = (
+        UniqueConstraint("key"),
+        Index("ix_payment_outbox_status_next_attempt_at", "status", "next_attempt_at"),
+        Index("ix_payment_outbox_payment_key", "payment_key"),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    key: Mapped[str] = mapped_column(String(64))
+    # the key of the payment: a capture of it is keyed by it, its adjustments
+    # after a re-billing by "<payment_key>:<n>"
+    payment_key: Mapped[Optional[str]] = mapped_column(String(64))
+    client_id: Mapped[int] = mapped_column(Integer)
+    # negative for a refund
+    amount: Mapped[int] = mapped_column(Integer)
+    status: Mapped[str] = mapped_column(String(16), default="pending")
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    next_attempt_at: Mapped[datetime.datetime] = mapped_column()
+    # the token of the batch that holds the row until next_attempt_at
+    claim: Mapped[Optional[str]] = mapped_column(String(32))
+    reference: Mapped[Optional[str]] = mapped_column(String(64))
+    last_error: Mapped[Optional[str]] = mapped_column(String(200))
+    created_at: Mapped[datetime.datetime] = mapped_column()
+    processed_at: Mapped[Optional[datetime.datetime]] = mapped_column()
+
+    def to_json(self) -> Dict[str, Any]:
+        return self._encoder.from_object(self)
+
+
+class IdempotencyKey(Base):
+    """
+    Ответ запроса с ключом идемпотентности (see `idempotency.py`),
+    a row without `status` is reserved by a request in progress, the status
+    0 marks a committed write whose response is not stored yet
+    """
+
+    __tablename__ = "idempotency_keys"
+    _encoder: ClassVar[RowEncoder]
+    __table_args__ = (Index("ix_idempotency_keys_expires_at", "expires_at"),)
+
+    key: Mapped[str] = mapped_column(String(64), primary_key=True)
+    fingerprint: Mapped[str] = mapped_column(String(64))
+    status: Mapped[Optional[int]] = mapped_column(Integer)
+    body: Mapped[Optional[bytes]] = mapped_column(LargeBinary)
+    mimetype: Mapped[Optional[str]] = mapped_column(String(100))
+    created_at: Mapped[datetime.datetime] = mapped_column()
+    expires_at: Mapped[datetime.datetime] = mapped_column()
+
+
+# Trigram index of the names and addresses of the parking lots on SQLite: an
+# external content FTS5 table kept in sync by triggers (see `search.py`)
+PARKINGS_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS parkings_search USING fts5("
+    "name, address, content='parkings', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS parkings_search_insert AFTER INSERT ON parkings "
+    "BEGIN INSERT INTO parkings_search(rowid, name, address) "
+    "VALUES (new.id, new.name, new.address); END",
+    "CREATE TRIGGER IF NOT EXISTS parkings_search_delete AFTER DELETE ON parkings "
+    "BEGIN INSERT INTO parkings_search(parkings_search, rowid, name, address) "
+    "VALUES ('delete', old.id, old.name, old.address); END",
+    "CREATE TRIGGER IF NOT EXISTS parkings_search_update "
+    "AFTER UPDATE OF name, address ON parkings "
+    "BEGIN INSERT INTO parkings_search(parkings_search, rowid, name, address) "
+    "VALUES ('delete', old.id, old.name, old.address); "
+    "INSERT INTO parkings_search(rowid, name, address) "
+    "VALUES (new.id, new.name, new.address); END",
+    "INSERT INTO parkings_search(parkings_search) VALUES ('rebuild')",
+)
+
+event.listen(
+    Base.metadata,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"),
+)
+for _statement in PARKINGS_SEARCH_DDL:
+    event.listen(
+        Parking.__table__, "after_create", DDL(_statement).execute_if(dialect="sqlite")
+    )
+event.listen(
+    Parking.__table__,
+    "before_drop",
+    DDL("DROP TABLE IF EXISTS parkings_search").execute_if(dialect="sqlite"),
+)
+
+for _model in (
+    Client,
+    Parking,
+    ClientParking,
+    ClientParkingArchive,
+    ParkingDailyStats,
+    Tariff,
+    Payment,
+    PaymentOutbox,
+    IdempotencyKey,
+):
+    _model._encoder = RowEncoder(_model.__table__)  # type: ignore[arg-type]
+
+# the normalized plate is for the lookups of the gates only
+Client._encoder = RowEncoder(
+    Client.__table__, exclude=("plate",)  # type: ignore[arg-type]
+)
@@ -0,0 +1,368 @@
+import atexit
+import logging
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from sqlalchemy import Table, and_, bindparam, func, select, update
+
+from .models import ClientParking, Parking, db
+from .shm import SharedSegment, segment_name
+
+logger = logging.getLogger(__name__)
+
+# (available places, opened)
+State = Tuple[int, bool]
+Loader = Callable[[int], Optional[State]]
+
+
+def next_state(state: State, delta: int) -> Optional[State]:
+    """
+    Правила счётчика парковки: заезд (-1) возможен только на открытую парковку
+    со свободными местами, парковка закрывается на последнем месте и
+    открывается при освобождении места.
+    """
+
+    available, opened = state
+    if delta < 0 and (not opened or available <= 0):
+        return None
+    available += delta
+    return available, available > 0
+
+
+class MemoryCounters:
+    """
+    Счётчики занятости в памяти процесса (один процесс на парковку,
+    например один воркер gunicorn или асинхронный сервер): the counters of
+    several workers would sell the same places and overwrite each other
+    in the table, `create_occupancy` refuses them with WEB_CONCURRENCY > 1.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._states: Dict[int, State] = {}
+        self._dirty: Dict[int, State] = {}
+        self.loader: Optional[Loader] = None
+
+    def rebuild(self, states: Iterable[Tuple[int, int, bool]]) -> None:
+        with self._lock:
+            self._states = {
+                pid: (available, opened) for pid, available, opened in states
+            }
+            self._dirty = {}
+
+    def _state(self, parking_id: int) -> Optional[State]:
+        state = self._states.get(parking_id)
+        if state is None and self.loader is not None:
+            state = self.loader(parking_id)
+            if state is not None:
+                self._states[parking_id] = state
+        return state
+
+    def get(self, parking_id: int) -> Optional[State]:
+        with self._lock:
+            return self._state(parking_id)
+
+    def apply(self, parking_id: int, delta: int) -> Optional[State]:
+        with self._lock:
+            state = self._state(parking_id)
+            if state is None:
+                return None
+            new_state = next_state(state, delta)
+            if new_state is not None:
+                self._states[parking_id] = new_state
+                self._dirty[parking_id] = new_state
+            return new_state
+
+    def drain(self) -> Dict[int, State]:
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            return dirty
+
+    def mark_dirty(self, parking_ids: Iterable[int]) -> None:
+        with self._lock:
+            for parking_id in parking_ids:
+                if parking_id in self._states:
+                    self._dirty[parking_id] = self._states[parking_id]
+
+
+class SharedCounters(SharedSegment):
+    """
+    Счётчики занятости в разделяемой памяти, общие для всех воркеров gunicorn
+    на одной машине.
+
+    The segment (see `shm.py`) is a hash table of `capacity` slots (parking
+    id + 1, available, opened, dirty) with linear probing, 0 is an empty
+    slot. The first slot is the header: the table was rebuilt from the
+    database, the number of dirty slots. The offsets of the dirty slots
+    follow the table: a flush reads only them.
+    """
+
+    FIELDS = 4
+
+    def __init__(self, name: str, capacity: int = 65536) -> None:
+        self.name = name
+        self.capacity = capacity
+        self.loader: Optional[Loader] = None
+        self._dirty_list = (capacity + 1) * self.FIELDS
+        super().__init__(name, self._dirty_list + capacity)
+        self._slots = self.slots
+        self._locked = self.locked
+
+    def _find(self, parking_id: int) -> Optional[int]:
+        if parking_id < 0:
+            return None
+        for step in range(self.capacity):
+            offset = (1 + (parking_id + step) % self.capacity) * self.FIELDS
+            if self._slots[offset] == parking_id + 1:
+                return offset
+            if self._slots[offset] == 0:
+                return None
+        return None
+
+    def _insert(self, parking_id: int, state: State) -> int:
+        offset = self._find(parking_id)
+        if offset is None:
+            for step in range(self.capacity):
+                offset = (1 + (parking_id + step) % self.capacity) * self.FIELDS
+                if self._slots[offset] == 0:
+                    self._slots[offset] = parking_id + 1
+                    break
+            else:
+                raise RuntimeError("The occupancy table is full")
+        self._write(offset, state)
+        return offset
+
+    def _write(self, offset: int, state: State) -> None:
+        self._slots[offset + 1] = state[0]
+        self._slots[offset + 2] = int(state[1])
+
+    def _mark(self, offset: int) -> None:
+        if self._slots[offset + 3]:
+            return
+        self._slots[offset + 3] = 1
+        self._slots[self._dirty_list + self._slots[1]] = offset
+        self._slots[1] += 1
+
+    def _read(self, offset: int) -> State:
+        return self._slots[offset + 1], bool(self._slots[offset + 2])
+
+    def _state(self, parking_id: int) -> Optional[int]:
+        offset = self._find(parking_id)
+        if offset is None and parking_id >= 0 and self.loader is not None:
+            state = self.loader(parking_id)
+            if state is not None:
+                offset = self._insert(parking_id, state)
+        return offset
+
+    def rebuild(self, states: Iterable[Tuple[int, int, bool]]) -> None:
+        with self._locked():
+            if self._slots[0]:
+                return
+            for parking_id, available, opened in states:
+                self._insert(parking_id, (available, opened))
+            self._slots[0] = 1
+
+    def get(self, parking_id: int) -> Optional[State]:
+        with self._locked():
+            offset = self._state(parking_id)
+            return None if offset is None else self._read(offset)
+
+    def apply(self, parking_id: int, delta: int) -> Optional[State]:
+        with self._locked():
+            offset = self._state(parking_id)
+            if offset is None:
+                return None
+            new_state = next_state(self._read(offset), delta)
+            if new_state is not None:
+                self._write(offset, new_state)
+                self._mark(offset)
+            return new_state
+
+    def drain(self) -> Dict[int, State]:
+        dirty: Dict[int, State] = {}
+        with self._locked():
+            for index in range(self._dirty_list, self._dirty_list + self._slots[1]):
+                offset = self._slots[index]
+                dirty[self._slots[offset] - 1] = self._read(offset)
+                self._slots[offset + 3] = 0
+            self._slots[1] = 0
+        return dirty
+
+    def mark_dirty(self, parking_ids: Iterable[int]) -> None:
+        with self._locked():
+            for parking_id in parking_ids:
+                offset = self._find(parking_id)
+                if offset is not None:
+                    self._mark(offset)
+
+
+Counters = Union[MemoryCounters, SharedCounters]
+
+
+def load_state(parking_id: int) -> Optional[State]:
+    """
+    The counter of one parking lot from the database, for the parking lots
+    created after the rebuild.
+    """
+
+    row = db.session.execute(
+        select(Parking.count_available_places, Parking.opened).where(
+            Parking.id == parking_id
+        )
+    ).one_or_none()
+    if row is None:
+        return None
+    return row.count_available_places, bool(row.opened)
+
+
+def rebuild_states() -> List[Tuple[int, int, bool]]:
+    """
+    Пересчёт свободных мест по незавершённым визитам `client_parking`.
+
+    A parking lot closed with free places is considered closed by hand and
+    stays closed, a parking lot closed because it was full is reopened if
+    places were freed.
+    """
+
+    parked = func.count(ClientParking.id)
+    rows = db.session.execute(
+        select(
+            Parking.id,
+            Parking.count_places,
+            Parking.count_available_places,
+            Parking.opened,
+            parked,
+        )
+        .outerjoin(
+            ClientParking,
+            and_(
+                ClientParking.parking_id == Parking.id,
+                ClientParking.time_in.is_not(None),
+                ClientParking.time_out.is_(None),
+            ),
+        )
+        .group_by(Parking.id)
+    )
+    states = []
+    for parking_id, places, stored, opened, count in rows:
+        available = max(places - count, 0)
+        if opened or stored <= 0:
+            opened = available > 0
+        states.append((parking_id, available, bool(opened)))
+    return states
+
+
+class OccupancyService:
+    """
+    Слой счётчиков занятости с отложенной записью (write-behind) в таблицу
+    `parkings`: `reserve`/`release` меняют только счётчик, изменённые счётчики
+    записываются в базу одним executemany раз в `interval` секунд.
+    `on_flush` is called with the ids of the parking lots written to the table.
+    """
+
+    def __init__(self, counters: Counters, interval: float = 1.0) -> None:
+        self.counters = counters
+        self.counters.loader = load_state
+        self.interval = interval
+        self.started = False
+        self.on_flush: Optional[Callable[[Iterable[int]], None]] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, app) -> None:
+        """Rebuilding the counters and starting the writer, once per process"""
+
+        if self.started:
+            return
+        with self._lock:
+            if self.started:
+                return
+            self.counters.rebuild(rebuild_states())
+            if self.interval > 0:
+                self._thread = threading.Thread(
+                    target=self._run, args=(app,), name="occupancy-writer", daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.stop, app)
+            self.started = True
+
+    def reserve(self, parking_id: int) -> Optional[State]:
+        return self.counters.apply(parking_id, -1)
+
+    def release(self, parking_id: int) -> Optional[State]:
+        return self.counters.apply(parking_id, 1)
+
+    def get(self, parking_id: int) -> Optional[State]:
+        return self.counters.get(parking_id)
+
+    def flush(self) -> int:
+        """
+        Writing the changed counters to `parkings`, must run in an app context
+        """
+
+        dirty = self.counters.drain()
+        if not dirty:
+            return 0
+        parkings: Table = Parking.__table__  # type: ignore[assignment]
+        try:
+            db.session.execute(
+                update(parkings)
+                .where(parkings.c.id == bindparam("parking_id"))
+                .values(
+                    count_available_places=bindparam("available"),
+                    opened=bindparam("is_opened"),
+                ),
+                [
+                    {"parking_id": pid, "available": available, "is_opened": opened}
+                    for pid, (available, opened) in dirty.items()
+                ],
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            self.counters.mark_dirty(dirty)
+            raise
+        if self.on_flush is not None:
+            self.on_flush(dirty)
+        return len(dirty)
+
+    def _run(self, app) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                with app.app_context():
+                    self.flush()
+            except Exception:
+                logger.exception("Failed to write the occupancy counters")
+
+    def stop(self, app) -> None:
+        self._stop.set()
+        try:
+            with app.app_context():
+                self.flush()
+        except Exception:
+            logger.exception("Failed to write the occupancy counters")
+
+
+def create_occupancy(config) -> Optional[OccupancyService]:
+    """
+    Счётчики по настройке OCCUPANCY_BACKEND: "" (выключены, счётчики
+    меняются в базе), "memory" или "shared".
+    """
+
+    backend = config.get("OCCUPANCY_BACKEND")
+    counters: Counters
+    if not backend:
+        return None
+    if backend == "memory":
+        if config.get("WEB_CONCURRENCY", 1) > 1:
+            raise ValueError(
+                'OCCUPANCY_BACKEND "memory" is one process: "shared" with'
+                " WEB_CONCURRENCY > 1"
+            )
+        counters = MemoryCounters()
+    elif backend == "shared":
+        counters = SharedCounters(segment_name(config, "occupancy"))
+    else:
+        raise ValueError(f"Unknown OCCUPANCY_BACKEND: {backend}")
+    return OccupancyService(counters, interval=config["OCCUPANCY_FLUSH_INTERVAL"])
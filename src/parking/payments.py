@@ -0,0 +1,288 @@
+import atexit
+import datetime
+import logging
+import math
+import random
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple, cast
+
+from sqlalchemy import Table, bindparam, select, update
+from sqlalchemy.orm import Session
+
+from .models import Client, PaymentOutbox, get_session
+
+logger = logging.getLogger(__name__)
+
+outbox = cast(Table, PaymentOutbox.__table__)
+
+PENDING = "pending"
+CAPTURED = "captured"
+FAILED = "failed"
+# the visit became free when re-billed (billing.rebill)
+CANCELLED = "cancelled"
+
+# (id, key, client_id, amount, attempts, credit_card, claim) of a claimed capture
+Capture = Tuple[int, str, int, int, int, Optional[str], str]
+
+
+class PaymentDeclined(Exception):
+    """Отказ процессора, который не исправить повтором (карта, сумма)"""
+
+
+class StubProcessor:
+    """
+    Локальный процессор платежей для тестов и разработки.
+
+    Like a real processor it is idempotent on the key: a capture repeated
+    after a lost answer returns the first reference. `delay` simulates a slow
+    processor, `errors` the number of transient failures left per key,
+    `declined` the keys refused for good. A refund is kept in `captured` as
+    a negative amount.
+    """
+
+    def __init__(self, delay: float = 0.0) -> None:
+        self.delay = delay
+        self.errors: Dict[str, int] = {}
+        self.declined: Set[str] = set()
+        self.captured: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def capture(self, key: str, card: str, amount: int) -> str:
+        if self.delay:
+            time.sleep(self.delay)
+        with self._lock:
+            if key in self.declined:
+                raise PaymentDeclined("Declined")
+            if self.errors.get(key, 0) > 0:
+                self.errors[key] -= 1
+                raise ConnectionError("The processor is unavailable")
+            self.captured.setdefault(key, amount)
+        return f"stub-{key}"
+
+    def refund(self, key: str, card: str, amount: int) -> str:
+        return self.capture(key, card, -amount)
+
+
+class PaymentWorker:
+    """
+    Пул, списывающий начисления из `payment_outbox` вне запросов выезда.
+
+    A batch of due captures is claimed in a short transaction (`FOR UPDATE
+    SKIP LOCKED` on Postgres, so the workers of all the processes share the
+    queue) and hidden from the others for the lease: `lease` seconds, or
+    longer if the batch may take longer, each call of the processor ending in
+    at most `capture_timeout` seconds. A worker that dies leaves its batch to
+    be retried after the lease. The processor is called by `threads` threads
+    outside of any transaction, the results are written with one executemany
+    guarded by the claim token of the batch: a row cancelled or claimed again
+    meanwhile is left as it is. A negative amount (an adjustment after a
+    re-billing) is refunded. A transient error is retried with an
+    exponential backoff (with jitter) up to `max_attempts` attempts, a
+    decline is final.
+    """
+
+    def __init__(
+        self,
+        processor: Any,
+        batch_size: int = 100,
+        threads: int = 4,
+        interval: float = 1.0,
+        max_attempts: int = 8,
+        backoff: float = 5.0,
+        max_backoff: float = 3600.0,
+        lease: float = 60.0,
+        jitter: float = 0.1,
+        capture_timeout: float = 10.0,
+    ) -> None:
+        self.processor = processor
+        self.batch_size = batch_size
+        self.threads = threads
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lease = lease
+        self.jitter = jitter
+        self.capture_timeout = capture_timeout
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def delay(self, attempts: int) -> float:
+        """Seconds before the next attempt after `attempts` failed ones"""
+
+        delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        return float(delay * (1 + random.uniform(0, self.jitter)))
+
+    def batch_lease(self, size: int) -> float:
+        """Seconds a batch of `size` captures is hidden from the other workers"""
+
+        rounds = math.ceil(size / max(self.threads, 1))
+        return max(self.lease, rounds * self.capture_timeout)
+
+    def claim(self, session: Session, now: datetime.datetime) -> List[Capture]:
+        """Due captures of a batch, hidden from the other workers for `lease`"""
+
+        rows = session.execute(
+            select(
+                outbox.c.id,
+                outbox.c.key,
+                outbox.c.client_id,
+                outbox.c.amount,
+                outbox.c.attempts,
+                Client.credit_card,
+            )
+            .outerjoin(Client, Client.id == outbox.c.client_id)
+            .where(outbox.c.status == PENDING, outbox.c.next_attempt_at <= now)
+            .order_by(outbox.c.next_attempt_at)
+            .limit(self.batch_size)
+            .with_for_update(of=outbox, skip_locked=True)
+        ).all()
+        token = secrets.token_hex(16)
+        if rows:
+            lease = datetime.timedelta(seconds=self.batch_lease(len(rows)))
+            session.execute(
+                update(outbox)
+                .where(outbox.c.id.in_([row.id for row in rows]))
+                .values(
+                    attempts=outbox.c.attempts + 1,
+                    next_attempt_at=now + lease,
+                    claim=token,
+                )
+            )
+        session.commit()
+        return [cast(Capture, (*row, token)) for row in rows]
+
+    def _capture(self, capture: Capture) -> Dict[str, Any]:
+        outbox_id, key, _client_id, amount, attempts, card, token = capture
+        attempts += 1
+        result: Dict[str, Any] = {
+            "outbox_id": outbox_id,
+            "b_claim": token,
+            "outcome": PENDING,
+            "ref": None,
+            "error": None,
+            "processed": None,
+            "next_attempt": None,
+        }
+        now = datetime.datetime.now()
+        try:
+            if not card:
+                raise PaymentDeclined("No card linked to the account")
+            if amount < 0:
+                result["ref"] = self.processor.refund(key, card, -amount)
+            else:
+                result["ref"] = self.processor.capture(key, card, amount)
+        except PaymentDeclined as error:
+            result.update(outcome=FAILED, error=str(error)[:200], processed=now)
+        except Exception as error:
+            logger.warning("Capture %s failed (attempt %s)", key, attempts)
+            result["error"] = f"{type(error).__name__}: {error}"[:200]
+            if attempts >= self.max_attempts:
+                result.update(outcome=FAILED, processed=now)
+            else:
+                retry = datetime.timedelta(seconds=self.delay(attempts))
+                result["next_attempt"] = now + retry
+        else:
+            result.update(outcome=CAPTURED, processed=now)
+        return result
+
+    def drain(
+        self, session: Optional[Session] = None, now: Optional[datetime.datetime] = None
+    ) -> int:
+        """
+        One batch of due captures, returns its size. Must run in an app
+        context if `session` is not given.
+        """
+
+        session = get_session(session)
+        captures = self.claim(session, now or datetime.datetime.now())
+        if not captures:
+            return 0
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        self.threads, thread_name_prefix="payment-capture"
+                    )
+        self._write(session, list(self._executor.map(self._capture, captures)))
+        return len(captures)
+
+    def _write(self, session: Session, results: List[Dict[str, Any]]) -> None:
+        session.execute(
+            update(outbox)
+            .where(
+                outbox.c.id == bindparam("outbox_id"),
+                outbox.c.status == PENDING,
+                outbox.c.claim == bindparam("b_claim"),
+            )
+            .values(
+                claim=None,
+                status=bindparam("outcome"),
+                reference=bindparam("ref"),
+                last_error=bindparam("error"),
+                processed_at=bindparam("processed"),
+                # a captured or failed row is not due any more (status)
+                next_attempt_at=bindparam("next_attempt"),
+            ),
+            [
+                dict(result, next_attempt=result["next_attempt"] or result["processed"])
+                for result in results
+            ],
+        )
+        session.commit()
+
+    def start(self, app) -> None:
+        """Starting the background drain, once per process"""
+
+        if self.interval <= 0 or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, args=(app,), name="payment-worker", daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def _run(self, app) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                with app.app_context():
+                    while self.drain() and not self._stop.is_set():
+                        pass
+            except Exception:
+                logger.exception("Failed to capture the payments")
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+
+def create_payments(config) -> Optional[PaymentWorker]:
+    """
+    Воркер списаний по настройке PAYMENT_PROCESSOR: "" (выключен, списания
+    копятся в `payment_outbox`) или "stub".
+    """
+
+    backend = config.get("PAYMENT_PROCESSOR")
+    if not backend:
+        return None
+    if backend != "stub":
+        raise ValueError(f"Unknown PAYMENT_PROCESSOR: {backend}")
+    return PaymentWorker(
+        StubProcessor(),
+        batch_size=config["PAYMENT_BATCH_SIZE"],
+        threads=config["PAYMENT_THREADS"],
+        interval=config["PAYMENT_INTERVAL"],
+        max_attempts=config["PAYMENT_MAX_ATTEMPTS"],
+        backoff=config["PAYMENT_RETRY_BACKOFF"],
+        max_backoff=config["PAYMENT_RETRY_MAX_BACKOFF"],
+        lease=config["PAYMENT_LEASE"],
+        capture_timeout=config["PAYMENT_CAPTURE_TIMEOUT"],
+    )
@@ -0,0 +1,54 @@
+from typing import Any, Dict, Iterable, List, Optional
+
+from sqlalchemy.orm import Session
+
+from .cache import LRUCache
+from .models import Client, get_session, normalize_plate
+
+
+class PlateIndex:
+    """
+    Поиск клиентов по номеру автомобиля для камер ворот (ANPR).
+
+    The plates are normalized (`normalize_plate`) and looked up together
+    with one query on the index of `clients.plate`, the found clients are
+    kept in an LRU cache of the process. A miss is not cached: a client
+    created by another worker is found at once. The cache is cleared by
+    the writes of the clients.
+    """
+
+    def __init__(self, cache_size: int = 10000) -> None:
+        self.cache = LRUCache(cache_size)
+
+    def lookup(
+        self, plates: Iterable[str], session: Optional[Session] = None
+    ) -> Dict[str, Optional[Dict[str, Any]]]:
+        """The client (or None) of every normalized plate"""
+
+        found: Dict[str, Optional[Dict[str, Any]]] = {}
+        missing: List[str] = []
+        for plate in {normalize_plate(plate) for plate in plates}:
+            client = self.cache.get(plate)
+            found[plate] = client
+            if client is None and plate:
+                missing.append(plate)
+        if not missing:
+            return found
+
+        session = get_session(session)
+        encoder = Client._encoder
+        rows = session.execute(
+            encoder.select()
+            .add_columns(Client.plate)
+            .where(Client.plate.in_(missing))
+            .order_by(Client.id)
+        )
+        for *columns, plate in rows:
+            # look-alike numbers of two clients: the first registered one
+            if found[plate] is None:
+                found[plate] = encoder.from_row(columns)
+                self.cache.set(plate, found[plate])
+        return found
+
+    def invalidate(self) -> None:
+        self.cache.clear()
@@ -0,0 +1,125 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+from flask import g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine
+
+from .config import engine_options
+
+logger = logging.getLogger(__name__)
+
+# seconds the replica is behind, 0 when it has replayed all the received WAL
+LAG_QUERY = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() "
+    "OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+class RoutingSession(Session):
+    """
+    Сессия, читающая с реплики в запросах, отмеченных `ReplicaRouter`.
+
+    Only the statements of a read-only request go to the engine of
+    `g.parking_read_engine`, the flushes (and everything outside such
+    a request) stay on the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context():
+            engine = g.get("parking_read_engine")
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReplicaRouter:
+    """
+    Маршрутизация чтений на реплику с проверкой её отставания.
+
+    The lag of the replica is checked at most every `check_interval` seconds
+    (by one thread, the others keep the last answer), a replica behind more
+    than `max_lag` seconds or unreachable is not used until a later check.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        max_lag: float = 5.0,
+        check_interval: float = 1.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.engine = engine
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._checked = float("-inf")
+        self._available = False
+
+    def lag(self) -> float:
+        if self.engine.dialect.name != "postgresql":
+            return 0.0
+        with self.engine.connect() as connection:
+            return float(connection.scalar(LAG_QUERY) or 0)
+
+    def available(self) -> bool:
+        now = self._clock()
+        if now - self._checked < self.check_interval:
+            return self._available
+        if not self._lock.acquire(blocking=False):
+            return self._available
+        try:
+            try:
+                lag: Optional[float] = self.lag()
+            except Exception:
+                logger.warning("Replica check failed", exc_info=True)
+                lag = None
+            available = lag is not None and lag <= self.max_lag
+            if available and not self._available:
+                logger.info("Reads go to the replica (lag %s s)", lag)
+            elif self._available and not available:
+                logger.warning("Reads fall back to the primary (lag %s s)", lag)
+            self._available = available
+            self._checked = now
+        finally:
+            self._lock.release()
+        return self._available
+
+    def use_replica(self) -> None:
+        """The reads of the current request go to the replica if it is fresh"""
+
+        g.parking_read_engine = self.engine if self.available() else None
+
+    def use_primary(self) -> None:
+        g.parking_read_engine = None
+
+    @contextmanager
+    def reading(self) -> Iterator[None]:
+        previous = g.get("parking_read_engine")
+        self.use_replica()
+        try:
+            yield
+        finally:
+            g.parking_read_engine = previous
+
+
+def create_replica(config: Any) -> Optional[ReplicaRouter]:
+    """
+    Маршрутизатор чтений, если задан REPLICA_DATABASE_URL (the engine
+    of the replica has the pool settings of the primary)
+    """
+
+    url = config.get("REPLICA_DATABASE_URL")
+    if not url:
+        return None
+    return ReplicaRouter(
+        create_engine(url, **engine_options(url)),
+        max_lag=config.get("REPLICA_MAX_LAG", 5.0),
+        check_interval=config.get("REPLICA_CHECK_INTERVAL", 1.0),
+    )
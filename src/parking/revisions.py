@@ -0,0 +1,124 @@
+import secrets
+import threading
+import time
+import zlib
+from typing import Any, Dict, Optional, Tuple, Union
+
+from .shm import SharedSegment, renew_after_fork, segment_name
+
+# (version, time of the last change, seconds since the epoch)
+Revision = Tuple[int, int]
+
+
+def revision_key(table: str, row_id: Optional[Any] = None) -> str:
+    """
+    The key of the revision of a table ("parkings") or of one row ("parkings:1")
+    """
+
+    return table if row_id is None else f"{table}:{row_id}"
+
+
+class MemoryRevisions:
+    """
+    Счётчики ревизий в памяти процесса (один процесс, например один воркер
+    gunicorn). The epoch is new on every start and in every forked worker,
+    the ETags of another process never match. A change made by another
+    worker is not seen (the primary reads of `replica.py` would miss it),
+    `create_revisions` refuses them with WEB_CONCURRENCY > 1.
+    """
+
+    def __init__(self) -> None:
+        self._revisions: Dict[str, Revision] = {}
+        self.renew()
+        renew_after_fork(self)
+
+    def renew(self) -> None:
+        self.epoch = secrets.randbits(48)
+        self._lock = threading.Lock()
+        self._started = int(time.time())
+
+    def get(self, key: str) -> Revision:
+        return self._revisions.get(key, (0, self._started))
+
+    def bump(self, *keys: str) -> None:
+        now = int(time.time())
+        with self._lock:
+            for key in keys:
+                self._revisions[key] = (self.get(key)[0] + 1, now)
+
+
+class SharedRevisions(SharedSegment):
+    """
+    Счётчики ревизий в разделяемой памяти, общие для всех воркеров gunicorn
+    на одной машине.
+
+    A key is hashed to one of `capacity` slots (version, time of the change),
+    the keys of a collision share the version: a write to one of them changes
+    the ETags of both, a changed row is never reported as unchanged.
+    The header is the epoch of the segment.
+    """
+
+    FIELDS = 2
+
+    def __init__(self, name: str, capacity: int = 8192) -> None:
+        self.name = name
+        self.capacity = capacity
+        super().__init__(name, (capacity + 1) * self.FIELDS)
+        self._slots = self.slots
+        with self.locked():
+            if not self._slots[0]:
+                self._slots[0] = secrets.randbits(48)
+                self._slots[1] = int(time.time())
+        self.epoch = self._slots[0]
+
+    def _offset(self, key: str) -> int:
+        return (1 + zlib.crc32(key.encode()) % self.capacity) * self.FIELDS
+
+    def get(self, key: str) -> Revision:
+        offset = self._offset(key)
+        version, modified = self._slots[offset], self._slots[offset + 1]
+        return version, modified or self._slots[1]
+
+    def bump(self, *keys: str) -> None:
+        now = int(time.time())
+        with self.locked():
+            for offset in {self._offset(key) for key in keys}:
+                self._slots[offset] += 1
+                self._slots[offset + 1] = now
+
+
+Revisions = Union[MemoryRevisions, SharedRevisions]
+
+
+def etag(revisions: Revisions, key: str, variant: str = "") -> Tuple[str, int]:
+    """
+    Strong ETag (without quotes) and the time of the last change of `key`.
+    `variant` is the query string: one revision, several representations.
+    """
+
+    version, modified = revisions.get(key)
+    tag = f"{revisions.epoch:x}-{version}"
+    if variant:
+        tag += f"-{zlib.crc32(variant.encode()):x}"
+    return tag, modified
+
+
+def create_revisions(config) -> Optional[Revisions]:
+    """
+    Ревизии по настройке REVISIONS_BACKEND: "" (выключены, ответы без ETag),
+    "memory" (один процесс) или "shared" (несколько воркеров на одной машине).
+    """
+
+    backend = config.get("REVISIONS_BACKEND")
+    if not backend:
+        return None
+    if backend == "memory":
+        if config.get("WEB_CONCURRENCY", 1) > 1:
+            raise ValueError(
+                'REVISIONS_BACKEND "memory" is one process: "shared" with'
+                " WEB_CONCURRENCY > 1"
+            )
+        return MemoryRevisions()
+    if backend == "shared":
+        return SharedRevisions(segment_name(config, "revisions"))
+    raise ValueError(f"Unknown REVISIONS_BACKEND: {backend}")
@@ -0,0 +1,143 @@
+import math
+from typing import Any, Dict, List, Optional, Tuple, cast
+
+from sqlalchemy import Select, Table, and_, literal_column, or_, select, text
+from sqlalchemy.orm import Session
+
+from .models import Parking, get_session
+
+# shorter texts are not in the trigram index: a scan of the table
+TRIGRAM_MIN_LENGTH = 3
+# half sides of the boxes around the point of `nearest_parkings`, in metres
+NEAREST_RADII = (2_000, 20_000, 200_000)
+EARTH_RADIUS = 6_371_000
+METRES_PER_DEGREE = 111_320
+
+parkings = cast(Table, Parking.__table__)
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def text_filter(value: str, prefix: bool, dialect: str):
+    """
+    Поиск по названию или адресу: подстрока или (prefix) начало строки,
+    без учёта регистра.
+
+    ILIKE uses the trigram GIN indexes on Postgres, on SQLite the candidates
+    come from the FTS5 trigram table `parkings_search` (see `models.py`).
+    """
+
+    pattern = _escape_like(value) + "%"
+    if not prefix:
+        pattern = "%" + pattern
+    condition = or_(
+        parkings.c.name.ilike(pattern, escape="\\"),
+        parkings.c.address.ilike(pattern, escape="\\"),
+    )
+    if dialect != "sqlite" or len(value) < TRIGRAM_MIN_LENGTH:
+        return condition
+
+    phrase = '"' + value.replace('"', '""') + '"'
+    matches: Select = (
+        select(literal_column("rowid"))
+        .select_from(text("parkings_search"))
+        .where(text("parkings_search MATCH :phrase").bindparams(phrase=phrase))
+    )
+    if not prefix:
+        # the trigram match is the substring search (and folds the case
+        # of non ASCII letters, unlike LIKE of SQLite)
+        return parkings.c.id.in_(matches)
+    return and_(parkings.c.id.in_(matches), condition)
+
+
+def parking_filters(
+    opened: Optional[bool] = None,
+    min_free: Optional[int] = None,
+    search: Optional[str] = None,
+    prefix: Optional[str] = None,
+    dialect: str = "",
+) -> List[Any]:
+    """Условия `where` списка парковок по параметрам запроса"""
+
+    conditions: List[Any] = []
+    if opened is not None:
+        conditions.append(parkings.c.opened.is_(opened))
+    if min_free is not None:
+        conditions.append(parkings.c.count_available_places >= min_free)
+    if search:
+        conditions.append(text_filter(search, False, dialect))
+    if prefix:
+        conditions.append(text_filter(prefix, True, dialect))
+    return conditions
+
+
+def distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Расстояние по большому кругу в метрах (haversine)"""
+
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2
+    a += math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def nearest_parkings(
+    latitude: float,
+    longitude: float,
+    min_free: int = 1,
+    limit: int = 5,
+    session: Optional[Session] = None,
+) -> List[Tuple[Dict[str, Any], float]]:
+    """
+    Ближайшие открытые парковки с не менее чем `min_free` свободными местами,
+    (parking, metres) by distance.
+
+    The lots are looked up in growing boxes around the point (the index on
+    latitude, longitude), ordered in SQL by the equirectangular distance and
+    refined with haversine. A box is enough when its nearest lot is within
+    its half side, otherwise the next box (at last all the lots) is searched.
+    """
+
+    session = get_session(session)
+    encoder = Parking._encoder
+    scale = max(math.cos(math.radians(latitude)), 0.01)
+    d_lat = parkings.c.latitude - latitude
+    d_lon = (parkings.c.longitude - longitude) * scale
+    query = (
+        encoder.select()
+        .where(
+            parkings.c.opened.is_(True),
+            parkings.c.count_available_places >= min_free,
+            parkings.c.latitude.is_not(None),
+            parkings.c.longitude.is_not(None),
+        )
+        .order_by(d_lat * d_lat + d_lon * d_lon, parkings.c.id)
+        .limit(limit)
+    )
+
+    found: List[Tuple[Dict[str, Any], float]] = []
+    for radius in (*NEAREST_RADII, None):
+        box = query
+        if radius is not None:
+            half_lat = radius / METRES_PER_DEGREE
+            half_lon = half_lat / scale
+            box = query.where(
+                parkings.c.latitude.between(latitude - half_lat, latitude + half_lat),
+                parkings.c.longitude.between(
+                    longitude - half_lon, longitude + half_lon
+                ),
+            )
+        rows = encoder.from_rows(session.execute(box))
+        found = sorted(
+            (
+                (row, distance(latitude, longitude, row["latitude"], row["longitude"]))
+                for row in rows
+            ),
+            key=lambda item: item[1],
+        )
+        if found and (radius is None or found[0][1] <= radius):
+            break
+    return found
@@ -0,0 +1,78 @@
+import json
+from operator import attrgetter
+from typing import Any, Dict, Iterable, List, Sequence
+
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import Select, Table, select
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore[assignment]
+
+
+class RowEncoder:
+    """
+    Кодировщик строк таблицы в словарь, собирается один раз на модель.
+
+    The column names and the attribute getter are computed once, an ORM object
+    is encoded with one `attrgetter` call and a plain row of `select()` of the
+    columns (no ORM hydration) with one `zip`. The `exclude` columns are
+    never sent to the clients.
+    """
+
+    def __init__(self, table: Table, exclude: Iterable[str] = ()) -> None:
+        self.table = table
+        excluded = set(exclude)
+        self.columns = [c for c in table.columns if c.name not in excluded]
+        self.names = tuple(column.name for column in self.columns)
+        self._getter = attrgetter(*self.names)
+
+    def from_object(self, obj: Any) -> Dict[str, Any]:
+        return dict(zip(self.names, self._getter(obj)))
+
+    def from_row(self, row: Sequence[Any]) -> Dict[str, Any]:
+        return dict(zip(self.names, row))
+
+    def from_rows(self, rows: Iterable[Sequence[Any]]) -> List[Dict[str, Any]]:
+        names = self.names
+        return [dict(zip(names, row)) for row in rows]
+
+    def select(self) -> Select:
+        """`select()` of the plain columns of the table, in the order of `names`"""
+
+        return select(*self.columns)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    JSON провайдер Flask на orjson (если установлен).
+
+    The output is the same as the default provider: dates are formatted by
+    `default` (HTTP date) and keys are sorted if `sort_keys` is set.
+    Calls with extra `json.dumps` arguments fall back to the default provider.
+    """
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        if kwargs or orjson is None:
+            return super().dumps(obj, **kwargs)
+        return dumps(obj, sort_keys=self.sort_keys)
+
+    def loads(self, s: Any, **kwargs: Any) -> Any:
+        if kwargs or orjson is None:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+
+def dumps(obj: Any, sort_keys: bool = False) -> str:
+    """
+    Быстрая сериализация в JSON (orjson, если установлен) с форматом дат Flask
+    """
+
+    default = DefaultJSONProvider.default
+    if orjson is None:
+        return json.dumps(obj, default=default, ensure_ascii=False, sort_keys=sort_keys)
+    option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    return orjson.dumps(obj, default=default, option=option).decode()
@@ -0,0 +1,131 @@
+import fcntl
+import os
+import tempfile
+import threading
+import weakref
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Iterator, List
+
+# the segments of POSIX shared memory on Linux
+SHM_DIR = "/dev/shm"
+
+_renewed: "weakref.WeakSet[Any]" = weakref.WeakSet()
+
+
+class SharedSegment:
+    """
+    Сегмент разделяемой памяти из `size` целых int64, общий для всех воркеров
+    gunicorn на одной машине.
+
+    The segment is created by the first process and attached by the others,
+    it outlives the workers. Writes are guarded by a `flock` on a lock file
+    and by a thread lock inside the process, see `locked()`.
+    The shared stores (occupancy counters, revisions, metrics, limits)
+    subclass it.
+    """
+
+    def __init__(self, name: str, size: int) -> None:
+        self.name = name
+        try:
+            self._shm = shared_memory.SharedMemory(
+                name=name, create=True, size=size * 8
+            )
+        except FileExistsError:
+            self._shm = shared_memory.SharedMemory(name=name)
+        try:
+            # Every worker only attaches the segment, it must outlive them.
+            resource_tracker.unregister(
+                self._shm._name, "shared_memory"  # type: ignore[attr-defined]
+            )
+        except Exception:  # pragma: no cover
+            pass
+        self.slots = self._shm.buf.cast("q")
+        self._open_lock()
+
+    def _open_lock(self) -> None:
+        # `flock` locks belong to the open file: a process forked with the
+        # segment (gunicorn `preload_app`) opens the lock file again
+        self._pid = os.getpid()
+        self._thread_lock = threading.Lock()
+        self._lock_file = open(
+            os.path.join(tempfile.gettempdir(), f"{self.name}.lock"), "a+b"
+        )
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        if self._pid != os.getpid():
+            self._lock_file.close()
+            self._open_lock()
+        with self._thread_lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def close(self) -> None:
+        self.slots.release()
+        self._shm.close()
+        self._lock_file.close()
+
+    def unlink(self) -> None:
+        """Removing the segment, e.g. when the deployment is stopped"""
+
+        self.close()
+        self._shm.unlink()
+
+
+def segment_name(config, store: str) -> str:
+    """
+    The name of the segment of a store: <STORE>_SHM_NAME if it is set,
+    else "<SHM_PREFIX>_<store>". SHM_PREFIX is new on every start of the
+    gunicorn master (`gunicorn.conf.py`), without it the segments belong
+    to this process.
+    """
+
+    configured = config.get(f"{store.upper()}_SHM_NAME")
+    if configured:
+        return str(configured)
+    prefix = config.get("SHM_PREFIX") or f"parking_{os.getpid()}"
+    return f"{prefix}_{store}"
+
+
+def unlink_segments(prefix: str) -> List[str]:
+    """
+    Removing the segments "<prefix>_*" and their lock files, e.g. when
+    the gunicorn master exits. Returns the removed names.
+    """
+
+    if not os.path.isdir(SHM_DIR):
+        return []
+    removed = []
+    for name in sorted(os.listdir(SHM_DIR)):
+        if not name.startswith(f"{prefix}_"):
+            continue
+        try:
+            shared_memory.SharedMemory(name=name).unlink()
+        except FileNotFoundError:
+            continue
+        lock_path = os.path.join(tempfile.gettempdir(), f"{name}.lock")
+        if os.path.exists(lock_path):
+            os.remove(lock_path)
+        removed.append(name)
+    return removed
+
+
+def _after_fork() -> None:
+    for state in list(_renewed):
+        state.renew()
+
+
+def renew_after_fork(state: Any) -> None:
+    """
+    `state.renew()` in every process forked from this one: the state of a
+    process created in the gunicorn master (`preload_app`), e.g. an epoch,
+    must not be the same in all the workers.
+    """
+
+    if not _renewed and hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=_after_fork)
+    _renewed.add(state)
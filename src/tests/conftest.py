@@ -8,8 +8,13 @@ from src.parking.models import db as _db
 
 
 @pytest.fixture()
-def app():
-    _app = create_app(test_config=True)
+def app_config():
+    return True
+
+
+@pytest.fixture()
+def app(app_config):
+    _app = create_app(test_config=app_config)
     _app.config["TESTING"] = True
     time_in = datetime.now()
 
@@ -0,0 +1,86 @@
+import datetime
+
+from src.parking.analytics import ParkingAnalytics, compute_days
+from src.parking.models import ClientParking, ClientParkingArchive
+
+DAY = datetime.date(2025, 3, 1)
+NOW = datetime.datetime(2025, 4, 1)
+
+
+def at(day: int, hour: int, minute: int = 0) -> datetime.datetime:
+    return datetime.datetime(2025, 3, day, hour, minute)
+
+
+def add_visits(db):
+    db.session.add_all(
+        [
+            ClientParking(
+                client_id=2, parking_id=1, time_in=at(1, 8, 30), time_out=at(1, 10)
+            ),
+            ClientParking(
+                client_id=2, parking_id=1, time_in=at(1, 23), time_out=at(2, 1)
+            ),
+            ClientParkingArchive(
+                id=100,
+                client_id=2,
+                parking_id=1,
+                time_in=at(1, 9),
+                time_out=at(1, 9, 30),
+            ),
+        ]
+    )
+    db.session.commit()
+
+
+def test_compute_days(app, db):
+    """Hourly occupancy from current and archived visits, counted on departure"""
+
+    add_visits(db)
+    first, second = compute_days(
+        1, DAY, DAY + datetime.timedelta(days=2), hourly_rate=100, now=NOW
+    )
+
+    assert first["hourly_occupancy"][8] == 0.5
+    assert first["hourly_occupancy"][9] == 1.5
+    assert first["hourly_occupancy"][10] == 0
+    assert first["hourly_occupancy"][23] == 1
+    assert first["visits"] == 2
+    assert first["dwell_seconds"] == 2 * 3600
+    assert first["revenue"] == 300
+    assert second["hourly_occupancy"][:2] == [1, 0]
+    assert second["visits"] == 1
+    assert second["revenue"] == 200
+
+
+def test_past_days_are_cached(app, db):
+    add_visits(db)
+    analytics = ParkingAnalytics()
+    end = DAY + datetime.timedelta(days=1)
+    assert analytics.days(1, DAY, end, now=NOW)[0]["visits"] == 2
+
+    db.session.add(
+        ClientParking(client_id=2, parking_id=1, time_in=at(1, 1), time_out=at(1, 2))
+    )
+    db.session.commit()
+    assert analytics.days(1, DAY, end, now=NOW)[0]["visits"] == 2
+    assert ParkingAnalytics().days(1, DAY, end, now=NOW)[0]["visits"] == 3
+
+
+def test_analytics_endpoint(client, db):
+    add_visits(db)
+    response = client.get("/parkings/1/analytics?from=2025-03-01&to=2025-03-02")
+    assert response.status_code == 200
+    report = response.json
+    assert [day["day"] for day in report["days"]] == ["2025-03-01", "2025-03-02"]
+    assert report["summary"]["visits"] == 3
+    assert report["summary"]["avg_dwell_seconds"] == 4 * 3600 / 3
+    assert report["days"][0]["turnover"] == 0.1
+    assert len(report["summary"]["hourly_occupancy"]) == 24
+
+
+def test_analytics_bad_requests(client):
+    assert client.get("/parkings/100/analytics").status_code == 404
+    assert client.get("/parkings/1/analytics?from=yesterday").status_code == 400
+    too_long = client.get("/parkings/1/analytics?from=2020-01-01&to=2025-01-01")
+    assert too_long.status_code == 400
+    assert client.get("/parkings/1/analytics").status_code == 200
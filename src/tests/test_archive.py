@@ -0,0 +1,77 @@
+import datetime
+
+from src.parking.archive import parking_days, run_archive
+from src.parking.models import ClientParking, ClientParkingArchive, ParkingDailyStats
+
+DAY = datetime.date(2025, 3, 1)
+
+
+def at(day: int, hour: int) -> datetime.datetime:
+    return datetime.datetime(2025, 3, day, hour)
+
+
+def test_parking_days_sweep():
+    """Visits and dwell on the day of departure, the parked cars are carried"""
+
+    sessions = [
+        (1, at(1, 8), at(1, 10)),
+        (1, at(1, 9), at(1, 12)),
+        (1, at(1, 9), at(3, 9)),
+        (1, at(1, 10), at(1, 11)),
+    ]
+    days = parking_days(1, sessions, DAY, DAY + datetime.timedelta(days=4))
+
+    assert [(row["day"].day, row["peak_occupancy"]) for row in days] == [
+        (1, 3),
+        (2, 1),
+        (3, 1),
+    ]
+    assert days[0]["visits"] == 3
+    assert days[0]["dwell_seconds"] == (2 + 3 + 1) * 3600
+    assert days[2]["visits"] == 1
+    assert days[2]["dwell_seconds"] == 48 * 3600
+
+
+def test_run_archive(app, db):
+    """Old finished visits are rolled up and moved, active visits stay"""
+
+    db.session.add_all(
+        [
+            ClientParking(
+                client_id=2, parking_id=1, time_in=at(1, 8), time_out=at(1, 9)
+            ),
+            ClientParking(
+                client_id=2, parking_id=1, time_in=at(2, 8), time_out=at(2, 9)
+            ),
+            ClientParking(client_id=2, parking_id=2, time_in=at(2, 8)),
+        ]
+    )
+    db.session.commit()
+
+    report = run_archive(age_days=30, batch_size=1, now=datetime.datetime(2025, 4, 2))
+    assert report["archived"] == 2
+    assert report["cutoff"] == "2025-03-03T00:00:00"
+    assert db.session.query(ClientParkingArchive).count() == 2
+    assert db.session.query(ClientParking).filter_by(client_id=2).count() == 1
+
+    stats = {
+        (row.parking_id, row.day.day): row.to_json()
+        for row in db.session.query(ParkingDailyStats)
+    }
+    assert stats[(1, 1)]["visits"] == 1
+    assert stats[(1, 1)]["avg_dwell_seconds"] == 3600
+    assert stats[(2, 2)]["peak_occupancy"] == 1
+    assert stats[(2, 2)]["visits"] == 0
+
+    # the next run only adds the new days, the archive is unchanged
+    report = run_archive(age_days=30, now=datetime.datetime(2025, 4, 3))
+    assert report["archived"] == 0
+    assert (2, 3) in {
+        (row.parking_id, row.day.day) for row in db.session.query(ParkingDailyStats)
+    }
+
+
+def test_archive_command(runner, db):
+    result = runner.invoke(args=["archive-visits", "--age-days", "0"])
+    assert result.exit_code == 0, result.output
+    assert "archived visits: 0" in result.output
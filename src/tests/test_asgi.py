@@ -0,0 +1,235 @@
+import asyncio
+import json
+import uuid
+
+import pytest
+
+from src.parking.app import create_app
+from src.parking.asgi import async_url, create_asgi_app
+from src.parking.revisions import SharedRevisions
+from src.parking.shm import unlink_segments
+
+CLIENT = {"name": "A", "surname": "B", "credit_card": "1", "car_number": "A1"}
+PARKING = {
+    "name": "Mall",
+    "address": "Moscow",
+    "opened": True,
+    "count_places": 3,
+    "count_available_places": 3,
+    "latitude": 55.75,
+    "longitude": 37.62,
+}
+
+
+async def call(app, method, path, body=None, query="", headers=None):
+    """Sending one request to the ASGI application"""
+
+    messages = [
+        {
+            "type": "http.request",
+            "body": json.dumps(body).encode() if body is not None else b"",
+        }
+    ]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query.encode(),
+        "headers": [
+            (name.lower().encode(), value.encode())
+            for name, value in (headers or {}).items()
+        ],
+    }
+    await app(scope, receive, send)
+    payload = b"".join(m.get("body", b"") for m in sent[1:])
+    if headers is not None:
+        response_headers = {
+            name.decode(): value.decode() for name, value in sent[0]["headers"]
+        }
+        return sent[0]["status"], json.loads(payload), response_headers
+    return sent[0]["status"], json.loads(payload)
+
+
+@pytest.fixture()
+def asgi_app(tmp_path):
+    return create_asgi_app(f"sqlite:///{tmp_path}/parking.db")
+
+
+def test_async_url():
+    """The URL of the sync application is translated to the asyncio drivers"""
+
+    assert async_url("postgresql://u:p@host/db") == "postgresql+asyncpg://u:p@host/db"
+    assert async_url("sqlite:///parking.db") == "sqlite+aiosqlite:///parking.db"
+
+
+def test_asgi_arrival_and_departure(asgi_app):
+    """The async mode shares the models and the rules of the gates"""
+
+    async def scenario():
+        await asgi_app.startup()
+        client = {"name": "A", "surname": "B", "credit_card": "1", "car_number": "A1"}
+        parking = {
+            "name": "P",
+            "address": "Moscow",
+            "opened": True,
+            "count_places": 1,
+            "count_available_places": 1,
+        }
+        assert (await call(asgi_app, "POST", "/clients", client))[0] == 201
+        assert (await call(asgi_app, "POST", "/parkings", parking))[0] == 201
+
+        data = {"client_id": 1, "parking_id": 1}
+        status, arrival = await call(asgi_app, "POST", "/client_parkings", data)
+        assert status == 201
+        assert arrival["arrival"]["time_in"].endswith("GMT")
+
+        status, refused = await call(asgi_app, "POST", "/client_parkings", data)
+        assert (status, refused) == (404, {"No place": 404})
+
+        status, departure = await call(asgi_app, "DELETE", "/client_parkings", data)
+        assert departure["departure"]["parking"]["count_available_places"] == 1
+
+        status, listing = await call(asgi_app, "GET", "/parkings", query="stream=1")
+        assert [p["id"] for p in listing["parkings"]] == [1]
+        status, page = await call(asgi_app, "GET", "/clients", query="limit=1")
+        assert page["next"] == 1
+
+        assert (await call(asgi_app, "GET", "/clients/7"))[0] == 404
+        assert (await call(asgi_app, "GET", "/client_parkings"))[0] == 405
+        await asgi_app.shutdown()
+
+    asyncio.run(scenario())
+
+
+@pytest.fixture()
+def shared(tmp_path):
+    """The sync and the async applications on one database and one machine"""
+
+    name = f"parking_test_{uuid.uuid4().hex[:8]}"
+    settings = {"REVISIONS_BACKEND": "shared", "REVISIONS_SHM_NAME": name}
+    url = f"sqlite:///{tmp_path}/parking.db"
+    flask_app = create_app(test_config=dict(settings, SQLALCHEMY_DATABASE_URI=url))
+    asgi_app = create_asgi_app(url, settings)
+    asyncio.run(asgi_app.startup())
+    yield flask_app.test_client(), asgi_app
+    asyncio.run(asgi_app.shutdown())
+    for revisions in (flask_app.extensions["revisions"], asgi_app.revisions):
+        assert isinstance(revisions, SharedRevisions)
+        revisions.close()
+    unlink_segments(name)
+
+
+def test_asgi_parity(shared):
+    """The routes of the async mode answer as the ones of `app.py`"""
+
+    flask_client, asgi_app = shared
+
+    async def create():
+        await call(asgi_app, "POST", "/clients", CLIENT)
+        await call(asgi_app, "POST", "/parkings", PARKING)
+        other = dict(PARKING, name="Yard", address="Tver", opened=False)
+        await call(asgi_app, "POST", "/parkings", other)
+
+    asyncio.run(create())
+    for path, query in [
+        ("/parkings", ""),
+        ("/parkings", "opened=1&min_free=2"),
+        ("/parkings", "q=all"),
+        ("/parkings", "prefix=Tv&limit=1"),
+        ("/parkings/1", ""),
+        ("/clients", ""),
+        ("/clients/1", ""),
+    ]:
+        expected = flask_client.get(f"{path}?{query}").json
+        assert asyncio.run(call(asgi_app, "GET", path, query=query)) == (200, expected)
+    assert flask_client.get("/parkings/1").json["parking"]["latitude"] == 55.75
+
+
+def test_asgi_writes_bump_revisions(shared):
+    """A sync worker does not answer 304 after a write of the async mode"""
+
+    flask_client, asgi_app = shared
+    asyncio.run(call(asgi_app, "POST", "/clients", CLIENT))
+    asyncio.run(call(asgi_app, "POST", "/parkings", PARKING))
+    response = flask_client.get("/parkings/1")
+    tag = response.headers["ETag"]
+    response = flask_client.get("/parkings/1", headers={"If-None-Match": tag})
+    assert response.status_code == 304
+
+    data = {"client_id": 1, "parking_id": 1}
+    asyncio.run(call(asgi_app, "POST", "/client_parkings", data))
+    response = flask_client.get("/parkings/1", headers={"If-None-Match": tag})
+    assert response.status_code == 200
+    assert response.json["parking"]["count_available_places"] == 2
+
+
+def test_asgi_idempotency_and_errors(shared):
+    flask_client, asgi_app = shared
+
+    async def scenario():
+        assert (await call(asgi_app, "POST", "/clients", CLIENT))[0] == 201
+        # a duplicate car number
+        assert (await call(asgi_app, "POST", "/clients", CLIENT)) == (
+            400,
+            {"Bad request": 400},
+        )
+        await call(asgi_app, "POST", "/parkings", PARKING)
+
+        data = {"client_id": 1, "parking_id": 1}
+        headers = {"Idempotency-Key": "gate-1"}
+        first = await call(asgi_app, "POST", "/client_parkings", data, headers=headers)
+        assert first[0] == 201
+        retry = await call(asgi_app, "POST", "/client_parkings", data, headers=headers)
+        assert retry[:2] == first[:2]
+        assert retry[2]["idempotent-replayed"] == "true"
+
+    asyncio.run(scenario())
+    # the sync application replays the same key and body
+    response = flask_client.post(
+        "/client_parkings",
+        data=json.dumps({"client_id": 1, "parking_id": 1}),
+        content_type="application/json",
+        headers={"Idempotency-Key": "gate-1"},
+    )
+    assert response.headers["Idempotent-Replayed"] == "true"
+    assert (
+        flask_client.get("/parkings/1").json["parking"]["count_available_places"] == 2
+    )
+
+
+def test_asgi_limits(tmp_path):
+    asgi_app = create_asgi_app(
+        f"sqlite:///{tmp_path}/parking.db",
+        {
+            "LIMITS_BACKEND": "memory",
+            "RATE_LIMIT_READ_RATE": 1,
+            "RATE_LIMIT_READ_BURST": 1,
+        },
+    )
+
+    async def scenario():
+        await asgi_app.startup()
+        assert (await call(asgi_app, "GET", "/parkings"))[0] == 200
+        status, body, headers = await call(asgi_app, "GET", "/parkings", headers={})
+        assert (status, headers["retry-after"]) == (429, "1")
+        # the gates are not limited
+        data = {"client_id": 1, "parking_id": 1}
+        assert (await call(asgi_app, "POST", "/client_parkings", data))[0] == 404
+        await asgi_app.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_asgi_refuses_occupancy_counters(tmp_path):
+    with pytest.raises(ValueError):
+        create_asgi_app(
+            f"sqlite:///{tmp_path}/parking.db", {"OCCUPANCY_BACKEND": "memory"}
+        )
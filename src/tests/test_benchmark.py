@@ -0,0 +1,68 @@
+import pytest
+
+from src.benchmark import cold_start, compare, percentiles, run
+
+
+@pytest.fixture()
+def app_config(tmp_path):
+    # the workers are threads: a file database shared by their connections
+    return {"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path}/bench.db"}
+
+
+def test_percentiles():
+    result = percentiles([float(value) for value in range(1, 101)])
+    assert result["p50"] == pytest.approx(50.5)
+    assert result["p99"] == pytest.approx(99.01)
+    assert percentiles([3.0])["p95"] == 3.0
+    few = percentiles([1.0, 2.0, 10.0])
+    assert few["p95"] <= few["p99"] <= few["max"] == 10.0
+
+
+def test_run_reports_every_operation(app):
+    """A small run seeds the missing rows and reports every operation"""
+
+    report = run(
+        app,
+        ["client_by_id", "parkings_list", "check_in_out"],
+        requests=10,
+        workers=2,
+        clients=30,
+        parkings=5,
+    )
+
+    assert report["meta"]["dataset"] == {"clients": 30, "parkings": 5}
+    results = report["results"]
+    assert set(results) == {"client_by_id", "parkings_list", "check_in", "check_out"}
+    assert results["check_in"]["requests"] == 10
+    assert results["check_in"]["errors"] == 0
+    assert results["check_out"]["errors"] == 0
+    assert results["client_by_id"]["queries_per_request"] >= 1
+    assert results["parkings_list"]["latency_ms"]["p99"] > 0
+
+
+def test_compare_flags_regressions():
+    def report(p95):
+        return {
+            "results": {
+                "check_out": {
+                    "latency_ms": {"p95": p95},
+                    "throughput_rps": 1,
+                    "queries_per_request": 2,
+                }
+            }
+        }
+
+    assert compare(report(1.3), report(1.0), max_regression=0.2) == ["check_out"]
+    assert compare(report(1.1), report(1.0), max_regression=0.2) == []
+
+
+def test_cold_start(app, monkeypatch):
+    """`src.manage` is started in new interpreters against the database"""
+
+    monkeypatch.setenv("DATABASE_URL", app.config["SQLALCHEMY_DATABASE_URI"])
+    result = cold_start(2, url="/clients/1")
+
+    assert result["runs"] == 2
+    assert result["errors"] == 0
+    assert 0 < result["import_ms"]["p50"] < result["total_ms"]["p50"]
+    assert result["first_request_ms"]["max"] > 0
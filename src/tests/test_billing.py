@@ -0,0 +1,159 @@
+import datetime
+
+import pytest
+from sqlalchemy import select
+
+from src.parking.billing import Rates, billed_minutes, charge, rebill
+from src.parking.models import ClientParking, ClientParkingArchive, Payment, Tariff
+
+START = datetime.datetime(2025, 3, 1, 8)
+
+
+@pytest.mark.parametrize(
+    "minutes, amount",
+    [
+        (0, 0),
+        (15, 0),
+        (16, 10),
+        (45, 300),
+        # 60 minutes cost the hourly cap
+        (75, 500),
+        (76, 510),
+        (15 + 5 * 60, 2000),
+        # the daily cap, then a second day
+        (15 + 24 * 60, 2000),
+        (15 + 24 * 60 + 1, 2010),
+        (15 + 48 * 60, 4000),
+    ],
+)
+def test_charge(minutes, amount):
+    rates = Rates(minute_rate=10, hourly_cap=500, daily_cap=2000, free_minutes=15)
+    assert charge(rates, minutes) == amount
+
+
+def test_charge_without_caps():
+    assert charge(Rates(minute_rate=3), 24 * 60 + 1) == 3 * (24 * 60 + 1)
+    assert charge(Rates(), 1000) == 0
+
+
+def test_billed_minutes():
+    assert billed_minutes(START, START) == 0
+    assert billed_minutes(START, START + datetime.timedelta(seconds=61)) == 2
+
+
+def payments(db):
+    return {
+        row.visit_id: row.amount
+        for row in db.session.execute(select(Payment.visit_id, Payment.amount))
+    }
+
+
+def test_checkout_payment(client, db):
+    db.session.add(Tariff(parking_id=1, minute_rate=10, free_minutes=0))
+    db.session.commit()
+    data = {"client_id": 1, "parking_id": 1}
+    client.post("/client_parkings", json=data)
+    visit = db.session.scalars(select(ClientParking).order_by(ClientParking.id.desc()))
+    visit.first().time_in -= datetime.timedelta(minutes=30)
+    db.session.commit()
+
+    response = client.delete("/client_parkings", json=data)
+    assert response.status_code == 201
+    payment = response.json["departure"]["payment"]
+    assert payment["key"] == "visit:3"
+    assert payment["minutes"] == 31
+    assert payment["amount"] == 310
+    assert payments(db) == {3: 310}
+
+
+def test_batch_departure_payment(client, db):
+    data = {"client_id": 1, "parking_id": 1}
+    events = [dict(data, action="arrival"), dict(data, action="departure")]
+    response = client.post("/client_parkings/batch", json={"events": events})
+    results = response.json["results"]
+    assert "payment" not in results[0]
+    assert results[1]["payment"]["amount"] == 0
+    assert payments(db) == {3: 0}
+
+
+def test_tariff_route(client):
+    tariff = client.get("/parkings/1/tariff").json["tariff"]
+    assert tariff["minute_rate"] == 0
+    assert tariff["daily_cap"] is None
+
+    response = client.put(
+        "/parkings/1/tariff", json={"minute_rate": 5, "daily_cap": 1000}
+    )
+    assert response.status_code == 200
+    tariff = client.get("/parkings/1/tariff").json["tariff"]
+    assert (tariff["minute_rate"], tariff["daily_cap"]) == (5, 1000)
+
+    assert client.put("/parkings/1/tariff", json={"minute_rate": -1}).status_code == 400
+    assert (
+        client.put("/parkings/1/tariff", json={"minute_rate": "5"}).status_code == 400
+    )
+    assert client.get("/parkings/9/tariff").status_code == 404
+
+
+def test_rebill(app, db):
+    """Current and archived visits are priced in chunks, the keys are unique"""
+
+    db.session.add_all(
+        [
+            ClientParking(
+                client_id=2,
+                parking_id=2,
+                time_in=START,
+                time_out=START + datetime.timedelta(hours=2),
+            ),
+            ClientParkingArchive(
+                id=100,
+                client_id=1,
+                parking_id=2,
+                time_in=START,
+                time_out=START + datetime.timedelta(minutes=10),
+            ),
+            Tariff(parking_id=2, minute_rate=10, hourly_cap=400),
+        ]
+    )
+    db.session.commit()
+
+    assert rebill(batch_size=1) == {"billed": 3}
+    # the visit 1 lasts 4 days at the free parking lot
+    assert payments(db) == {1: 0, 3: 800, 100: 100}
+
+    db.session.get(Tariff, 2).hourly_cap = 300
+    db.session.commit()
+    assert rebill(parking_ids=[2], since=START + datetime.timedelta(hours=1)) == {
+        "billed": 1
+    }
+    assert payments(db) == {1: 0, 3: 600, 100: 100}
+    assert db.session.query(Payment).count() == 3
+
+
+def test_payments_without_on_conflict(client, db, monkeypatch):
+    """The databases without INSERT ... ON CONFLICT are billed with a select"""
+
+    monkeypatch.setattr("src.parking.billing._on_conflict_insert", lambda *args: None)
+    db.session.add(Tariff(parking_id=1, minute_rate=10, free_minutes=0))
+    db.session.commit()
+    data = {"client_id": 1, "parking_id": 1}
+    client.post("/client_parkings", json=data)
+    response = client.delete("/client_parkings", json=data)
+    assert response.json["departure"]["payment"]["amount"] == 10
+    assert payments(db)[3] == 10
+
+    assert rebill() == {"billed": 2}
+    billed = payments(db)
+    assert billed[3] == 10 and billed[1] > 0
+    db.session.get(Tariff, 1).minute_rate = 20
+    db.session.commit()
+    assert rebill() == {"billed": 2}
+    assert payments(db) == {visit: amount * 2 for visit, amount in billed.items()}
+    assert db.session.query(Payment).count() == 2
+
+
+def test_rebill_command(runner, db):
+    result = runner.invoke(args=["rebill", "--parking-id", "1"])
+    assert "Billed visits: 1" in result.output
+    assert payments(db) == {1: 0}
@@ -0,0 +1,104 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from sqlalchemy import create_engine, inspect
+
+from src.parking.app import create_app
+from src.parking.bootstrap import alembic_head, check_schema, ensure_schema
+from src.parking.models import db
+
+
+def test_bootstrap_empty_database():
+    """Testing the creation of tables and alembic stamp on the first request"""
+
+    app = create_app(test_config=True)
+    client = app.test_client()
+
+    assert client.get("/clients").status_code == 200
+    bootstrap = app.extensions["schema_bootstrap"]
+    assert bootstrap.ready
+    assert bootstrap.revision == alembic_head()
+    with app.app_context():
+        tables = inspect(db.engine).get_table_names()
+    assert {"clients", "parkings", "client_parking", "alembic_version"} <= set(tables)
+
+
+def test_bootstrap_runs_once(client, app, monkeypatch):
+    """Testing that the schema is checked only on the first request"""
+
+    client.get("/clients")
+    calls = []
+    monkeypatch.setattr(
+        "src.parking.bootstrap.ensure_schema", lambda engine: calls.append(engine)
+    )
+    client.get("/clients")
+    client.get("/parkings")
+    assert not calls
+
+
+def test_bootstrap_baseline_database(tmp_path):
+    """The tables of the first release (create_all without alembic) are upgraded"""
+
+    url = f"sqlite:///{tmp_path}/parking.db"
+    engine = create_engine(url)
+    with engine.begin() as connection:
+        # the schema of the first release
+        connection.exec_driver_sql(
+            "CREATE TABLE clients (id INTEGER PRIMARY KEY, name VARCHAR(50), "
+            "surname VARCHAR(50), credit_card VARCHAR(50), car_number VARCHAR(10), "
+            "UNIQUE (car_number))"
+        )
+        connection.exec_driver_sql(
+            "CREATE TABLE parkings (id INTEGER PRIMARY KEY, address VARCHAR(100), "
+            "name VARCHAR(50), opened BOOLEAN, count_places INTEGER, "
+            "count_available_places INTEGER, UNIQUE (address))"
+        )
+        connection.exec_driver_sql(
+            "CREATE TABLE client_parking (id INTEGER PRIMARY KEY, "
+            "client_id INTEGER REFERENCES clients (id), "
+            "parking_id INTEGER REFERENCES parkings (id), "
+            "time_in DATETIME, time_out DATETIME)"
+        )
+        connection.exec_driver_sql(
+            "INSERT INTO clients (name, surname, credit_card, car_number) "
+            "VALUES ('Alex', 'Minnesota', '', 'х 123 оо 42')"
+        )
+
+    with engine.begin() as connection:
+        assert check_schema(connection) == alembic_head()
+    with engine.begin() as connection:
+        assert check_schema(connection) == alembic_head()
+        columns = {
+            column["name"] for column in inspect(connection).get_columns("clients")
+        }
+        assert "plate" in columns
+        plate = connection.exec_driver_sql("SELECT plate FROM clients").scalar()
+        assert plate == "X123OO42"
+        tables = set(inspect(connection).get_table_names())
+        assert {"tariffs", "payment_outbox", "idempotency_keys"} <= tables
+    engine.dispose()
+
+
+def test_bootstrap_unknown_tables(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/parking.db")
+    with engine.begin() as connection:
+        connection.exec_driver_sql("CREATE TABLE tariffs (parking_id INTEGER)")
+    with pytest.raises(RuntimeError, match="not managed by alembic"):
+        with engine.begin() as connection:
+            check_schema(connection)
+    engine.dispose()
+
+
+def test_bootstrap_workers_together(tmp_path):
+    """The workers started together check an empty database one by one"""
+
+    url = f"sqlite:///{tmp_path}/parking.db"
+    engines = [create_engine(url) for _ in range(4)]
+    with ThreadPoolExecutor(len(engines)) as executor:
+        revisions = list(executor.map(ensure_schema, engines))
+    assert revisions == [alembic_head()] * len(engines)
+    with engines[0].connect() as connection:
+        versions = connection.exec_driver_sql("SELECT * FROM alembic_version").all()
+    assert versions == [(alembic_head(),)]
+    for engine in engines:
+        engine.dispose()
@@ -0,0 +1,68 @@
+from flask import render_template_string
+
+from src.parking.cache import LazyList, TTLCache
+
+
+def test_ttl_cache_expires():
+    """Testing that the cached value is reloaded after the TTL"""
+
+    now = [0.0]
+    cache = TTLCache(ttl=5, clock=lambda: now[0])
+    loads = []
+
+    def loader():
+        loads.append(now[0])
+        return len(loads)
+
+    assert cache.get("key", loader) == 1
+    assert cache.get("key", loader) == 1
+    now[0] = 6.0
+    assert cache.get("key", loader) == 2
+    cache.invalidate()
+    assert cache.get("key", loader) == 3
+    assert len(loads) == 3
+
+
+def test_ttl_cache_invalidated_during_load():
+    """A value loaded before an invalidation must not be stored"""
+
+    cache = TTLCache(ttl=5)
+
+    def loader():
+        cache.invalidate()
+        return "stale"
+
+    assert cache.get("key", loader) == "stale"
+    assert "key" not in cache
+
+
+def test_lazy_list_is_not_loaded_until_used():
+    """Testing that the lazy list calls the loader only on access"""
+
+    lazy = LazyList(lambda: [1, 2, 3])
+    assert not lazy.loaded
+    assert list(lazy) == [1, 2, 3]
+    assert lazy.loaded
+    assert len(lazy) == 3
+
+
+def test_context_processor_is_lazy(app):
+    """Templates that do not use `parkings` do not load the parking list"""
+
+    cache = app.extensions["parkings_cache"]
+    with app.test_request_context("/"):
+        assert render_template_string("hello") == "hello"
+        assert "parkings" not in cache
+        names = render_template_string("{% for p in parkings %}{{ p.id }};{% endfor %}")
+    assert names == "1;2;"
+    assert "parkings" in cache
+
+
+def test_parkings_cache_invalidated_on_write(client, app):
+    """The cached parking list is dropped after a check-in"""
+
+    cache = app.extensions["parkings_cache"]
+    client.get("/")
+    assert "parkings" in cache
+    client.post("/client_parkings", json={"client_id": 1, "parking_id": 1})
+    assert "parkings" not in cache
@@ -1,8 +1,11 @@
+import io
 from datetime import datetime
 
 import pytest
 from flask import Flask
 
+from src.parking.models import Parking
+
 
 def test_create_app(app):
     """Testing a created application is Flask"""
@@ -151,17 +154,37 @@ def test_not_client_card(client):
 def test_departure_on_parking(client):
     """
     Method DELETE
-    Testing departure from the parking lot.
+    Testing departure from the parking lot after the arrival.
     Initially free parking spaces (Parking.count_available_places) = 8
     """
 
     data = {"client_id": 1, "parking_id": 1}
+    client.post("/client_parkings", json=data)
     departure = client.delete("/client_parkings", json=data)
     assert departure.status_code == 201
-    assert departure.json["departure"]["parking"]["count_available_places"] == 9
+    assert departure.json["departure"]["parking"]["count_available_places"] == 8
+    assert departure.json["departure"]["departure"]["time_out"]
     assert departure.json["departure"]["payment"]
 
 
+def test_departure_twice(client):
+    """
+    A finished visit can't be closed again, a client can park
+    at the same parking lot several times.
+    """
+
+    data = {"client_id": 1, "parking_id": 1}
+    assert client.delete("/client_parkings", json=data).status_code == 404
+    for _ in range(2):
+        assert client.post("/client_parkings", json=data).status_code == 201
+        assert client.delete("/client_parkings", json=data).status_code == 201
+    departure = client.delete("/client_parkings", json=data)
+    assert departure.status_code == 404
+    assert "Not available" in departure.json
+    parking = client.get("/parkings/1").json["parking"]
+    assert parking["count_available_places"] == 8
+
+
 def test_departure_not_client_parking(client):
     """Checking for errors when paying for parking"""
 
@@ -193,3 +216,235 @@ def test_route_status_method_get(client, route):
     """Checking paths for get requests"""
     route_status = client.get(route)
     assert route_status.status_code == 200
+
+
+def test_arrival_takes_last_place(client, db):
+    """
+    Taking the last place closes the parking lot in the same statement,
+    the next arrival is refused without overselling the places.
+    """
+
+    db.session.get(Parking, 1).count_available_places = 1
+    db.session.commit()
+
+    data = {"client_id": 1, "parking_id": 1}
+    arrival = client.post("/client_parkings", json=data)
+    assert arrival.status_code == 201
+    assert arrival.json["client"]["parking"]["count_available_places"] == 0
+    assert arrival.json["client"]["parking"]["opened"] is False
+
+    refused = client.post("/client_parkings", json=data)
+    assert refused.status_code == 404
+    assert "No place" in refused.json
+    parking = client.get("/parkings/1").json["parking"]
+    assert parking["count_available_places"] == 0
+
+
+def test_departure_reopens_parking(client, db):
+    """Departure from a closed parking lot opens it again"""
+
+    data = {"client_id": 1, "parking_id": 1}
+    client.post("/client_parkings", json=data)
+    db.session.get(Parking, 1).opened = False
+    db.session.commit()
+    departure = client.delete("/client_parkings", json=data)
+    assert departure.json["departure"]["parking"]["opened"] is True
+
+
+def test_arrival_unknown_parking(client):
+    """Arrival to a non-existent parking lot"""
+
+    arrival = client.post("/client_parkings", json={"client_id": 1, "parking_id": 9})
+    assert arrival.status_code == 404
+    assert "Not found" in arrival.json
+
+
+def test_get_clients_keyset_pages(client):
+    """Testing the keyset pagination of /clients with `limit` and `after`"""
+
+    first = client.get("/clients?limit=1")
+    assert first.status_code == 200
+    assert [c["id"] for c in first.json["clients"]] == [1]
+    assert first.json["next"] == 1
+
+    second = client.get(f"/clients?limit=1&after={first.json['next']}")
+    assert [c["name"] for c in second.json["clients"]] == ["Bob"]
+
+    last = client.get("/clients?limit=1&after=2")
+    assert last.json["clients"] == []
+    assert last.json["next"] is None
+
+
+@pytest.mark.parametrize(
+    "route, key", [("/clients", "clients"), ("/parkings", "parkings")]
+)
+def test_get_list_stream(client, route, key):
+    """Testing the streaming mode of the lists"""
+
+    resp = client.get(f"{route}?stream=1")
+    assert resp.status_code == 200
+    assert resp.is_streamed
+    assert [row["id"] for row in resp.json[key]] == [1, 2]
+
+    resp = client.get(f"{route}?stream=1&after=1")
+    assert [row["id"] for row in resp.json[key]] == [2]
+
+
+def test_client_parkings_batch(client):
+    """
+    Testing the batch of gate events: the rules of /client_parkings are applied
+    to every event and the results are returned in the order of the request.
+    """
+
+    events = [
+        {"client_id": 1, "parking_id": 1, "action": "arrival"},
+        {"client_id": 2, "parking_id": 1, "action": "arrival"},
+        {"client_id": 1, "parking_id": 2, "action": "arrival"},
+        {
+            "client_id": 1,
+            "parking_id": 1,
+            "action": "departure",
+            "time": "2030-01-01T12:00:00",
+        },
+        {"client_id": 1, "parking_id": 9, "action": "arrival"},
+        {"client_id": 1, "action": "arrival"},
+    ]
+    resp = client.post("/client_parkings/batch", json={"events": events})
+    assert resp.status_code == 200
+    results = resp.json["results"]
+    assert results[0]["status"] == 201
+    assert results[0]["arrival"]["time_in"]
+    assert results[1] == {"status": 404, "error": "Link the card to your account"}
+    assert results[2] == {"status": 404, "error": "No place"}
+    assert results[3]["departure"]["id"] == results[0]["arrival"]["id"]
+    assert results[3]["departure"]["time_out"] == "Tue, 01 Jan 2030 12:00:00 GMT"
+    assert results[4] == {"status": 404, "error": "Not found"}
+    assert results[5]["status"] == 400
+
+    parking = client.get("/parkings/1").json["parking"]
+    assert parking["count_available_places"] == 8
+    assert parking["opened"]
+
+
+def test_client_parkings_batch_closes_parking(client, db):
+    """Arrivals in a batch close the parking lot on the last place"""
+
+    db.session.get(Parking, 1).count_available_places = 2
+    db.session.commit()
+
+    events = [{"client_id": 1, "parking_id": 1, "action": "arrival"}] * 3
+    resp = client.post("/client_parkings/batch", json=events)
+    assert [r["status"] for r in resp.json["results"]] == [201, 201, 404]
+    assert resp.json["parkings"] == [
+        {"id": 1, "opened": False, "count_available_places": 0}
+    ]
+
+
+def test_clients_bulk_json(client):
+    """Bulk creation of clients with conflicts reported per row"""
+
+    rows = [
+        {"name": "A", "surname": "A", "credit_card": "1", "car_number": "A001AA"},
+        {"name": "B", "surname": "B", "car_number": "X123OO42"},
+        {"name": "C", "surname": "C", "car_number": "A001AA"},
+        {"name": "D", "surname": "D"},
+        {"name": "E", "surname": "E", "car_number": "E005EE"},
+    ]
+    resp = client.post("/clients/bulk", json=rows)
+    assert resp.status_code == 201
+    assert resp.json["created"] == 2
+    conflicts = {c["row"]: c["error"] for c in resp.json["conflicts"]}
+    assert conflicts == {1: "already exists", 2: "duplicate"}
+    assert [e["row"] for e in resp.json["errors"]] == [3]
+    assert len(client.get("/clients").json["clients"]) == 4
+
+
+def test_clients_bulk_ndjson(client):
+    """Bulk creation of clients from NDJSON"""
+
+    body = (
+        '{"name": "A", "surname": "A", "car_number": "A001AA"}\n'
+        "not json\n"
+        '{"name": "B", "surname": "B", "car_number": "B002BB"}\n'
+    )
+    resp = client.post("/clients/bulk", data=body, content_type="application/x-ndjson")
+    assert resp.json["created"] == 2
+    assert [e["row"] for e in resp.json["errors"]] == [1]
+
+
+def test_parkings_bulk_csv_upload(client):
+    """Bulk creation of parking lots from an uploaded CSV file"""
+
+    body = (
+        "address,name,opened,count_places\n"
+        "Moscow 1,First,true,10\n"
+        '"Новосибирск, Ватутина, 27",Dup,true,5\n'
+        "Moscow 2,Second,no,7\n"
+    ).encode()
+    resp = client.post(
+        "/parkings/bulk",
+        data={"file": (io.BytesIO(body), "parkings.csv")},
+        content_type="multipart/form-data",
+    )
+    assert resp.status_code == 201
+    assert resp.json["created"] == 2
+    assert resp.json["conflicts"][0]["row"] == 1
+    parkings = client.get("/parkings").json["parkings"]
+    assert [p["count_available_places"] for p in parkings[2:]] == [10, 7]
+    assert [p["opened"] for p in parkings[2:]] == [True, False]
+
+
+def test_bulk_bad_body(client):
+    """A body that is not a list of rows"""
+
+    resp = client.post("/parkings/bulk", json={"name": "x"})
+    assert resp.status_code == 400
+
+
+def test_bulk_broken_body(client):
+    """The rows read before a broken byte are committed and reported"""
+
+    rows = "".join(f"Street {n},{n % 10 + 1}\n" for n in range(1000))
+    body = ("address,count_places\n" + rows).encode() + b"\xff,1\n"
+    assert client.get("/parkings").json["parkings"]
+    resp = client.post("/parkings/bulk", data=body, content_type="text/csv")
+    assert resp.status_code == 400
+    report = resp.json
+    assert not report["complete"]
+    assert 0 < report["created"] == report["committed"] < 1000
+    assert report["failed"] == 1
+    assert report["errors"][0]["error"].startswith("unreadable body")
+    parkings = client.get("/parkings").json["parkings"]
+    assert len(parkings) == 2 + report["created"]
+
+
+def test_bulk_retry_is_replayed(client):
+    rows = [{"name": "A", "surname": "A", "car_number": "A001AA"}]
+    headers = {"Idempotency-Key": "import-1"}
+    first = client.post("/clients/bulk", json=rows, headers=headers)
+    retry = client.post("/clients/bulk", json=rows, headers=headers)
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.json == first.json
+    assert first.json["created"] == 1
+    assert len(client.get("/clients").json["clients"]) == 3
+
+
+def test_client_parkings_batch_event_times(client):
+    """An offset of the controller is converted, a departure before the arrival is refused"""
+
+    arrival = {"client_id": 1, "parking_id": 1, "action": "arrival"}
+    departure = dict(arrival, action="departure")
+    events = [
+        arrival,
+        dict(departure, time="2000-01-01T12:00:00"),
+        dict(departure, time="2030-01-01T12:00:00+03:00"),
+    ]
+    resp = client.post("/client_parkings/batch", json={"events": events})
+    assert resp.status_code == 200
+    results = resp.json["results"]
+    assert results[1] == {"status": 400, "error": "The departure precedes the arrival"}
+    assert results[2]["status"] == 201
+    local = datetime.fromisoformat("2030-01-01T12:00:00+03:00").astimezone()
+    assert results[2]["departure"]["time_out"] == local.strftime(
+        "%a, %d %b %Y %H:%M:%S GMT"
+    )
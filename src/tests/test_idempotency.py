@@ -0,0 +1,188 @@
+import threading
+
+from sqlalchemy import func, select
+
+from src.parking.idempotency import (
+    BUSY,
+    LOST,
+    NEW,
+    REPLAY,
+    IdempotencyStore,
+    StoredResponse,
+)
+from src.parking.models import ClientParking, IdempotencyKey
+
+ARRIVAL = {"client_id": 1, "parking_id": 1}
+
+
+def visits(db):
+    return db.session.scalar(select(func.count()).select_from(ClientParking))
+
+
+def test_retry_is_replayed(client, db):
+    """A retried arrival is answered from the store, the place is taken once"""
+
+    headers = {"Idempotency-Key": "gate-1-0001"}
+    first = client.post("/client_parkings", json=ARRIVAL, headers=headers)
+    assert first.status_code == 201
+    assert "Idempotent-Replayed" not in first.headers
+
+    retry = client.post("/client_parkings", json=ARRIVAL, headers=headers)
+    assert retry.status_code == 201
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.json == first.json
+    assert visits(db) == 3
+    parking = client.get("/parkings/1").json["parking"]
+    assert parking["count_available_places"] == 7
+
+    # the store of the other workers (the table) answers too
+    client.application.extensions["idempotency"].cache.clear()
+    retry = client.post("/client_parkings", json=ARRIVAL, headers=headers)
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert visits(db) == 3
+
+
+def test_keys_are_scoped(client, db):
+    headers = {"Idempotency-Key": "same"}
+    client.post("/client_parkings", json=ARRIVAL, headers=headers)
+    departure = client.delete("/client_parkings", json=ARRIVAL, headers=headers)
+    assert departure.status_code == 201
+    assert "Idempotent-Replayed" not in departure.headers
+
+    # without a key every request runs
+    client.post("/client_parkings", json=ARRIVAL)
+    client.post("/client_parkings", json=ARRIVAL)
+    assert visits(db) == 5
+
+
+def test_key_reused_with_another_body(client):
+    headers = {"Idempotency-Key": "k"}
+    client.post("/client_parkings", json=ARRIVAL, headers=headers)
+    other = client.post(
+        "/client_parkings", json={"client_id": 1, "parking_id": 2}, headers=headers
+    )
+    assert other.status_code == 422
+
+
+def test_refusal_is_replayed(client):
+    """A 4xx answer is final for its key, as the first request saw it"""
+
+    headers = {"Idempotency-Key": "k"}
+    data = {"client_id": 1, "parking_id": 2}
+    assert (
+        client.post("/client_parkings", json=data, headers=headers).status_code == 404
+    )
+    retry = client.post("/client_parkings", json=data, headers=headers)
+    assert retry.status_code == 404
+    assert retry.headers["Idempotent-Replayed"] == "true"
+
+
+def test_failed_request_releases_key(client, db, monkeypatch):
+    headers = {"Idempotency-Key": "k"}
+    client.application.config["PROPAGATE_EXCEPTIONS"] = False
+    monkeypatch.setattr(
+        "src.parking.live.AvailabilityFeed.notify",
+        lambda *args: (_ for _ in ()).throw(RuntimeError("down")),
+    )
+    response = client.post("/client_parkings", json=ARRIVAL, headers=headers)
+    assert response.status_code == 500
+    assert db.session.scalars(select(IdempotencyKey)).all() == []
+
+    monkeypatch.undo()
+    response = client.post("/client_parkings", json=ARRIVAL, headers=headers)
+    assert response.status_code == 201
+    assert visits(db) == 3
+
+
+def test_committed_write_is_not_run_again(client, db, monkeypatch):
+    """The worker dies between the commit of the arrival and the response"""
+
+    headers = {"Idempotency-Key": "k"}
+    client.application.config["PROPAGATE_EXCEPTIONS"] = False
+    monkeypatch.setattr(
+        "src.parking.idempotency.IdempotencyStore.complete",
+        lambda *args: (_ for _ in ()).throw(RuntimeError("killed")),
+    )
+    response = client.post("/client_parkings", json=ARRIVAL, headers=headers)
+    assert response.status_code == 500
+    assert visits(db) == 3
+    monkeypatch.undo()
+
+    # the first request might still store its response
+    retry = client.post("/client_parkings", json=ARRIVAL, headers=headers)
+    assert (retry.status_code, retry.headers["Retry-After"]) == (409, "1")
+    # its lease is over: the response is lost, the arrival is not run again
+    client.application.extensions["idempotency"].lock_timeout = 0
+    retry = client.post("/client_parkings", json=ARRIVAL, headers=headers)
+    assert retry.status_code == 409
+    assert "Retry-After" not in retry.headers
+    assert visits(db) == 3
+
+
+def test_store_written(app, db):
+    now = [1_000_000.0]
+    store = IdempotencyStore(ttl=60, lock_timeout=5, clock=lambda: now[0])
+    assert store.reserve("key", "body-hash") == (NEW, None)
+    with store.writing("key"):
+        db.session.commit()
+    store.release("key")
+    assert store.reserve("key", "body-hash") == (BUSY, None)
+    now[0] += 6
+    assert store.reserve("key", "body-hash") == (LOST, None)
+    # a rolled back write does not mark its key
+    assert store.reserve("other", "body-hash") == (NEW, None)
+    with store.writing("other"):
+        db.session.rollback()
+    now[0] += 6
+    assert store.reserve("other", "body-hash") == (NEW, None)
+
+    # kept as long as a response
+    now[0] += 60
+    assert store.reserve("key", "body-hash") == (NEW, None)
+
+
+def test_other_threads_do_not_mark_the_key(app, db):
+    """The commits of the concurrent requests (gthread) are not the write"""
+
+    store = IdempotencyStore(ttl=60, lock_timeout=5)
+    assert store.reserve("key", "body-hash") == (NEW, None)
+
+    def other_request():
+        with app.app_context():
+            assert store.reserve("other", "body-hash") == (NEW, None)
+            db.session.commit()
+
+    with store.writing("key"):
+        thread = threading.Thread(target=other_request)
+        thread.start()
+        thread.join()
+    status = select(IdempotencyKey.key, IdempotencyKey.status)
+    assert dict(db.session.execute(status).all()) == {"key": None, "other": None}
+    store.release("key")
+    assert db.session.scalars(select(IdempotencyKey.key)).all() == ["other"]
+
+
+def test_store_reservation(app, db):
+    now = [1_000_000.0]
+    store = IdempotencyStore(ttl=60, lock_timeout=5, clock=lambda: now[0])
+    response = StoredResponse("body-hash", 201, b"{}", "application/json")
+
+    assert store.reserve("key", "body-hash") == (NEW, None)
+    # the first request is still running
+    assert store.reserve("key", "body-hash") == (BUSY, None)
+    # its worker died: the reservation expires
+    now[0] += 6
+    assert store.reserve("key", "body-hash") == (NEW, None)
+    store.complete("key", response)
+    store.cache.clear()
+    assert store.reserve("key", "body-hash") == (REPLAY, response)
+
+    # the response expires after the ttl, the expired rows are purged
+    now[0] += 61
+    store.cache.clear()
+    assert store.reserve("key", "body-hash") == (NEW, None)
+    store.purge_interval = 0
+    now[0] += 10
+    store.reserve("other", "x")
+    keys = db.session.scalars(select(IdempotencyKey.key)).all()
+    assert keys == ["other"]
@@ -0,0 +1,190 @@
+import os
+import uuid
+
+import pytest
+from sqlalchemy.pool import NullPool
+
+from src.parking.engine import TimedNullPool, TimedQueuePool, pool_wait, timed_pool
+from src.parking.limits import Buckets, MemoryBuckets, SharedBuckets, SharedInflight
+
+ARRIVAL = {"client_id": 1, "parking_id": 1}
+PARKING = {
+    "address": "A",
+    "name": "N",
+    "opened": True,
+    "count_places": 5,
+    "count_available_places": 5,
+}
+CLIENT = {"name": "A", "surname": "B", "credit_card": "", "car_number": "A001MP77"}
+
+
+@pytest.fixture()
+def app_config():
+    return {
+        "LIMITS_BACKEND": "memory",
+        "RATE_LIMIT_READ_RATE": 1,
+        "RATE_LIMIT_READ_BURST": 3,
+        "RATE_LIMIT_WRITE_RATE": 0,
+        "SHED_READ_INFLIGHT": 2,
+        "SHED_WRITE_INFLIGHT": 4,
+        "SHED_POOL_WAIT_MS": 100,
+    }
+
+
+@pytest.fixture()
+def limiter(app):
+    limiter = app.extensions["limiter"]
+    yield limiter
+    pool_wait.value = 0.0
+
+
+@pytest.mark.parametrize("buckets", ["memory", "shared"])
+def test_token_bucket(buckets):
+    store: Buckets
+    if buckets == "memory":
+        store = MemoryBuckets()
+    else:
+        store = SharedBuckets(f"parking_test_{uuid.uuid4().hex[:8]}", capacity=64)
+    try:
+        assert [store.take("a", 2, 3, now=100.0) for _ in range(3)] == [0, 0, 0]
+        assert store.take("a", 2, 3, now=100.0) == pytest.approx(0.5)
+        # another client has its own bucket
+        assert store.take("b", 2, 3, now=100.0) == 0
+        # refilled with the rate, up to the burst
+        assert store.take("a", 2, 3, now=100.5) == 0
+        assert store.take("a", 2, 3, now=100.5) == pytest.approx(0.5)
+        assert [store.take("a", 2, 3, now=200.0) for _ in range(4)][-1] > 0
+    finally:
+        if isinstance(store, SharedBuckets):
+            store.unlink()
+
+
+def test_shared_inflight_between_workers(monkeypatch):
+    """The requests of all the workers are counted, a dead worker is forgotten"""
+
+    name = f"parking_test_{uuid.uuid4().hex[:8]}"
+    first = SharedInflight(name, capacity=4)
+    second = SharedInflight(name, capacity=4)
+    try:
+        first.add(1)
+        first.add(1)
+        assert second.total() == 2
+
+        # the other worker: another pid, then killed
+        monkeypatch.setattr(os, "getpid", lambda: 4_000_000)
+        second.add(1)
+        assert first.total() == 3
+        # the limits in flight are per process
+        assert first.processes() == 2
+        monkeypatch.undo()
+        first.add(-1)
+        assert first.total() == 2
+
+        third = SharedInflight(name, capacity=4)
+        monkeypatch.setattr(os, "getpid", lambda: 4_000_001)
+        third.add(1)
+        monkeypatch.undo()
+        assert first.total() == 2
+        third.close()
+    finally:
+        second.close()
+        first.unlink()
+
+
+def test_rate_limited_reads(client, limiter):
+    for _ in range(3):
+        assert client.get("/parkings/1").status_code == 200
+    response = client.get("/parkings/1")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+
+    # the gates and the other writes are not limited
+    for _ in range(5):
+        assert client.post("/client_parkings", json=ARRIVAL).status_code == 201
+        assert client.get("/clients/lookup?plate=X123OO42").status_code == 200
+    assert client.get("/metrics").status_code == 404
+    assert limiter.inflight.total() == 0
+
+
+def test_reads_are_shed_first(client, limiter):
+    """A storm of reads holds the workers: the reads are refused, not the gates"""
+
+    limiter.rates.clear()
+    # two slow reads of other clients in flight
+    limiter.inflight.add(2)
+    response = client.get("/parkings")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert client.post("/parkings", json=PARKING).status_code == 201
+    assert client.post("/client_parkings", json=ARRIVAL).status_code == 201
+
+    limiter.inflight.add(2)
+    assert client.post("/parkings", json=PARKING).status_code == 503
+    assert client.delete("/client_parkings", json=ARRIVAL).status_code == 201
+
+    limiter.inflight.add(-4)
+    assert client.get("/parkings").status_code == 200
+    assert limiter.inflight.total() == 0
+
+
+def test_live_feeds_are_not_in_flight(client, limiter):
+    """The live feeds wait on their threads: they do not shed the other reads"""
+
+    limiter.rates.clear()
+    limiter.inflight.add(2)
+    assert client.get("/parkings").status_code == 503
+    assert client.get("/parkings/changes?timeout=0").status_code == 200
+    limiter.inflight.add(-2)
+
+    client.get("/parkings/changes?timeout=0")
+    assert limiter.inflight.total() == 0
+    # refused on the wait for a connection
+    pool_wait.value = 0.15
+    assert client.get("/parkings/changes?timeout=0").status_code == 503
+
+
+def test_live_feeds_are_rate_limited(client, limiter):
+    for _ in range(3):
+        assert client.get("/parkings/changes?timeout=0").status_code == 200
+    # the tokens of the reads
+    assert client.get("/parkings/1").status_code == 429
+
+
+@pytest.mark.parametrize("app_config", [{"LIMITS_BACKEND": "memory"}])
+def test_clients_without_proxy_fix(client, limiter):
+    limiter.rates["read"] = (1, 1)
+    headers = {"X-Forwarded-For": "10.0.0.1"}
+    assert client.get("/parkings/1", headers=headers).status_code == 200
+    # an untrusted header is ignored: the same peer
+    headers = {"X-Forwarded-For": "10.0.0.2"}
+    assert client.get("/parkings/1", headers=headers).status_code == 429
+
+
+@pytest.mark.parametrize(
+    "app_config", [{"LIMITS_BACKEND": "memory", "PROXY_FIX_HOPS": 1}]
+)
+def test_clients_behind_proxy(client, limiter):
+    """Every client behind the trusted proxy has its own bucket"""
+
+    limiter.rates["read"] = (1, 1)
+    for address in ("10.0.0.1", "10.0.0.2"):
+        headers = {"X-Forwarded-For": address}
+        assert client.get("/parkings/1", headers=headers).status_code == 200
+    headers = {"X-Forwarded-For": "10.0.0.1"}
+    assert client.get("/parkings/1", headers=headers).status_code == 429
+
+
+def test_shed_on_pool_wait(client, limiter):
+    limiter.rates.clear()
+    pool_wait.value = 0.15
+    assert client.get("/parkings").status_code == 503
+    assert client.post("/clients", json=CLIENT).status_code == 201
+    pool_wait.value = 0.25
+    assert client.post("/clients", json=CLIENT).status_code == 503
+    assert client.post("/client_parkings", json=ARRIVAL).status_code == 201
+
+
+def test_timed_pool():
+    assert timed_pool({}) == {}
+    assert timed_pool({"pool_size": 5})["poolclass"] is TimedQueuePool
+    assert timed_pool({"poolclass": NullPool}) == {"poolclass": TimedNullPool}
@@ -0,0 +1,180 @@
+import os
+import threading
+
+import pytest
+
+from src.parking.live import AvailabilityFeed, create_feed
+
+
+@pytest.fixture()
+def app_config():
+    return {"LIVE_STREAM_TIMEOUT": 0.2, "LIVE_HEARTBEAT": 0.1, "LIVE_POLL_TIMEOUT": 1}
+
+
+def test_feed_coalesces_deltas():
+    """The changes since a cursor hold the latest state of every parking lot"""
+
+    feed = AvailabilityFeed()
+    cursor = feed.cursor
+    feed.publish([{"id": 1, "count_available_places": 7, "opened": True}])
+    feed.publish([{"id": 1, "count_available_places": 6, "opened": True}])
+    feed.publish([{"id": 2, "count_available_places": 0, "opened": False}])
+
+    changes, cursor = feed.wait(cursor, 0)
+    assert changes == [
+        {"id": 1, "count_available_places": 6, "opened": True},
+        {"id": 2, "count_available_places": 0, "opened": False},
+    ]
+    assert feed.wait(cursor, 0) == ([], cursor)
+
+
+def test_feed_unknown_cursor_needs_snapshot():
+    """A missing, foreign or evicted cursor is answered with None"""
+
+    feed = AvailabilityFeed(size=2)
+    cursor = feed.cursor
+    assert feed.wait(None, 0)[0] is None
+    assert feed.wait("abc-1", 0)[0] is None
+
+    for places in range(3):
+        feed.publish([{"id": 1, "count_available_places": places, "opened": True}])
+    assert feed.wait(cursor, 0)[0] is None
+
+    cursor = feed.cursor
+    feed.reset()
+    assert feed.wait(cursor, 0)[0] is None
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_feed_cursor_after_fork():
+    """A cursor of the master (preload_app) is not valid in a forked worker"""
+
+    feed = AvailabilityFeed()
+    feed.publish([{"id": 1, "count_available_places": 7, "opened": True}])
+    cursor = feed.cursor
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover
+        os._exit(0 if feed.wait(cursor, 0)[0] is None else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    assert feed.wait(cursor, 0)[0] == []
+
+
+def test_feed_wakes_subscribers():
+    feed = AvailabilityFeed()
+    cursor = feed.cursor
+    received = []
+    subscribers = [
+        threading.Thread(target=lambda: received.append(feed.wait(cursor, 5)[0]))
+        for _ in range(5)
+    ]
+    for subscriber in subscribers:
+        subscriber.start()
+    feed.publish([{"id": 1, "count_available_places": 3, "opened": True}])
+    for subscriber in subscribers:
+        subscriber.join()
+    assert received == [[{"id": 1, "count_available_places": 3, "opened": True}]] * 5
+
+
+def test_feed_shares_snapshot():
+    feed = AvailabilityFeed()
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return []
+
+    assert feed.snapshot(loader) == ([], feed.cursor)
+    feed.snapshot(loader)
+    assert len(loads) == 1
+    feed.publish([{"id": 1, "count_available_places": 3, "opened": True}])
+    feed.snapshot(loader)
+    assert len(loads) == 2
+
+
+def test_long_poll_after_arrival(client):
+    """The long-poll returns a snapshot, then the delta of the arrival"""
+
+    response = client.get("/parkings/changes?timeout=0")
+    assert response.json["snapshot"] is True
+    assert {
+        "id": 1,
+        "count_available_places": 8,
+        "opened": True,
+    } in response.json["parkings"]
+    cursor = response.json["cursor"]
+
+    arrival = client.post("/client_parkings", json={"client_id": 1, "parking_id": 1})
+    assert arrival.status_code == 201
+
+    response = client.get(f"/parkings/changes?cursor={cursor}")
+    assert response.json["snapshot"] is False
+    assert response.json["parkings"] == [
+        {"id": 1, "count_available_places": 7, "opened": True}
+    ]
+
+    cursor = response.json["cursor"]
+    response = client.get(f"/parkings/changes?cursor={cursor}&timeout=0")
+    assert response.json["parkings"] == []
+
+
+def test_event_stream(client):
+    """The stream starts with a snapshot and resumes from `Last-Event-ID`"""
+
+    response = client.get("/parkings/events")
+    assert response.mimetype == "text/event-stream"
+    body = response.get_data(as_text=True)
+    assert "event: snapshot" in body
+    assert ": heartbeat" in body
+    cursor = body.split("id: ")[1].split("\n")[0]
+
+    client.post("/client_parkings", json={"client_id": 1, "parking_id": 1})
+    body = client.get("/parkings/events", headers={"Last-Event-ID": cursor}).get_data(
+        as_text=True
+    )
+    assert "event: snapshot" not in body
+    assert "event: delta" in body
+    assert '"count_available_places":7' in body.replace(" ", "")
+
+
+def test_feed_subscribers():
+    feed = AvailabilityFeed(max_streams=3, max_client_streams=2)
+    assert feed.join("a") and feed.join("a")
+    assert not feed.join("a")
+    assert feed.join("b")
+    # the worker is full
+    assert not feed.join("c")
+    feed.leave("a")
+    assert feed.join("c")
+    assert feed.subscribers() == 3
+
+
+@pytest.mark.parametrize(
+    "app_config",
+    [{"LIVE_STREAM_TIMEOUT": 0.2, "LIVE_HEARTBEAT": 0.1, "LIVE_MAX_CLIENT_STREAMS": 1}],
+)
+def test_streams_of_a_client_are_limited(client):
+    """An open stream holds a thread: the client gets 503 above its limit"""
+
+    live = client.application.extensions["live"]
+    stream = client.get("/parkings/events")
+    assert live.subscribers() == 1
+    for path in ("/parkings/events", "/parkings/changes?timeout=0"):
+        response = client.get(path)
+        assert (response.status_code, response.headers["Retry-After"]) == (503, "1")
+    stream.close()
+    assert live.subscribers() == 0
+    assert client.get("/parkings/changes?timeout=0").status_code == 200
+    assert live.subscribers() == 0
+
+
+def test_listen_behind_pgbouncer():
+    """LISTEN is a state of the session: not through a transaction pooler"""
+
+    assert create_feed({}, "postgresql").channel == "parking_availability"
+    with pytest.raises(ValueError):
+        create_feed({}, "postgresql", pgbouncer=True)
+    assert create_feed({}, "sqlite", pgbouncer=True).channel is None
+    direct = "postgresql://parking@db:5432/parking"
+    feed = create_feed({"LIVE_LISTEN_URL": direct}, "postgresql", pgbouncer=True)
+    assert feed.listen_url == direct
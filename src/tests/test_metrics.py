@@ -0,0 +1,61 @@
+import pytest
+
+from src.parking.metrics import Metrics, RequestStats
+
+
+@pytest.fixture()
+def app_config():
+    return {"METRICS_BACKEND": "memory"}
+
+
+def test_histograms_are_cumulative():
+    metrics = Metrics(["parkings"])
+    stats = RequestStats()
+    stats.queries, stats.db_time, stats.slowest = 3, 0.02, 0.015
+    metrics.record("parkings", 200, stats)
+    metrics.record("unknown", 404, RequestStats())
+
+    text = metrics.render()
+    assert 'parking_requests_total{endpoint="parkings",status="2xx"} 1' in text
+    assert 'parking_requests_total{endpoint="other",status="4xx"} 1' in text
+    assert 'parking_request_queries_bucket{endpoint="parkings",le="2"} 0' in text
+    assert 'parking_request_queries_bucket{endpoint="parkings",le="3"} 1' in text
+    assert 'parking_request_queries_bucket{endpoint="parkings",le="+Inf"} 1' in text
+    assert 'parking_request_queries_sum{endpoint="parkings"} 3.0' in text
+    assert 'parking_request_db_seconds_sum{endpoint="parkings"} 0.02' in text
+    assert 'parking_slowest_query_seconds{endpoint="parkings"} 0.015' in text
+
+
+def test_server_timing(client):
+    """The header reports the statements of the request"""
+
+    # the first request checks the schema
+    client.get("/parkings/1")
+    response = client.get("/parkings/1")
+    timing = response.headers["Server-Timing"]
+    assert 'desc="1 queries"' in timing
+    assert "db-slowest;dur=" in timing
+    assert "total;dur=" in timing
+
+
+def test_metrics_endpoint(client):
+    client.get("/parkings/1")
+    client.get("/parkings/1")
+    client.post("/client_parkings", json={"client_id": 1, "parking_id": 1})
+
+    response = client.get("/metrics")
+    assert response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    assert (
+        'parking_request_duration_seconds_count{endpoint="get_parking_by_id"} 2' in text
+    )
+    assert (
+        'parking_requests_total{endpoint="get_client_parkings",status="2xx"} 1' in text
+    )
+    assert "# TYPE parking_request_queries histogram" in text
+
+
+@pytest.mark.parametrize("app_config", [True])
+def test_metrics_disabled(client):
+    assert client.get("/metrics").status_code == 404
+    assert "Server-Timing" not in client.get("/parkings/1").headers
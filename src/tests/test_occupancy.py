@@ -0,0 +1,132 @@
+import uuid
+
+import pytest
+
+from src.parking.models import Parking
+from src.parking.occupancy import MemoryCounters, SharedCounters, create_occupancy
+
+
+@pytest.fixture()
+def app_config():
+    return {
+        "OCCUPANCY_BACKEND": "memory",
+        "OCCUPANCY_FLUSH_INTERVAL": 0,
+        "WEB_CONCURRENCY": 1,
+    }
+
+
+def test_memory_counters_rules():
+    """The last place closes the parking lot, a departure opens it again"""
+
+    counters = MemoryCounters()
+    counters.rebuild([(1, 1, True), (2, 5, False)])
+
+    assert counters.apply(1, -1) == (0, False)
+    assert counters.apply(1, -1) is None
+    assert counters.apply(2, -1) is None
+    assert counters.apply(3, -1) is None
+    assert counters.apply(1, 1) == (1, True)
+    assert counters.drain() == {1: (1, True)}
+    assert counters.drain() == {}
+
+
+def test_shared_counters_between_workers():
+    """Two attachments of the same segment see the same counters"""
+
+    name = f"parking_test_{uuid.uuid4().hex[:8]}"
+    first = SharedCounters(name, capacity=16)
+    second = SharedCounters(name, capacity=16)
+    try:
+        first.rebuild([(1, 2, True), (17, 1, True)])
+        second.rebuild([(1, 100, True)])
+
+        assert first.apply(1, -1) == (1, True)
+        assert second.apply(1, -1) == (0, False)
+        assert first.apply(1, -1) is None
+        assert second.apply(17, -1) == (0, False)
+        assert first.drain() == {1: (0, False), 17: (0, False)}
+        assert second.drain() == {}
+    finally:
+        second.close()
+        first.unlink()
+
+
+def test_shared_counters_dirty_slots():
+    """A flush reads the dirty slots only, the parking lot 0 is not an empty slot"""
+
+    name = f"parking_test_{uuid.uuid4().hex[:8]}"
+    counters = SharedCounters(name, capacity=16)
+    try:
+        counters.rebuild([(1, 2, True), (5, 1, True)])
+        assert counters.apply(0, -1) is None
+        assert counters.get(0) is None
+        counters.loader = lambda parking_id: (3, True) if parking_id == 0 else None
+        assert counters.apply(0, -1) == (2, True)
+        assert counters.apply(-1, -1) is None
+
+        assert counters.apply(5, -1) == (0, False)
+        assert counters.apply(5, 1) == (1, True)
+        counters.mark_dirty([5, 7])
+        assert counters.slots[1] == 2
+        assert counters.drain() == {0: (2, True), 5: (1, True)}
+        assert counters.drain() == {}
+    finally:
+        counters.unlink()
+
+
+def test_memory_counters_of_one_process():
+    config = {"OCCUPANCY_BACKEND": "memory", "OCCUPANCY_FLUSH_INTERVAL": 1}
+    with pytest.raises(ValueError):
+        create_occupancy(dict(config, WEB_CONCURRENCY=4))
+    assert create_occupancy(dict(config, WEB_CONCURRENCY=1)) is not None
+
+
+def test_arrival_with_write_behind(client, app, db):
+    """
+    The counters are rebuilt from the active visits, the arrival changes
+    only the counter until the writer flushes it to the database.
+    """
+
+    occupancy = app.extensions["occupancy"]
+    data = {"client_id": 1, "parking_id": 1}
+    arrival = client.post("/client_parkings", json=data)
+    assert arrival.status_code == 201
+    assert arrival.json["client"]["parking"]["count_available_places"] == 19
+    assert client.get("/parkings/1").json["parking"]["count_available_places"] == 19
+    assert db.session.get(Parking, 1).count_available_places == 8
+
+    assert occupancy.flush() == 1
+    db.session.expire_all()
+    assert db.session.get(Parking, 1).count_available_places == 19
+
+    departure = client.delete("/client_parkings", json=data)
+    assert departure.json["departure"]["parking"]["count_available_places"] == 20
+
+
+def test_list_filtered_by_counters(client, db):
+    """`min_free` and `opened` of the listing see the counters, not the table"""
+
+    def listed(query):
+        return [p["id"] for p in client.get(f"/parkings?{query}").json["parkings"]]
+
+    assert db.session.get(Parking, 1).count_available_places == 8
+    assert listed("min_free=20") == [1]
+    arrival = client.post("/client_parkings", json={"client_id": 1, "parking_id": 1})
+    assert arrival.status_code == 201
+    assert listed("min_free=20") == []
+    assert listed("min_free=19&opened=1&limit=10") == [1]
+    assert listed("opened=0&stream=1") == [2]
+    assert client.get("/parkings").json["parkings"][0]["count_available_places"] == 19
+
+
+def test_closed_parking_with_counters(client):
+    """A parking lot closed by hand stays closed after the rebuild"""
+
+    arrival = client.post("/client_parkings", json={"client_id": 1, "parking_id": 2})
+    assert arrival.status_code == 404
+    assert "No place" in arrival.json
+
+    events = [{"client_id": 1, "parking_id": 1, "action": "arrival"}] * 2
+    resp = client.post("/client_parkings/batch", json=events)
+    assert [r["status"] for r in resp.json["results"]] == [201, 201]
+    assert resp.json["parkings"][0]["count_available_places"] == 18
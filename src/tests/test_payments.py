@@ -0,0 +1,260 @@
+import datetime
+import time
+
+import pytest
+from sqlalchemy import select
+
+from src.parking.billing import rebill
+from src.parking.models import ClientParking, Payment, PaymentOutbox, Tariff
+from src.parking.payments import CANCELLED, CAPTURED, FAILED, PENDING
+
+LATER = datetime.timedelta(days=1)
+
+
+@pytest.fixture()
+def app_config():
+    return {"PAYMENT_PROCESSOR": "stub", "PAYMENT_INTERVAL": 0}
+
+
+@pytest.fixture()
+def worker(app, db):
+    worker = app.extensions["payments"]
+    worker.jitter = 0
+    db.session.add(Tariff(parking_id=1, minute_rate=10))
+    db.session.commit()
+    yield worker
+    worker.stop()
+
+
+def depart(client, db, minutes=30):
+    data = {"client_id": 1, "parking_id": 1}
+    client.post("/client_parkings", json=data)
+    visit = db.session.scalars(
+        select(ClientParking).order_by(ClientParking.id.desc())
+    ).first()
+    visit.time_in -= datetime.timedelta(minutes=minutes)
+    db.session.commit()
+    return client.delete("/client_parkings", json=data)
+
+
+def queued(db):
+    return db.session.scalars(select(PaymentOutbox)).one()
+
+
+def capture(db, key="visit:3"):
+    return db.session.scalars(select(PaymentOutbox).filter_by(key=key)).one()
+
+
+def test_departure_queues_capture(client, db, worker):
+    """The departure only writes the outbox row, the worker captures it"""
+
+    worker.processor.delay = 0.5
+    started = time.monotonic()
+    response = depart(client, db)
+    assert response.status_code == 201
+    assert time.monotonic() - started < 0.5
+    row = queued(db)
+    assert (row.key, row.amount, row.status) == ("visit:3", 310, PENDING)
+
+    assert worker.drain() == 1
+    db.session.expire_all()
+    row = queued(db)
+    assert (row.status, row.reference, row.attempts) == (CAPTURED, "stub-visit:3", 1)
+    assert worker.processor.captured == {"visit:3": 310}
+    assert worker.drain() == 0
+
+
+def test_free_visit_is_not_queued(client, db, worker):
+    db.session.get(Tariff, 1).free_minutes = 15
+    db.session.commit()
+    depart(client, db, minutes=10)
+    assert db.session.scalars(select(PaymentOutbox)).all() == []
+
+
+def test_rebill_then_drain(client, db, worker):
+    """The pending capture is re-billed with its payment, then captured"""
+
+    started = datetime.datetime.now()
+    depart(client, db)
+    db.session.get(Tariff, 1).minute_rate = 20
+    db.session.commit()
+    assert rebill(since=started) == {"billed": 2}
+    db.session.expire_all()
+    assert (capture(db).amount, capture(db).status) == (620, PENDING)
+    worker.drain()
+    assert worker.processor.captured["visit:3"] == 620
+
+    # a captured payment is not captured again, the difference is adjusted
+    db.session.get(Tariff, 1).minute_rate = 30
+    db.session.commit()
+    rebill(since=started)
+    db.session.expire_all()
+    assert (capture(db).amount, capture(db).status) == (620, CAPTURED)
+    adjustment = capture(db, "visit:3:1")
+    assert (adjustment.payment_key, adjustment.amount) == ("visit:3", 310)
+    worker.drain()
+    assert worker.processor.captured["visit:3"] == 620
+    assert worker.processor.captured["visit:3:1"] == 310
+
+    # a lower charge is refunded
+    db.session.get(Tariff, 1).minute_rate = 10
+    db.session.commit()
+    rebill(since=started)
+    worker.drain()
+    assert worker.processor.captured["visit:3:2"] == -620
+    charged = [
+        amount
+        for key, amount in worker.processor.captured.items()
+        if key.startswith("visit:3")
+    ]
+    billed = select(Payment.amount).filter_by(key="visit:3")
+    assert sum(charged) == db.session.scalars(billed).one() == 310
+
+
+def test_rebill_leaves_claimed_capture(client, db, worker):
+    """A claimed capture is made with its amount, the rest is adjusted"""
+
+    started = datetime.datetime.now()
+    depart(client, db)
+    worker.claim(db.session, datetime.datetime.now())
+    db.session.get(Tariff, 1).minute_rate = 20
+    db.session.commit()
+    rebill(since=started)
+    db.session.expire_all()
+    assert (capture(db).amount, capture(db).status) == (310, PENDING)
+    assert capture(db, "visit:3:1").amount == 310
+
+    # the pending adjustment takes the next change
+    db.session.get(Tariff, 1).minute_rate = 30
+    db.session.commit()
+    rebill(since=started)
+    db.session.expire_all()
+    assert capture(db, "visit:3:1").amount == 620
+    assert capture(db).amount == 310
+
+
+def test_rebill_queues_and_cancels(client, db, worker):
+    started = datetime.datetime.now()
+    db.session.get(Tariff, 1).free_minutes = 60
+    db.session.commit()
+    depart(client, db)
+    assert db.session.scalars(select(PaymentOutbox)).all() == []
+
+    # charged now
+    db.session.get(Tariff, 1).free_minutes = 0
+    db.session.commit()
+    rebill(since=started)
+    db.session.expire_all()
+    assert (capture(db).amount, capture(db).status) == (310, PENDING)
+
+    # free again
+    db.session.get(Tariff, 1).minute_rate = 0
+    db.session.commit()
+    rebill(since=started)
+    db.session.expire_all()
+    assert (capture(db).amount, capture(db).status) == (0, CANCELLED)
+    worker.drain()
+    assert "visit:3" not in worker.processor.captured
+
+
+def test_retry_with_backoff(client, db, worker):
+    depart(client, db)
+    worker.processor.errors["visit:3"] = 2
+
+    assert worker.drain() == 1
+    db.session.expire_all()
+    row = queued(db)
+    assert (row.status, row.attempts) == (PENDING, 1)
+    assert row.last_error.startswith("ConnectionError")
+    # not due before the backoff
+    assert worker.drain() == 0
+    assert row.next_attempt_at > datetime.datetime.now()
+
+    assert worker.drain(now=datetime.datetime.now() + LATER) == 1
+    assert worker.drain(now=datetime.datetime.now() + 2 * LATER) == 1
+    db.session.expire_all()
+    assert (queued(db).status, queued(db).attempts) == (CAPTURED, 3)
+
+
+def test_give_up(client, db, worker):
+    worker.max_attempts = 2
+    depart(client, db)
+    worker.processor.errors["visit:3"] = 5
+    worker.drain()
+    worker.drain(now=datetime.datetime.now() + LATER)
+    db.session.expire_all()
+    assert (queued(db).status, queued(db).attempts) == (FAILED, 2)
+    assert worker.drain(now=datetime.datetime.now() + 2 * LATER) == 0
+
+
+def test_declined(client, db, worker):
+    depart(client, db)
+    worker.processor.declined.add("visit:3")
+    worker.drain()
+    db.session.expire_all()
+    assert (queued(db).status, queued(db).last_error) == (FAILED, "Declined")
+
+
+def test_backoff_delay(worker):
+    worker.backoff, worker.max_backoff = 5, 30
+    assert [worker.delay(attempt) for attempt in (1, 2, 3, 4, 5)] == [5, 10, 20, 30, 30]
+
+
+def test_claimed_batch_is_leased(client, db, worker):
+    """A claimed capture is retried only after the lease of its worker"""
+
+    depart(client, db)
+    now = datetime.datetime.now()
+    assert len(worker.claim(db.session, now)) == 1
+    assert worker.claim(db.session, now) == []
+    later = now + datetime.timedelta(seconds=worker.lease + 1)
+    assert len(worker.claim(db.session, later)) == 1
+
+
+def test_batch_lease(worker):
+    """A batch is leased for the longest it may take"""
+
+    worker.lease, worker.threads, worker.capture_timeout = 60, 4, 10
+    assert worker.batch_lease(1) == 60
+    assert worker.batch_lease(100) == 250
+
+
+def test_stale_batch_does_not_overwrite(client, db, worker):
+    """The results of a batch are written only to the rows it still holds"""
+
+    depart(client, db)
+    now = datetime.datetime.now()
+    stale = worker.claim(db.session, now)
+    later = now + datetime.timedelta(seconds=worker.batch_lease(1) + 1)
+    claimed = worker.claim(db.session, later)
+    assert [capture[0] for capture in claimed] == [capture[0] for capture in stale]
+
+    worker._write(db.session, [worker._capture(capture) for capture in stale])
+    db.session.expire_all()
+    row = queued(db)
+    assert (row.status, row.attempts, row.claim) == (PENDING, 2, claimed[0][-1])
+
+    worker._write(db.session, [worker._capture(capture) for capture in claimed])
+    db.session.expire_all()
+    row = queued(db)
+    assert (row.status, row.claim) == (CAPTURED, None)
+
+
+def test_cancelled_row_is_not_overwritten(client, db, worker):
+    depart(client, db)
+    claimed = worker.claim(db.session, datetime.datetime.now())
+    row = queued(db)
+    row.status = CANCELLED
+    db.session.commit()
+
+    results = [worker._capture(capture) for capture in claimed]
+    assert results[0]["outcome"] == CAPTURED
+    worker._write(db.session, results)
+    db.session.expire_all()
+    assert queued(db).status == CANCELLED
+
+
+def test_capture_command(client, db, worker, runner):
+    depart(client, db)
+    result = runner.invoke(args=["capture-payments"])
+    assert "Processed captures: 1" in result.output
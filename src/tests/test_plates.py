@@ -0,0 +1,76 @@
+import pytest
+from sqlalchemy import event
+
+from src.parking.models import Client, normalize_plate
+
+
+@pytest.mark.parametrize(
+    "plate, normalized",
+    [
+        ("X123OO42", "X123OO42"),
+        ("х 123 оо 42", "X123OO42"),
+        ("Х123ОО-42", "X123OO42"),
+        ("a001mp 777", "A001MP777"),
+    ],
+)
+def test_normalize_plate(plate, normalized):
+    assert normalize_plate(plate) == normalized
+
+
+def lookup(client, *plates):
+    response = client.post("/clients/lookup", json={"plates": list(plates)})
+    assert response.status_code == 200
+    return [row["client"] and row["client"]["id"] for row in response.json["clients"]]
+
+
+def test_lookup(client):
+    # Cyrillic letters and spaces of the camera read
+    response = client.get("/clients/lookup?plate=х 123 оо 42")
+    assert response.status_code == 200
+    assert response.json["clients"][0]["client"]["name"] == "Alex"
+
+    assert lookup(client, "X153BB142", "x123oo42", "A000AA00") == [2, 1, None]
+    assert "plate" not in response.json["clients"][0]["client"]
+
+
+def test_lookup_cached(app, client, db):
+    """Several reads of one car cost one query, a new client is found at once"""
+
+    lookup(client, "A000AA00")
+    statements = []
+    event.listen(db.engine, "before_cursor_execute", lambda *a: statements.append(1))
+    lookup(client, "X123OO42", "Х123ОО42")
+    lookup(client, "X123OO42")
+    assert len(statements) == 1
+
+    assert lookup(client, "В777ВВ77") == [None]
+    response = client.post(
+        "/clients",
+        json={
+            "name": "Carl",
+            "surname": "Sagan",
+            "credit_card": "",
+            "car_number": "B777BB77",
+        },
+    )
+    assert response.status_code == 201
+    assert "plate" not in response.json["client"]
+    assert lookup(client, "В777ВВ77") == [3]
+    assert len(app.extensions["plate_index"].cache) == 1
+
+
+def test_lookup_bulk_created(client, db):
+    rows = [{"name": "D", "surname": "E", "car_number": "e 001 kx 54"}]
+    assert client.post("/clients/bulk", json=rows).status_code == 201
+    assert lookup(client, "E001KX54") == [3]
+    assert db.session.get(Client, 3).plate == "E001KX54"
+
+
+def test_lookup_bad_request(app, client):
+    app.config["PLATE_LOOKUP_MAX"] = 2
+    assert client.post("/clients/lookup", json={"plates": []}).status_code == 400
+    assert client.post("/clients/lookup", json={"plates": [1]}).status_code == 400
+    assert client.post("/clients/lookup", json=["A", "B", "C"]).status_code == 400
+    assert client.get("/clients/lookup").status_code == 400
+    assert client.get("/clients/lookup?plate=").status_code == 400
+    assert client.post("/clients/lookup", json=["A", " - "]).status_code == 400
@@ -0,0 +1,135 @@
+from typing import cast
+
+import pytest
+from sqlalchemy import Table, create_engine, event, insert, select
+
+from src.parking.models import Parking
+from src.parking.replica import ReplicaRouter
+
+
+@pytest.fixture()
+def app_config(tmp_path, request):
+    return {
+        "REPLICA_DATABASE_URL": f"sqlite:///{tmp_path}/replica.db",
+        "REPLICA_CHECK_INTERVAL": 0,
+        **getattr(request, "param", {}),
+    }
+
+
+@pytest.fixture()
+def replica(app, db):
+    """The replica holds one parking lot of its own"""
+
+    router = app.extensions["replica"]
+    engine = router.engine
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(
+            insert(cast(Table, Parking.__table__)),
+            {
+                "id": 1,
+                "address": "Replica",
+                "name": "Replica",
+                "opened": True,
+                "count_places": 5,
+                "count_available_places": 5,
+            },
+        )
+    yield router
+    engine.dispose()
+
+
+def test_reads_from_replica(client, db, replica):
+    """The GET routes read the replica, the writes go to the primary"""
+
+    assert [row["name"] for row in client.get("/parkings").json["parkings"]] == [
+        "Replica"
+    ]
+    assert client.get("/parkings/2").status_code == 404
+
+    response = client.post(
+        "/parkings",
+        json={
+            "name": "New",
+            "address": "New",
+            "opened": True,
+            "count_places": 1,
+            "count_available_places": 1,
+        },
+    )
+    assert response.status_code == 201
+    # the re-select after the commit reads the primary
+    assert len(response.json["parkings"]) == 3
+    assert db.session.scalar(select(Parking.name).where(Parking.address == "New"))
+
+    replica_names = (
+        replica.engine.connect().execute(select(Parking.name)).scalars().all()
+    )
+    assert replica_names == ["Replica"]
+
+
+def test_context_processor_reads_replica(client, replica):
+    assert "Replica" in client.get("/").get_data(as_text=True)
+
+
+def test_lagging_replica_falls_back(client, replica, monkeypatch):
+    monkeypatch.setattr(replica, "lag", lambda: replica.max_lag + 1)
+    assert len(client.get("/parkings").json["parkings"]) == 2
+
+    monkeypatch.setattr(replica, "lag", lambda: 0.0)
+    assert len(client.get("/parkings").json["parkings"]) == 1
+
+    def unreachable():
+        raise ConnectionError
+
+    monkeypatch.setattr(replica, "lag", unreachable)
+    assert len(client.get("/parkings").json["parkings"]) == 2
+
+
+def test_lag_checked_once_per_interval():
+    now = [0.0]
+    calls = []
+    router = ReplicaRouter(create_engine("sqlite://"), clock=lambda: now[0])
+    router.lag = lambda: calls.append(1) or 0.0  # type: ignore
+
+    assert router.available()
+    assert router.available()
+    now[0] = 2.0
+    assert router.available()
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize(
+    "app_config", [{"REVISIONS_BACKEND": "memory", "WEB_CONCURRENCY": 1}], indirect=True
+)
+def test_recent_change_reads_primary(client, db, replica):
+    """A route whose data changed within REPLICA_MAX_LAG reads the primary"""
+
+    app = client.application
+    app.config["REPLICA_MAX_LAG"] = 60
+    # a process started (or a change) long ago
+    app.extensions["revisions"]._started -= 120
+    assert len(client.get("/parkings").json["parkings"]) == 1
+
+    client.post("/client_parkings", json={"client_id": 1, "parking_id": 1})
+    parkings = client.get("/parkings").json["parkings"]
+    assert len(parkings) == 2
+    assert parkings[0]["count_available_places"] == 7
+
+
+@pytest.mark.parametrize("app_config", [{"METRICS_BACKEND": "memory"}], indirect=True)
+def test_replica_statements_are_measured(client, db, replica):
+    """The statements of the replica are in the metrics of the request"""
+
+    client.get("/parkings")
+    statements = []
+    for engine in (db.engine, replica.engine):
+        event.listen(
+            engine,
+            "before_cursor_execute",
+            lambda *args, engine=engine: statements.append(engine),
+        )
+    response = client.get("/parkings")
+    assert response.json["parkings"][0]["name"] == "Replica"
+    assert replica.engine in statements
+    assert f'desc="{len(statements)} queries"' in response.headers["Server-Timing"]
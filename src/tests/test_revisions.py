@@ -0,0 +1,161 @@
+import os
+import uuid
+
+import pytest
+
+from src.parking.revisions import (
+    MemoryRevisions,
+    SharedRevisions,
+    create_revisions,
+    etag,
+)
+from src.parking.shm import SHM_DIR, segment_name, unlink_segments
+
+
+@pytest.fixture()
+def app_config():
+    return {"REVISIONS_BACKEND": "memory", "WEB_CONCURRENCY": 1}
+
+
+def test_memory_revisions():
+    """A bump changes the ETag of the key only, a new process has a new epoch"""
+
+    revisions = MemoryRevisions()
+    parkings, _ = etag(revisions, "parkings")
+    row, _ = etag(revisions, "parkings:1")
+
+    revisions.bump("parkings:1")
+    assert etag(revisions, "parkings")[0] == parkings
+    assert etag(revisions, "parkings:1")[0] != row
+    assert etag(revisions, "parkings", "limit=10")[0] != parkings
+    assert etag(MemoryRevisions(), "parkings")[0] != parkings
+
+
+def test_memory_revisions_of_one_process():
+    config = {"REVISIONS_BACKEND": "memory"}
+    with pytest.raises(ValueError):
+        create_revisions(dict(config, WEB_CONCURRENCY=4))
+    assert isinstance(
+        create_revisions(dict(config, WEB_CONCURRENCY=1)), MemoryRevisions
+    )
+
+
+def test_shared_revisions_between_workers():
+    """Two attachments of the same segment share the epoch and the versions"""
+
+    name = f"parking_test_{uuid.uuid4().hex[:8]}"
+    first = SharedRevisions(name, capacity=16)
+    second = SharedRevisions(name, capacity=16)
+    try:
+        assert first.epoch == second.epoch
+        tag, _ = etag(second, "parkings")
+        first.bump("parkings")
+        assert etag(second, "parkings")[0] != tag
+        assert etag(second, "parkings") == etag(first, "parkings")
+    finally:
+        second.close()
+        first.unlink()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_memory_revisions_after_fork():
+    """A worker forked from the master (preload_app) has its own epoch"""
+
+    revisions = MemoryRevisions()
+    epoch = revisions.epoch
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover
+        os._exit(0 if revisions.epoch != epoch else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    assert revisions.epoch == epoch
+
+
+def test_segment_names():
+    config = {"SHM_PREFIX": "parking_1_ab", "METRICS_SHM_NAME": "metrics"}
+    assert segment_name(config, "revisions") == "parking_1_ab_revisions"
+    assert segment_name(config, "metrics") == "metrics"
+    assert segment_name({}, "revisions") == f"parking_{os.getpid()}_revisions"
+
+
+@pytest.mark.skipif(not os.path.isdir(SHM_DIR), reason="needs /dev/shm")
+def test_segments_unlinked_on_exit():
+    """The segments of a stopped master are removed, a restart starts empty"""
+
+    prefix = f"parking_test_{uuid.uuid4().hex[:8]}"
+    revisions = SharedRevisions(segment_name({"SHM_PREFIX": prefix}, "revisions"))
+    revisions.bump("parkings")
+    revisions.close()
+    assert unlink_segments(prefix) == [f"{prefix}_revisions"]
+    assert unlink_segments(prefix) == []
+
+    revisions = SharedRevisions(f"{prefix}_revisions")
+    try:
+        assert revisions.get("parkings")[0] == 0
+    finally:
+        revisions.unlink()
+
+
+@pytest.mark.parametrize("url", ["/parkings", "/parkings/1", "/clients/1"])
+def test_not_modified(client, url):
+    """The ETag of a read route is answered with 304 while nothing changed"""
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers["ETag"]
+    assert response.headers["Last-Modified"]
+    assert "no-cache" in response.headers["Cache-Control"]
+
+    cached = client.get(url, headers={"If-None-Match": response.headers["ETag"]})
+    assert cached.status_code == 304
+    assert cached.headers["ETag"] == response.headers["ETag"]
+    assert cached.data == b""
+
+
+def test_private_clients(client):
+    """Client data is never stored by shared caches"""
+
+    response = client.get("/clients/1")
+    assert "private" in response.headers["Cache-Control"]
+    assert "public" in client.get("/parkings").headers["Cache-Control"]
+
+
+def test_not_found_without_etag(client):
+    response = client.get("/parkings/100")
+    assert response.status_code == 404
+    assert "ETag" not in response.headers
+
+
+def test_arrival_changes_etag(client):
+    """A write path bumps the revisions of the table and of the row"""
+
+    listing = client.get("/parkings").headers["ETag"]
+    parking = client.get("/parkings/1").headers["ETag"]
+    other = client.get("/parkings/2").headers["ETag"]
+
+    arrival = client.post("/client_parkings", json={"client_id": 1, "parking_id": 1})
+    assert arrival.status_code == 201
+
+    response = client.get("/parkings", headers={"If-None-Match": listing})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != listing
+    response = client.get("/parkings/1", headers={"If-None-Match": parking})
+    assert response.status_code == 200
+    assert response.json["parking"]["count_available_places"] == 7
+    response = client.get("/parkings/2", headers={"If-None-Match": other})
+    assert response.status_code == 304
+
+
+def test_new_parking_changes_listing_etag(client):
+    listing = client.get("/parkings").headers["ETag"]
+    data = {
+        "name": "Аэропорт",
+        "address": "Новосибирск, Толмачёво",
+        "opened": True,
+        "count_places": 100,
+        "count_available_places": 100,
+    }
+    assert client.post("/parkings", json=data).status_code == 201
+    response = client.get("/parkings", headers={"If-None-Match": listing})
+    assert response.status_code == 200
+    assert len(response.json["parkings"]) == 3
@@ -0,0 +1,102 @@
+import pytest
+from sqlalchemy import text
+
+from src.parking.models import Parking
+from src.parking.search import distance, nearest_parkings
+
+# (name, address, opened, available, latitude, longitude)
+LOTS = [
+    ("Центр", "Новосибирск, Красный проспект, 1", True, 0, 55.030, 82.920),
+    ("Вокзал", "Новосибирск, Дмитрия Шамшурина, 43", True, 5, 55.035, 82.897),
+    ("Аэропорт", "Обь, Толмачёво", True, 40, 55.012, 82.650),
+    ("Academ_50%", "Новосибирск, Морской проспект, 2", False, 9, 54.850, 83.110),
+]
+
+
+@pytest.fixture()
+def lots(db):
+    db.session.add_all(
+        [
+            Parking(
+                name=name,
+                address=address,
+                opened=opened,
+                count_places=50,
+                count_available_places=available,
+                latitude=latitude,
+                longitude=longitude,
+            )
+            for name, address, opened, available, latitude, longitude in LOTS
+        ]
+    )
+    db.session.commit()
+
+
+def names(response):
+    assert response.status_code == 200
+    return [parking["name"] for parking in response.json["parkings"]]
+
+
+def test_filters(client, lots):
+    assert names(client.get("/parkings?opened=0")) == ["На Горской", "Academ_50%"]
+    assert names(client.get("/parkings?opened=1&min_free=6")) == [
+        "Сан Сити",
+        "Аэропорт",
+    ]
+    assert client.get("/parkings?opened=maybe").status_code == 400
+
+
+def test_text_search(client, lots):
+    """Substring (trigram index) and prefix search on the name or address"""
+
+    assert names(client.get("/parkings?q=проспект")) == ["Центр", "Academ_50%"]
+    assert names(client.get("/parkings?q=ПРОСПЕКТ")) == ["Центр", "Academ_50%"]
+    assert names(client.get("/parkings?q=Об")) == ["Аэропорт"]
+    assert names(client.get("/parkings?q=_50%")) == ["Academ_50%"]
+    assert names(client.get("/parkings?prefix=Обь")) == ["Аэропорт"]
+    assert names(client.get("/parkings?prefix=Толм")) == []
+    assert names(client.get("/parkings?q=проспект&opened=1")) == ["Центр"]
+
+
+def test_search_with_pagination(client, lots):
+    response = client.get("/parkings?q=Новосибирск&limit=2")
+    assert [row["id"] for row in response.json["parkings"]] == [1, 2]
+    after = response.json["next"]
+    response = client.get(f"/parkings?q=Новосибирск&limit=2&after={after}")
+    assert names(response) == ["Центр", "Вокзал"]
+
+
+def test_search_index_follows_updates(app, db, lots):
+    db.session.execute(text("UPDATE parkings SET name = 'Рынок' WHERE id = 3"))
+    db.session.commit()
+    matches = db.session.execute(
+        text("SELECT rowid FROM parkings_search WHERE parkings_search MATCH 'Рынок'")
+    ).all()
+    assert matches == [(3,)]
+
+
+def test_distance():
+    assert distance(55.0, 82.9, 55.0, 82.9) == 0
+    assert distance(0.0, 0.0, 1.0, 0.0) == pytest.approx(111_195, rel=1e-3)
+
+
+def test_nearest_parkings(app, db, lots):
+    found = nearest_parkings(55.031, 82.919)
+    # the lot of the center is full, the lots of the first box are enough
+    assert [parking["name"] for parking, _ in found] == ["Вокзал"]
+    assert found[0][1] == pytest.approx(1400, rel=0.1)
+    assert nearest_parkings(55.031, 82.919, min_free=10)[0][0]["name"] == "Аэропорт"
+    assert nearest_parkings(55.031, 82.919, min_free=100) == []
+
+
+def test_nearest_endpoint(client, lots):
+    response = client.get("/parkings/nearest?lat=55.031&lon=82.919&min_free=2")
+    assert response.status_code == 200
+    assert response.json["parking"]["name"] == "Вокзал"
+    assert response.json["parking"]["distance_m"] > 0
+
+    assert (
+        client.get("/parkings/nearest?lat=55&lon=82.9&min_free=99").status_code == 404
+    )
+    assert client.get("/parkings/nearest?lat=95&lon=82.9").status_code == 400
+    assert client.get("/parkings/nearest?lon=82.9").status_code == 400
@@ -0,0 +1,32 @@
+import json
+from datetime import datetime
+
+from flask.json.provider import DefaultJSONProvider
+
+from src.parking.models import ClientParking, Parking
+from src.parking.serializers import FastJSONProvider
+
+
+def test_row_encoder_matches_columns(db):
+    """The encoders give the same dict as the columns of the table"""
+
+    parking = db.session.get(Parking, 1)
+    expected = {c.name: getattr(parking, c.name) for c in Parking.__table__.columns}
+    assert parking.to_json() == expected
+
+    row = db.session.execute(Parking._encoder.select().where(Parking.id == 1)).one()
+    assert Parking._encoder.from_row(row) == expected
+
+
+def test_fast_json_provider_same_output(app):
+    """The fast provider keeps the format of the default provider"""
+
+    visit = ClientParking(id=1, client_id=1, parking_id=2, time_in=datetime(2025, 5, 1))
+    data = {"b": [visit.to_json()], "a": "Сан Сити"}
+
+    fast = FastJSONProvider(app).dumps(data)
+    default = DefaultJSONProvider(app).dumps(data)
+    assert json.loads(fast) == json.loads(default)
+    assert '"time_in":"Thu, 01 May 2025 00:00:00 GMT"' in fast
+    assert fast.index('"a"') < fast.index('"b"')
+    assert isinstance(app.json, FastJSONProvider)